@@ -1,8 +1,11 @@
 import streamlit as st
 import base64
 from utils.auth import login_form
-from utils.docs import handle_upload, handle_delete, list_documents
-from utils.chat import handle_chat
+from utils.docs import handle_upload, handle_delete, list_documents, show_jobs
+from utils.chat import handle_chat_stream
+from utils.vector_store import get_query_cache_stats
+from utils.llm_cache import get_response_cache
+from utils.context import BASELINE_CONTEXT_CHUNKS, get_context_stats
 import os
 
 # Page configuration
@@ -149,6 +152,27 @@ else:
     
     # Delete section
     handle_delete()
+    
+    # Background indexing job statuses
+    with st.sidebar:
+        show_jobs()
+    
+    # Retrieval cache counters for monitoring
+    cache_stats = get_query_cache_stats()
+    st.sidebar.caption(
+        f"Search cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses "
+        f"({cache_stats['hit_rate']:.0%} hit rate)"
+    )
+    answer_cache_stats = get_response_cache().stats()
+    st.sidebar.caption(
+        f"Answer cache: {answer_cache_stats['hits']} hits, {answer_cache_stats['misses']} misses "
+        f"({answer_cache_stats['hit_rate']:.0%} hit rate)"
+    )
+    context_stats = get_context_stats()["total"]
+    st.sidebar.caption(
+        f"Context packing: {context_stats['tokens_used']:,} tokens over {context_stats['prompts']} prompts "
+        f"({context_stats['tokens_baseline']:,} with the former top-{BASELINE_CONTEXT_CHUNKS} context)"
+    )
 
 # AI Model Settings
 st.sidebar.header("AI Model Settings")
@@ -358,9 +382,16 @@ with col1:
         # Add user message to chat history
         st.session_state['chat_history'].append({'role': 'user', 'content': query})
         
-        # Get response from RAG system
+        # Stream the response from the RAG system, showing the spinner
+        # only until the first piece of the answer arrives
+        response_placeholder = st.empty()
         with st.spinner("Getting answer..."):
-            response = handle_chat(query, internal_model_choice, api_key, uploaded_file)
+            response_stream = handle_chat_stream(query, internal_model_choice, api_key, uploaded_file)
+            response = next(response_stream, "")
+        response_placeholder.markdown(f"<div class='bot-message'>{response}</div>", unsafe_allow_html=True)
+        for delta in response_stream:
+            response += delta
+            response_placeholder.markdown(f"<div class='bot-message'>{response}</div>", unsafe_allow_html=True)
         
         # Add bot response to chat history
         st.session_state['chat_history'].append({'role': 'assistant', 'content': response})
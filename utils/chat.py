@@ -1,8 +1,15 @@
 import streamlit as st
-from utils.vector_store import search_index, extract_text_from_file
-from utils.llm import query_model
+from utils.vector_store import SimpleVectorStore, search_index_chunks, extract_text_from_file
+from utils.llm import query_model, stream_model
+from utils.context import (CONTEXT_CANDIDATES, PROMPT_TEMPLATE_TOKENS, context_budget, count_tokens,
+                           format_context, pack_context)
 import json
 import os
+import hashlib
+import tempfile
+
+# Inline-uploaded documents kept extracted and indexed per session
+INLINE_DOCUMENT_LIMIT = 3
 
 def handle_chat(query, model_choice, api_key, uploaded_file=None):
     """
@@ -18,99 +25,188 @@ def handle_chat(query, model_choice, api_key, uploaded_file=None):
         Response string from the AI model
     """
     try:
-        # Handle uploaded file first if provided
-        temp_content = None
-        if uploaded_file is not None:
-            try:
-                # Save the uploaded file temporarily
-                import tempfile
-                with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-                    tmp_file.write(uploaded_file.getvalue())
-                    temp_path = tmp_file.name
+        prompt, context, reply = _prepare_chat(query, model_choice, uploaded_file)
+        if reply is not None:
+            return reply
+        return query_model(prompt, model_choice, api_key, question=query, context=context)
+    
+    except Exception as e:
+        return f"Sorry, I encountered an error while processing your request: {str(e)}"
+
+def handle_chat_stream(query, model_choice, api_key, uploaded_file=None):
+    """
+    Handle a chat query like handle_chat, streaming the answer as it is generated.
+    
+    Args:
+        query: User query string
+        model_choice: Selected AI model
+        api_key: API key for the selected model
+        uploaded_file: Optional uploaded file to process and query
+        
+    Yields:
+        Successive pieces of the response text
+    """
+    try:
+        prompt, context, reply = _prepare_chat(query, model_choice, uploaded_file)
+    except Exception as e:
+        yield f"Sorry, I encountered an error while processing your request: {str(e)}"
+        return
+    if reply is not None:
+        yield reply
+        return
+    yield from stream_model(prompt, model_choice, api_key, question=query, context=context)
+
+def _inline_document(uploaded_file):
+    """
+    Extracted text and ephemeral index of an inline upload.
+    
+    Both are cached in the session by the SHA-256 of the file, so follow-up
+    questions about the same file skip extraction and indexing. The index is
+    an in-memory store built on first need.
+    
+    Args:
+        uploaded_file: The file attached with the inline uploader
+        
+    Returns:
+        Dict with the document "text" and its "index" (None until built)
+    """
+    data = uploaded_file.getvalue()
+    digest = hashlib.sha256(data).hexdigest()
+    if 'inline_documents' not in st.session_state:
+        st.session_state['inline_documents'] = {}
+    inline_documents = st.session_state['inline_documents']
+    
+    inline_doc = inline_documents.pop(digest, None)
+    if inline_doc is None:
+        # Save the uploaded file temporarily
+        with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
+            tmp_file.write(data)
+            temp_path = tmp_file.name
+        
+        try:
+            # Extract text from the uploaded file
+            inline_doc = {"text": extract_text_from_file(temp_path), "index": None}
+        finally:
+            # Clean up the temporary file
+            os.unlink(temp_path)
+    
+    # Keep the most recently used documents, newest last
+    inline_documents[digest] = inline_doc
+    while len(inline_documents) > INLINE_DOCUMENT_LIMIT:
+        del inline_documents[next(iter(inline_documents))]
+    return inline_doc
+
+def _prepare_chat(query, model_choice, uploaded_file=None):
+    """
+    Retrieve context for a chat query and build the model prompt.
+    
+    The context is packed into a token budget that fits the selected
+    model's context window.
+    
+    Args:
+        query: User query string
+        model_choice: Selected AI model
+        uploaded_file: Optional uploaded file to process and query
+        
+    Returns:
+        (prompt, context, reply): the prompt and the context it was built
+        from, or a reply to show directly when no model call is needed
+    """
+    budget = context_budget(model_choice, st.session_state.get("specific_model", ""),
+                            count_tokens(query) + PROMPT_TEMPLATE_TOKENS)
+    
+    # Handle uploaded file first if provided
+    temp_content = None
+    if uploaded_file is not None:
+        try:
+            inline_doc = _inline_document(uploaded_file)
+            temp_content = inline_doc["text"]
+            
+            if temp_content:
+                # Send the document as is if it fits, else only its chunks
+                # most relevant to the question
+                if count_tokens(temp_content) > budget:
+                    if inline_doc["index"] is None:
+                        inline_doc["index"] = SimpleVectorStore(None)
+                        inline_doc["index"].add_document(uploaded_file.name, temp_content)
+                    chunks = inline_doc["index"].search_chunks(query, top_k=CONTEXT_CANDIDATES)
+                    passages, _ = pack_context(chunks, budget)
+                    temp_content = "\n\n".join(passage["content"] for passage in passages)
                 
-                # Extract text from the uploaded file
-                temp_content = extract_text_from_file(temp_path)
+                # Process the uploaded file content directly
+                prompt = f"""
+                Content from uploaded document:
+                {temp_content}
                 
-                # Clean up the temporary file
-                os.unlink(temp_path)
+                User question: {query}
                 
-                if temp_content:
-                    # Process the uploaded file content directly
-                    prompt = f"""
-                    Content from uploaded document:
-                    {temp_content}
-                    
-                    User question: {query}
-                    
-                    Based only on the content from the uploaded document above, answer the user's question.
-                    If the answer cannot be directly found in the document content, state that clearly.
-                    Begin your response with: "Based on the uploaded document:"
-                    """
-                    
-                    return query_model(prompt, model_choice, api_key)
-                else:
-                    return "I couldn't extract text from the uploaded file. Please make sure it's a valid PDF, DOCX, or TXT file."
-                    
-            except Exception as e:
-                return f"Error processing uploaded file: {str(e)}"
+                Based only on the content from the uploaded document above, answer the user's question.
+                If the answer cannot be directly found in the document content, state that clearly.
+                Begin your response with: "Based on the uploaded document:"
+                """
+                
+                return prompt, temp_content, None
+            else:
+                return None, None, "I couldn't extract text from the uploaded file. Please make sure it's a valid PDF, DOCX, or TXT file."
+                
+        except Exception as e:
+            return None, None, f"Error processing uploaded file: {str(e)}"
+    
+    # Get selected documents from session state
+    selected_docs = st.session_state.get('selected_documents', [])
+    
+    # First try to find relevant document chunks
+    if selected_docs:
+        # Search only in selected documents
+        doc_paths = [os.path.join("uploaded_docs", doc) for doc in selected_docs]
+        matches = search_index_chunks(query, top_k=CONTEXT_CANDIDATES, specific_docs=doc_paths)
+        doc_msg = f"Searched within {len(selected_docs)} selected documents"
+    else:
+        # Search all documents
+        matches = search_index_chunks(query, top_k=CONTEXT_CANDIDATES)
+        doc_msg = "Searched all available documents"
+    
+    if matches and len(matches) > 0:
+        # If we have relevant document matches, pack the best of them as context
+        passages, _ = pack_context(matches, budget)
+        context = format_context(passages)
         
-        # Get selected documents from session state
-        selected_docs = st.session_state.get('selected_documents', [])
+        prompt = f"""
+        Context information from company documents:
+        {context}
         
-        # First try to find relevant document chunks
-        if selected_docs:
-            # Search only in selected documents
-            doc_paths = [os.path.join("uploaded_docs", doc) for doc in selected_docs]
-            matches = search_index(query, specific_docs=doc_paths)
-            doc_msg = f"Searched within {len(selected_docs)} selected documents"
-        else:
-            # Search all documents
-            matches = search_index(query)
-            doc_msg = "Searched all available documents"
+        User question: {query}
         
-        if matches and len(matches) > 0:
-            # If we have relevant document matches, use them as context
-            context = "\n\n".join([f"Document content: {match}" for match in matches])
-            
-            prompt = f"""
-            Context information from company documents:
-            {context}
-            
-            User question: {query}
-            
-            Based only on the context information provided, answer the user's question.
-            If the answer cannot be directly found in the context, state that clearly.
-            Begin your response with: "{doc_msg}"
-            """
-            
-            return query_model(prompt, model_choice, api_key)
-        else:
-            # If no document matches, try FAQ
-            faq_path = "faq.json"
-            
-            if os.path.exists(faq_path):
-                with open(faq_path, "r") as f:
-                    faq = json.load(f)
-                
-                # Look for matching FAQ questions
-                for q, a in faq.items():
-                    if q.lower() in query.lower() or query.lower() in q.lower():
-                        return f"From FAQ:\n{a}"
-            
-            # If no FAQ matches either, let the AI try to answer generally
-            prompt = f"""
-            User question: {query}
-            
-            The user is asking about company information, but I couldn't find specific 
-            documents or FAQ entries related to this question. 
-            {doc_msg}, but no relevant information was found.
-            
-            Please provide a general response stating that you don't have specific 
-            information on this topic and suggest what the user might do next.
-            Begin your response with: "{doc_msg}, but no relevant information was found."
-            """
+        Based only on the context information provided, answer the user's question.
+        If the answer cannot be directly found in the context, state that clearly.
+        Begin your response with: "{doc_msg}"
+        """
+        
+        return prompt, context, None
+    else:
+        # If no document matches, try FAQ
+        faq_path = "faq.json"
+        
+        if os.path.exists(faq_path):
+            with open(faq_path, "r") as f:
+                faq = json.load(f)
             
-            return query_model(prompt, model_choice, api_key)
-    
-    except Exception as e:
-        return f"Sorry, I encountered an error while processing your request: {str(e)}"
+            # Look for matching FAQ questions
+            for q, a in faq.items():
+                if q.lower() in query.lower() or query.lower() in q.lower():
+                    return None, None, f"From FAQ:\n{a}"
+        
+        # If no FAQ matches either, let the AI try to answer generally
+        prompt = f"""
+        User question: {query}
+        
+        The user is asking about company information, but I couldn't find specific 
+        documents or FAQ entries related to this question. 
+        {doc_msg}, but no relevant information was found.
+        
+        Please provide a general response stating that you don't have specific 
+        information on this topic and suggest what the user might do next.
+        Begin your response with: "{doc_msg}, but no relevant information was found."
+        """
+        
+        return prompt, None, None
@@ -0,0 +1,180 @@
+import os
+import math
+import threading
+from typing import Any, Dict, List, Tuple
+from utils.vector_store import CHUNK_OVERLAP
+from utils.llm import RESPONSE_TOKEN_RESERVE, context_window
+
+# Use tiktoken for exact token counts when it is installed and its encoding
+# is available offline; otherwise estimate from the character count
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+# Upper bound on the tokens of retrieved context put into one prompt; the
+# model's context window lowers it further for small models
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("RAG_CONTEXT_TOKENS", "6000"))
+
+# Number of chunks retrieved as candidates for packing
+CONTEXT_CANDIDATES = 8
+
+# Chunks the prompt held before packing (the top 3 retrieved), the baseline
+# packing statistics are measured against
+BASELINE_CONTEXT_CHUNKS = 3
+
+# Allowance for the fixed instructions around the context in chat prompts
+PROMPT_TEMPLATE_TOKENS = 100
+
+# Average characters per token, for the estimate without tiktoken
+CHARS_PER_TOKEN = 4
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in text, exact with tiktoken and estimated otherwise."""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def context_budget(model_choice: str, specific_model: str, prompt_tokens: int = 0) -> int:
+    """
+    Tokens available for context in a prompt to the given model.
+
+    Args:
+        model_choice: Selected AI model provider
+        specific_model: Display name of the specific model
+        prompt_tokens: Tokens of the prompt around the context
+
+    Returns:
+        The smaller of CONTEXT_TOKEN_BUDGET and what the model's window
+        leaves after the prompt and the answer
+    """
+    window = context_window(model_choice, specific_model)
+    return max(0, min(CONTEXT_TOKEN_BUDGET, window - RESPONSE_TOKEN_RESERVE - prompt_tokens))
+
+def _overlap_length(previous: str, text: str, max_overlap: int) -> int:
+    """Length of the longest prefix of text that is a suffix of previous."""
+    for length in range(min(max_overlap, len(previous), len(text)), 0, -1):
+        if previous.endswith(text[:length]):
+            return length
+    return 0
+
+def _merge_passages(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Merge chunks into passages without repeated text.
+
+    Identical chunks are kept once. Chunks at consecutive positions of the
+    same document become one passage, with the text the later chunk repeats
+    from the earlier one (up to CHUNK_OVERLAP characters) removed. A passage
+    scores as its best chunk.
+    """
+    seen = set()
+    by_doc: Dict[str, List[Dict[str, Any]]] = {}
+    for chunk in chunks:
+        content = " ".join(chunk["content"].split())
+        if content in seen:
+            continue
+        seen.add(content)
+        by_doc.setdefault(chunk.get("doc_path", ""), []).append(chunk)
+
+    passages = []
+    for doc_chunks in by_doc.values():
+        doc_chunks.sort(key=lambda chunk: chunk.get("position", 0))
+        passage = None
+        for chunk in doc_chunks:
+            if passage is not None and chunk.get("position") == passage["last_position"] + 1:
+                previous = passage["content"]
+                text = chunk["content"]
+                overlap = _overlap_length(previous, text, CHUNK_OVERLAP)
+                passage["content"] = previous + (text[overlap:] if overlap else " " + text)
+                passage["score"] = max(passage["score"], chunk.get("score", 0.0))
+                passage["last_position"] = chunk["position"]
+            else:
+                passage = {
+                    "content": chunk["content"],
+                    "doc_name": chunk.get("doc_name", ""),
+                    "score": chunk.get("score", 0.0),
+                    "last_position": chunk.get("position", 0),
+                }
+                passages.append(passage)
+    for passage in passages:
+        del passage["last_position"]
+    return passages
+
+def _select_chunks(chunks: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+    """
+    Pick chunks best score first while they fit the budget.
+
+    A chunk following an already picked chunk of the same document only
+    costs the tokens it adds beyond their overlap. Chunks too big for what
+    is left are skipped in favour of smaller ones.
+    """
+    picked = {}
+    tokens_used = 0
+    for chunk in sorted(chunks, key=lambda chunk: -chunk.get("score", 0.0)):
+        text = chunk["content"]
+        previous = picked.get((chunk.get("doc_path", ""), chunk.get("position", 0) - 1))
+        if previous is not None:
+            text = text[_overlap_length(previous["content"], text, CHUNK_OVERLAP):]
+        tokens = count_tokens(text)
+        if tokens_used + tokens <= budget:
+            picked[(chunk.get("doc_path", ""), chunk.get("position", 0))] = chunk
+            tokens_used += tokens
+    return list(picked.values())
+
+def pack_context(chunks: List[Dict[str, Any]], budget: int) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    Select the passages to put into a prompt within a token budget.
+
+    Args:
+        chunks: Retrieved chunks with content and, where known, doc_path,
+            doc_name, position and score
+        budget: Maximum tokens of packed context
+
+    Returns:
+        (passages, stats): passages ordered by score, and counts of the
+        candidate tokens, tokens used, tokens the top BASELINE_CONTEXT_CHUNKS
+        chunks would have used, and tokens saved relative to those
+        (negative when packing sent more)
+    """
+    tokens_available = sum(count_tokens(chunk["content"]) for chunk in chunks)
+    # Chunks arrive best first, as retrieval ranked them
+    tokens_baseline = sum(count_tokens(chunk["content"]) for chunk in chunks[:BASELINE_CONTEXT_CHUNKS])
+    passages = _merge_passages(_select_chunks(chunks, budget))
+    # Stable sort keeps retrieval order between passages of equal score
+    passages.sort(key=lambda passage: -passage["score"])
+    tokens_used = sum(count_tokens(passage["content"]) for passage in passages)
+
+    stats = {
+        "chunks": len(chunks),
+        "passages": len(passages),
+        "tokens_available": tokens_available,
+        "tokens_used": tokens_used,
+        "tokens_baseline": tokens_baseline,
+        "tokens_saved": tokens_baseline - tokens_used,
+    }
+    _record_stats(stats)
+    return passages, stats
+
+def format_context(passages: List[Dict[str, Any]]) -> str:
+    """Join packed passages into the context block of a prompt."""
+    return "\n\n".join(f"Document content: {passage['content']}" for passage in passages)
+
+# Packing statistics of this process, for monitoring
+_stats_lock = threading.Lock()
+_last_stats: Dict[str, int] = {}
+_total_stats = {"prompts": 0, "tokens_used": 0, "tokens_baseline": 0, "tokens_saved": 0}
+
+def _record_stats(stats: Dict[str, int]) -> None:
+    global _last_stats
+    with _stats_lock:
+        _last_stats = dict(stats)
+        _total_stats["prompts"] += 1
+        _total_stats["tokens_used"] += stats["tokens_used"]
+        _total_stats["tokens_baseline"] += stats["tokens_baseline"]
+        _total_stats["tokens_saved"] += stats["tokens_saved"]
+
+def get_context_stats() -> Dict[str, Any]:
+    """Statistics of the last packed context and totals since startup."""
+    with _stats_lock:
+        return {"last": dict(_last_stats), "total": dict(_total_stats)}
@@ -0,0 +1,224 @@
+import os
+import numpy as np
+from abc import ABC, abstractmethod
+from typing import Optional, Tuple
+
+try:
+    import faiss
+    faiss_available = True
+except ImportError:
+    faiss_available = False
+
+# Dense index used for the persisted segment: "numpy" (exact) or "faiss"
+DENSE_BACKEND = os.environ.get("RAG_DENSE_BACKEND", "numpy")
+
+# FAISS index type when DENSE_BACKEND is "faiss": "flat", "ivf" or "hnsw"
+FAISS_INDEX_TYPE = os.environ.get("RAG_FAISS_INDEX", "hnsw")
+
+# IVF: upper bound on the number of inverted lists, and lists probed per query
+FAISS_IVF_MAX_LISTS = 4096
+FAISS_IVF_NPROBE = 16
+
+# HNSW: graph degree, and candidate list sizes when building and searching
+FAISS_HNSW_M = 32
+FAISS_HNSW_EF_CONSTRUCTION = 80
+FAISS_HNSW_EF_SEARCH = 64
+
+class DenseIndex(ABC):
+    """
+    Interface of the dense vector indexes used by the vector store.
+
+    Ids are row numbers: the vector added n-th has id n. The store maps rows
+    to chunks and handles removals by passing a live mask to search, so an
+    index never has to delete vectors in place.
+    """
+    name = "base"
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of vectors in the index."""
+
+    @abstractmethod
+    def search(self, query: np.ndarray, top_k: int, live: Optional[np.ndarray] = None,
+               candidates: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the top_k vectors with the highest inner product with query.
+
+        Args:
+            query: Query vector of length dim
+            top_k: Number of results to return
+            live: Optional boolean mask over ids; False entries are never returned
+            candidates: Optional ids to restrict the search to
+
+        Returns:
+            (ids, scores) arrays ordered by descending score
+        """
+
+    def save(self, directory: str) -> None:
+        """Persist any index structures beyond the raw vectors into directory."""
+
+class NumpyDenseIndex(DenseIndex):
+    """
+    Exact inner-product search over a contiguous float32 matrix.
+
+    Row i of the matrix holds the vector with id i. Scoring is a single
+    matrix-vector product followed by argpartition, so there is no
+    per-vector Python work. The matrix may be a read-only memory map;
+    it is copied into a growable buffer on the first add.
+    """
+    name = "numpy"
+
+    def __init__(self, dim: int, vectors: Optional[np.ndarray] = None):
+        self.dim = dim
+        if vectors is None:
+            vectors = np.zeros((0, dim), dtype=np.float32)
+        self._vectors = vectors
+        self._size = len(vectors)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """The (len, dim) matrix of stored vectors."""
+        return self._vectors[:self._size]
+
+    def add(self, vectors: np.ndarray) -> int:
+        """Append vectors, returning the id assigned to the first one."""
+        first_id = self._size
+        needed = self._size + len(vectors)
+        if needed > len(self._vectors) or not self._vectors.flags.writeable:
+            # Grow geometrically so appends are amortized O(1) per vector
+            capacity = max(needed, 2 * len(self._vectors), 64)
+            grown = np.zeros((capacity, self.dim), dtype=np.float32)
+            grown[:self._size] = self._vectors[:self._size]
+            self._vectors = grown
+        self._vectors[self._size:needed] = vectors
+        self._size = needed
+        return first_id
+
+    def search(self, query: np.ndarray, top_k: int, live: Optional[np.ndarray] = None,
+               candidates: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        if candidates is None:
+            ids = None
+            scores = self.vectors @ query
+        else:
+            ids = np.asarray(candidates, dtype=np.int64)
+            scores = self._vectors[ids] @ query
+        if live is not None:
+            scores = np.where(live[ids] if ids is not None else live[:self._size], scores, -np.inf)
+
+        k = min(top_k, len(scores))
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        top = top[np.isfinite(scores[top])]
+        result_ids = ids[top] if ids is not None else top.astype(np.int64)
+        return result_ids, scores[top]
+
+class FaissDenseIndex(DenseIndex):
+    """
+    Approximate (or, for "flat", exact) inner-product search with FAISS.
+
+    Dead rows are excluded with an ID selector during the search rather than
+    removed from the index, which HNSW does not support. Searches scoped to a
+    set of candidate ids score those candidates exactly against the raw
+    vectors, which is cheaper than a heavily filtered graph or list walk.
+    """
+    def __init__(self, index, index_type: str, vectors: np.ndarray):
+        self.index = index
+        self.index_type = index_type
+        self.name = f"faiss-{index_type}"
+        self._exact = NumpyDenseIndex(vectors.shape[1], vectors)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, index_type: str = FAISS_INDEX_TYPE) -> "FaissDenseIndex":
+        """Build an index of the given type over an (n, dim) float32 matrix."""
+        num_vectors, dim = vectors.shape
+        data = np.ascontiguousarray(vectors, dtype=np.float32)
+        if index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = FAISS_HNSW_EF_CONSTRUCTION
+        elif index_type == "ivf":
+            # Aim for ~39 training points per list, as FAISS recommends
+            num_lists = max(1, min(FAISS_IVF_MAX_LISTS, num_vectors // 39))
+            quantizer = faiss.IndexFlatIP(dim)
+            index = faiss.IndexIVFFlat(quantizer, dim, num_lists, faiss.METRIC_INNER_PRODUCT)
+            if num_vectors:
+                index.train(data)
+        elif index_type == "flat":
+            index = faiss.IndexFlatIP(dim)
+        else:
+            raise ValueError(f"Unknown FAISS index type: {index_type}")
+        if num_vectors:
+            index.add(data)
+        return cls(index, index_type, vectors)
+
+    @classmethod
+    def load(cls, directory: str, vectors: np.ndarray,
+             index_type: str = FAISS_INDEX_TYPE) -> Optional["FaissDenseIndex"]:
+        """Load a persisted index of the given type, or return None if there is none."""
+        path = os.path.join(directory, f"faiss-{index_type}.index")
+        if not os.path.exists(path):
+            return None
+        try:
+            # Share pages between processes where the index type allows it
+            index = faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            index = faiss.read_index(path)
+        if index.ntotal != len(vectors):
+            return None
+        return cls(index, index_type, vectors)
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def save(self, directory: str) -> None:
+        faiss.write_index(self.index, os.path.join(directory, f"faiss-{self.index_type}.index"))
+
+    def search(self, query: np.ndarray, top_k: int, live: Optional[np.ndarray] = None,
+               candidates: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        if candidates is not None:
+            return self._exact.search(query, top_k, live=live, candidates=candidates)
+        k = min(top_k, self.index.ntotal)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        selector = None
+        if live is not None:
+            live = live[:self.index.ntotal]
+            if not live.all():
+                # The bitmap must outlive the selector, which only borrows it
+                bitmap = np.packbits(live, bitorder='little')
+                selector = faiss.IDSelectorBitmap(len(live), faiss.swig_ptr(bitmap))
+        if self.index_type == "hnsw":
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=max(FAISS_HNSW_EF_SEARCH, k))
+        elif self.index_type == "ivf":
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=FAISS_IVF_NPROBE)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+
+        scores, ids = self.index.search(np.ascontiguousarray(query[np.newaxis], dtype=np.float32), k, params=params)
+        found = ids[0] >= 0
+        return ids[0][found].astype(np.int64), scores[0][found]
+
+def build_dense_index(vectors: np.ndarray, backend: str = DENSE_BACKEND) -> DenseIndex:
+    """
+    Build the configured dense index over a matrix of vectors.
+
+    Falls back to the exact NumPy index when FAISS is requested but not installed.
+    """
+    if backend == "faiss":
+        if faiss_available:
+            return FaissDenseIndex.build(vectors)
+        print("faiss is not installed; using the NumPy dense index. Install it with 'pip install faiss-cpu'.")
+    return NumpyDenseIndex(vectors.shape[1], vectors)
+
+def load_dense_index(directory: str, vectors: np.ndarray, backend: str = DENSE_BACKEND) -> DenseIndex:
+    """Load the configured dense index persisted in directory, building it if missing."""
+    if backend == "faiss" and faiss_available:
+        index = FaissDenseIndex.load(directory, vectors)
+        if index is not None:
+            return index
+    return build_dense_index(vectors, backend)
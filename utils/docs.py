@@ -1,11 +1,25 @@
 import streamlit as st
 import os
-from utils.vector_store import update_index_from_file, remove_from_index
+import tempfile
+from utils.jobs import DELETED_PREFIX, get_job_queue
 
 # Directory to store uploaded documents
 UPLOAD_DIR = "uploaded_docs"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
+# Seconds between refreshes of the job status panel, and jobs it lists
+JOBS_REFRESH_SECONDS = 2
+JOBS_SHOWN = 8
+
+JOB_STATUS_ICONS = {
+    "queued": "⏳",
+    "extracting": "📖",
+    "indexing": "🗂️",
+    "removing": "🗑️",
+    "done": "✅",
+    "failed": "❌",
+}
+
 def handle_upload():
     """Handle document upload through sidebar."""
     st.sidebar.subheader("Upload Document")
@@ -42,22 +56,22 @@ def handle_upload():
         st.session_state['upload_state']['processing'] = True
         
         try:
-            # Show processing indicator
-            status_placeholder = st.sidebar.empty()
-            status_placeholder.info("Processing document... please wait")
-            
-            # Create file path and save file
+            # Create file path and save file; the rename keeps a running job
+            # from ever reading a half-written file
             filepath = os.path.join(UPLOAD_DIR, file.name)
-            with open(filepath, "wb") as f:
+            fd, temp_path = tempfile.mkstemp(dir=UPLOAD_DIR, prefix=".upload-")
+            with os.fdopen(fd, "wb") as f:
                 f.write(file.getvalue())
+            os.replace(temp_path, filepath)
             
-            # Process and index the file
-            update_index_from_file(filepath)
+            # Index the file in the background
+            if get_job_queue().submit("upload", filepath) is None:
+                raise RuntimeError("the indexing job could not be queued")
             
             # Update status
             st.session_state['upload_state']['file_uploaded'] = True
-            st.session_state['upload_state']['message'] = f"📄 {file.name} uploaded and indexed!"
-            status_placeholder.success(st.session_state['upload_state']['message'])
+            st.session_state['upload_state']['message'] = f"📄 {file.name} uploaded and queued for indexing"
+            st.sidebar.success(st.session_state['upload_state']['message'])
             
         except Exception as e:
             error_msg = f"Error uploading document: {str(e)}"
@@ -128,19 +142,15 @@ def handle_delete():
             st.session_state['delete_state']['processing'] = True
             
             try:
-                # Show processing indicator
-                status_placeholder = st.sidebar.empty()
-                status_placeholder.info("Deleting document...")
-                
-                # Delete the file
+                # Remove the document from the index, then the file, in the background
                 file_path = os.path.join(UPLOAD_DIR, selected)
-                remove_from_index(file_path)
-                os.remove(file_path)
+                if get_job_queue().submit("delete", file_path) is None:
+                    raise RuntimeError("the delete job could not be queued")
                 
                 # Update status
                 st.session_state['delete_state']['file_deleted'] = True
-                st.session_state['delete_state']['message'] = f"🗑️ {selected} deleted"
-                status_placeholder.success(st.session_state['delete_state']['message'])
+                st.session_state['delete_state']['message'] = f"🗑️ {selected} queued for deletion"
+                st.sidebar.success(st.session_state['delete_state']['message'])
                 
             except Exception as e:
                 error_msg = f"Error deleting document: {str(e)}"
@@ -176,8 +186,35 @@ def handle_delete():
     else:
         st.sidebar.info("No documents available to delete.")
 
+@st.fragment(run_every=JOBS_REFRESH_SECONDS)
+def show_jobs():
+    """
+    Show the status of recent ingestion jobs.
+    
+    Runs as a fragment that reruns on its own every JOBS_REFRESH_SECONDS, so
+    progress updates without rerunning the page. Call it inside
+    `with st.sidebar:`, as fragments can't write to st.sidebar directly.
+    """
+    job_queue = get_job_queue()
+    st.subheader("Indexing Jobs")
+    
+    jobs = job_queue.jobs(limit=JOBS_SHOWN)
+    if not jobs:
+        st.caption("No indexing jobs yet.")
+    for job in jobs:
+        icon = JOB_STATUS_ICONS.get(job['status'], "")
+        line = f"{icon} {job['kind'].capitalize()} {os.path.basename(job['path'])}: {job['status']}"
+        if job['message']:
+            line += f" ({job['message']})"
+        st.caption(line)
+    
+    # Re-index every document; unchanged ones are skipped by content hash
+    if st.button("Re-index All", key="reindex_all_button", disabled=not list_documents()):
+        for name in list_documents():
+            job_queue.submit("reindex", os.path.join(UPLOAD_DIR, name))
+
 def list_documents():
     """Return list of available documents."""
     if os.path.exists(UPLOAD_DIR):
-        return sorted(os.listdir(UPLOAD_DIR))
+        return sorted(name for name in os.listdir(UPLOAD_DIR) if not name.startswith((".upload-", DELETED_PREFIX)))
     return []
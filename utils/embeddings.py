@@ -0,0 +1,129 @@
+import os
+import re
+import math
+import zlib
+import threading
+import numpy as np
+from typing import List
+
+# Dimension of the hashed feature embeddings
+EMBEDDING_DIM = 256
+
+# Path to a locally cached sentence-embedding model; when it exists it is used
+# instead of the hashing embedder. Nothing is ever downloaded.
+EMBEDDING_MODEL_PATH = os.environ.get("RAG_EMBEDDING_MODEL", "")
+
+TOKEN_PATTERN = re.compile(r'\b\w+\b')
+
+# Weight of character trigram features relative to whole-word features
+TRIGRAM_WEIGHT = 0.5
+
+# Number of words whose hashed features are memoized
+FEATURE_CACHE_SIZE = 200000
+
+class HashingEmbedder:
+    """
+    Offline embedder based on signed feature hashing.
+
+    Words and their character trigrams are hashed into a fixed number of
+    dimensions with log-scaled counts, then L2-normalized. It needs no
+    training data or model files, so vectors never change as the corpus
+    grows, and trigrams let related word forms (e.g. "refund" and
+    "refunds") score as similar.
+    """
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+        # Word -> hashed features; words repeat heavily across chunks
+        self._cache: dict = {}
+
+    def _word_features(self, word: str) -> List[tuple]:
+        """Hashed (bucket, signed weight) features of one word and its trigrams."""
+        features = self._cache.get(word)
+        if features is None:
+            grams = [word]
+            padded = f"<{word}>"
+            if len(padded) > 3:
+                grams.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+            features = []
+            for n, gram in enumerate(grams):
+                h = zlib.crc32(gram.encode('utf-8'))
+                sign = 1.0 if h & 0x80000000 else -1.0
+                features.append((h % self.dim, sign if n == 0 else sign * TRIGRAM_WEIGHT))
+            if len(self._cache) >= FEATURE_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[word] = features
+        return features
+
+    def _features(self, text: str) -> dict:
+        """Map hashed feature buckets to signed weights for a piece of text."""
+        word_counts: dict = {}
+        for word in TOKEN_PATTERN.findall(text.lower()):
+            word_counts[word] = word_counts.get(word, 0) + 1
+
+        features: dict = {}
+        for word, count in word_counts.items():
+            weight = 1 + math.log(count)
+            for bucket, value in self._word_features(word):
+                features[bucket] = features.get(bucket, 0.0) + weight * value
+        return features
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        """Embed texts into an (n, dim) float32 matrix of unit vectors."""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for bucket, value in self._features(text).items():
+                vectors[i, bucket] = value
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Embed a single query into a unit vector."""
+        return self.embed_documents([text])[0]
+
+class LocalModelEmbedder:
+    """Embedder backed by a sentence-embedding model cached on local disk."""
+    def __init__(self, model_path: str):
+        # Never reach out to the Hugging Face Hub
+        os.environ.setdefault("HF_HUB_OFFLINE", "1")
+        from langchain_community.embeddings import HuggingFaceEmbeddings
+
+        self.model = HuggingFaceEmbeddings(
+            model_name=model_path,
+            encode_kwargs={"normalize_embeddings": True}
+        )
+        self.name = f"model-{os.path.basename(os.path.normpath(model_path))}"
+        self.dim = len(self.model.embed_query("dimension probe"))
+
+    def embed_documents(self, texts: List[str]) -> np.ndarray:
+        """Embed texts into an (n, dim) float32 matrix of unit vectors."""
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.asarray(self.model.embed_documents(texts), dtype=np.float32)
+
+    def embed_query(self, text: str) -> np.ndarray:
+        """Embed a single query into a unit vector."""
+        return np.asarray(self.model.embed_query(text), dtype=np.float32)
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+def get_embedder():
+    """
+    Return the process-wide embedder.
+
+    Uses the local model at EMBEDDING_MODEL_PATH when it exists and can be
+    loaded, and falls back to the hashing embedder otherwise.
+    """
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            if EMBEDDING_MODEL_PATH and os.path.isdir(EMBEDDING_MODEL_PATH):
+                try:
+                    _embedder = LocalModelEmbedder(EMBEDDING_MODEL_PATH)
+                except Exception as e:
+                    print(f"Error loading local embedding model, using hashing embedder: {e}")
+            if _embedder is None:
+                _embedder = HashingEmbedder()
+        return _embedder
@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+import utils.vector_store as vector_store_module
+from utils.embeddings import get_embedder
+from utils.vector_store import chunk_document, get_vector_store, iter_text_from_file
+
+# File types picked up when walking a directory
+INGEST_EXTENSIONS = ('.pdf', '.docx', '.txt')
+
+# Documents committed to the index per log write, and extraction jobs queued
+# per worker process so workers never wait for the next file
+INGEST_BATCH_SIZE = 64
+INGEST_QUEUE_PER_WORKER = 4
+
+# Default progress file, kept next to the store it describes
+INGEST_PROGRESS_FILE = "ingest_progress.jsonl"
+
+def iter_documents(directory: str) -> Iterator[str]:
+    """Yield the paths of supported documents under a directory, in sorted order."""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in INGEST_EXTENSIONS:
+                yield os.path.join(root, name)
+
+def _file_signature(file_path: str) -> List[int]:
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def _init_worker() -> None:
+    # Files are already spread over the pool; a worker must not start a
+    # nested pool for the pages of a large PDF
+    vector_store_module.PDF_WORKERS = 1
+
+def _prepare_document(file_path: str) -> Dict[str, Any]:
+    """
+    Extract, chunk and embed one file; runs in pool workers.
+
+    Embedding here rather than in the parent keeps the parent's share of the
+    work to applying records, so throughput grows with the number of workers.
+
+    Returns:
+        Dict with the file's path and either chunks, content_hash, vectors
+        and the embedder name, or an error message
+    """
+    try:
+        chunks, content_hash = chunk_document(iter_text_from_file(file_path))
+        embedder = get_embedder()
+        return {
+            "path": file_path,
+            "chunks": chunks,
+            "content_hash": content_hash,
+            "vectors": embedder.embed_documents(chunks) if chunks else None,
+            "embedder": embedder.name,
+        }
+    except Exception as e:
+        return {"path": file_path, "error": str(e)}
+
+class IngestProgress:
+    """
+    Append-only record of files an ingest run has finished with.
+
+    Each line is a JSON object with a file's path, size, mtime and outcome,
+    written only after the batch holding the file is committed to the index.
+    A resumed run skips files whose size and mtime still match, so at most
+    one uncommitted batch is redone after a crash. Failed files are retried.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Dict[str, List[int]] = {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn final line from a crash
+                        continue
+                    if entry["status"] == "failed":
+                        self.done.pop(entry["path"], None)
+                    else:
+                        self.done[entry["path"]] = entry["signature"]
+        except FileNotFoundError:
+            pass
+
+    def is_done(self, file_path: str, signature: List[int]) -> bool:
+        return self.done.get(file_path) == signature
+
+    def record(self, entries: List[Dict[str, Any]]) -> None:
+        """Durably append outcomes of committed files."""
+        if not entries:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        for entry in entries:
+            if entry["status"] != "failed":
+                self.done[entry["path"]] = entry["signature"]
+
+    def reset(self) -> None:
+        """Forget all progress."""
+        self.done.clear()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+def ingest_directory(directory: str, store_directory: str = "simple_vector_store",
+                     workers: Optional[int] = None, batch_size: int = INGEST_BATCH_SIZE,
+                     progress_file: Optional[str] = None, restart: bool = False,
+                     compact: bool = True, verbose: bool = False) -> Dict[str, Any]:
+    """
+    Index every supported document under a directory.
+
+    Files are extracted, chunked and embedded in a process pool; the parent
+    process only applies the prepared chunks, batch_size documents per
+    durable log write. Documents whose content is already indexed are left
+    untouched. Progress is recorded after each batch, so an interrupted run picks up
+    where it stopped when started again with the same progress file.
+
+    Args:
+        directory: Directory tree to ingest
+        store_directory: Directory of the vector store to index into
+        workers: Number of worker processes; defaults to the number of CPUs
+        batch_size: Documents committed per log write
+        progress_file: Progress file; defaults to INGEST_PROGRESS_FILE in store_directory
+        restart: Ignore earlier progress and consider every file again
+        compact: Merge the ingested chunks into a new segment at the end
+        verbose: Print a line per committed batch
+
+    Returns:
+        Dict with counts of files seen, indexed, unchanged, resumed (skipped
+        thanks to earlier progress), empty and failed, and the seconds taken
+    """
+    started = time.monotonic()
+    workers = workers or os.cpu_count() or 1
+    vector_store = get_vector_store(store_directory)
+    progress = IngestProgress(progress_file or os.path.join(store_directory, INGEST_PROGRESS_FILE))
+    if restart:
+        progress.reset()
+    stats = {"files": 0, "indexed": 0, "unchanged": 0, "resumed": 0, "empty": 0, "failed": 0}
+
+    batch: List[Tuple[str, List[str], str]] = []
+    batch_vectors: List[np.ndarray] = []
+    entries: List[Dict[str, Any]] = []
+    signatures: Dict[str, List[int]] = {}
+
+    def commit() -> None:
+        # Vectors from another embedder (e.g. a model missing in the workers) are recomputed
+        usable = len(batch_vectors) == len(batch)
+        changed = vector_store.add_chunked_documents(batch, batch_vectors if usable else None)
+        stats["indexed"] += changed
+        stats["unchanged"] += len(batch) - changed
+        progress.record(entries)
+        if verbose:
+            print(f"Committed {len(entries)} files: {stats['indexed']} indexed, "
+                  f"{stats['unchanged']} unchanged, {stats['failed']} failed so far")
+        batch.clear()
+        batch_vectors.clear()
+        entries.clear()
+
+    def collect(future) -> None:
+        result = future.result()
+        file_path = result["path"]
+        chunks = result.get("chunks")
+        signature = signatures.pop(file_path)
+        if "error" in result:
+            print(f"Error processing file {file_path}: {result['error']}")
+            stats["failed"] += 1
+            entries.append({"path": file_path, "signature": signature, "status": "failed"})
+        elif not chunks:
+            stats["empty"] += 1
+            entries.append({"path": file_path, "signature": signature, "status": "empty"})
+        else:
+            batch.append((file_path, chunks, result["content_hash"]))
+            if result["embedder"] == vector_store.embedder.name:
+                batch_vectors.append(result["vectors"])
+            entries.append({"path": file_path, "signature": signature, "status": "indexed"})
+        if len(entries) >= batch_size:
+            commit()
+
+    # Spawned rather than forked, as the store may already run threads
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = set()
+        for file_path in iter_documents(directory):
+            stats["files"] += 1
+            try:
+                signature = _file_signature(file_path)
+            except OSError as e:
+                print(f"Error reading file {file_path}: {e}")
+                stats["failed"] += 1
+                continue
+            if progress.is_done(file_path, signature):
+                stats["resumed"] += 1
+                continue
+            signatures[file_path] = signature
+            pending.add(pool.submit(_prepare_document, file_path))
+            # Bound the queue so chunks of finished files don't pile up
+            if len(pending) >= workers * INGEST_QUEUE_PER_WORKER:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+        for future in pending:
+            collect(future)
+    commit()
+
+    if compact and stats["indexed"]:
+        vector_store.compact()
+    stats["seconds"] = time.monotonic() - started
+    return stats
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Command line entry point: python -m utils.ingest DIRECTORY [options]."""
+    parser = argparse.ArgumentParser(description="Index every PDF, DOCX and TXT file under a directory.")
+    parser.add_argument("directory", help="Directory tree to ingest")
+    parser.add_argument("--store", default="simple_vector_store", help="Vector store directory")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="Documents per commit")
+    parser.add_argument("--progress", default=None, help="Progress file (default: in the store directory)")
+    parser.add_argument("--restart", action="store_true", help="Ignore progress from earlier runs")
+    parser.add_argument("--no-compact", action="store_true", help="Skip compacting the index at the end")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.directory):
+        print(f"Not a directory: {args.directory}")
+        return 1
+    stats = ingest_directory(args.directory, store_directory=args.store, workers=args.workers,
+                             batch_size=args.batch_size, progress_file=args.progress,
+                             restart=args.restart, compact=not args.no_compact, verbose=True)
+    print(f"{stats['files']} files in {stats['seconds']:.1f}s: {stats['indexed']} indexed, "
+          f"{stats['unchanged']} unchanged, {stats['resumed']} already done, "
+          f"{stats['empty']} without text, {stats['failed']} failed")
+    return 1 if stats["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Any, Dict, List, Optional
+from utils.vector_store import chunk_document, get_vector_store, iter_text_from_file, remove_from_index
+
+# SQLite file holding the ingestion job queue
+JOBS_DB_PATH = os.environ.get("RAG_JOBS_DB", "jobs.sqlite3")
+
+# Finished jobs kept for the admin panel; older ones are deleted
+JOBS_HISTORY = 200
+
+# Seconds the worker sleeps when the queue is empty and nothing wakes it
+JOBS_POLL_INTERVAL = 2.0
+
+# Job kinds, and the statuses a job moves through
+JOB_KINDS = ("upload", "reindex", "delete")
+JOB_STATUSES = ("queued", "extracting", "indexing", "removing", "done", "failed")
+ACTIVE_STATUSES = ("extracting", "indexing", "removing")
+
+# A file queued for deletion is renamed with this prefix and its job id
+# right away, so a file uploaded later under the same name is left alone
+DELETED_PREFIX = ".deleted-"
+
+def deleted_path(path: str, job_id: int) -> str:
+    """Where a delete job moves the file it deletes until the job runs."""
+    directory, name = os.path.split(path)
+    return os.path.join(directory, f"{DELETED_PREFIX}{job_id}-{name}")
+
+def _restore_deleted(path: str, job_id: int) -> None:
+    """Give a file moved aside by a delete job back its name, unless a newer upload took it."""
+    moved = deleted_path(path, job_id)
+    try:
+        if os.path.exists(path):
+            # The newer upload replaces it in the index too
+            os.remove(moved)
+        else:
+            os.replace(moved, path)
+    except FileNotFoundError:
+        pass
+
+def _process_alive(pid: Optional[int]) -> bool:
+    """Whether a process with this id exists on this host."""
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobQueue:
+    """
+    Persistent queue of document ingestion jobs in a SQLite file.
+
+    A single worker thread per process runs jobs one at a time, oldest
+    first, so index writes from the app never run concurrently and a long
+    upload never blocks a Streamlit rerun. Jobs are claimed with an atomic
+    status update, so several app processes on one host can share a queue
+    file. Jobs left running by a process that has since died are queued
+    again when the queue is opened. Queue errors are reported and never
+    raised into the UI.
+    """
+    def __init__(self, path: str = JOBS_DB_PATH, history: int = JOBS_HISTORY):
+        self.path = path
+        self.history = history
+        self._wakeup = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._worker_lock = threading.Lock()
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS jobs (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        kind TEXT NOT NULL,
+                        path TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        message TEXT NOT NULL DEFAULT '',
+                        owner INTEGER,
+                        created_at REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+                running = conn.execute(
+                    f"SELECT id, owner FROM jobs WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                    ACTIVE_STATUSES).fetchall()
+                orphaned = [(time.time(), job_id) for job_id, owner in running if not _process_alive(owner)]
+                conn.executemany("UPDATE jobs SET status = 'queued', owner = NULL, updated_at = ? WHERE id = ?",
+                                 orphaned)
+                # Release deletes held by a submitter that died before moving their file aside
+                held = conn.execute("SELECT id, owner FROM jobs WHERE status = 'queued' AND owner IS NOT NULL").fetchall()
+                conn.executemany("UPDATE jobs SET owner = NULL, updated_at = ? WHERE id = ?",
+                                 [(time.time(), job_id) for job_id, owner in held if not _process_alive(owner)])
+        except sqlite3.Error as e:
+            print(f"Error initializing job queue: {e}")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    def submit(self, kind: str, path: str) -> Optional[int]:
+        """
+        Queue a job, or return the identical job queued last for the same path.
+
+        A delete moves the file aside once the job is committed; the job
+        later removes it from the index and disk, or gives it its name back
+        if that fails. Until the file is moved the job is held by setting
+        its owner, so the worker doesn't run it early.
+
+        Args:
+            kind: "upload", "reindex" or "delete"
+            path: Path of the document the job applies to
+
+        Returns:
+            The job id, or None if the job could not be queued
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind: {kind}")
+        now = time.time()
+        try:
+            with closing(self._connect()) as conn, conn:
+                # Merging with an older job across a different one for the
+                # same path would reorder them, e.g. upload, delete, upload
+                row = conn.execute("SELECT id, kind, status FROM jobs WHERE path = ? ORDER BY id DESC LIMIT 1",
+                                   (path,)).fetchone()
+                if row is not None and row[1] == kind and row[2] == "queued":
+                    return row[0]
+                job_id = conn.execute(
+                    "INSERT INTO jobs (kind, path, status, owner, created_at, updated_at) "
+                    "VALUES (?, ?, 'queued', ?, ?, ?)",
+                    (kind, path, os.getpid() if kind == "delete" else None, now, now)).lastrowid
+        except sqlite3.Error as e:
+            print(f"Error queuing job: {e}")
+            return None
+        if kind == "delete" and not self._move_aside(job_id, path):
+            return None
+        self.start_worker()
+        self._wakeup.set()
+        return job_id
+
+    def _move_aside(self, job_id: int, path: str) -> bool:
+        """Move a committed delete job's file aside, then release the job to the worker."""
+        try:
+            os.replace(path, deleted_path(path, job_id))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error queuing job: {e}")
+            self._set_status(job_id, "failed", f"Could not move {os.path.basename(path)} aside: {e}")
+            return False
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("UPDATE jobs SET owner = NULL, updated_at = ? WHERE id = ?", (time.time(), job_id))
+        except sqlite3.Error as e:
+            print(f"Error queuing job: {e}")
+            _restore_deleted(path, job_id)
+            self._set_status(job_id, "failed", str(e))
+            return False
+        return True
+
+    def _claim(self) -> Optional[Dict[str, Any]]:
+        """Take the oldest queued job whose path no other job is working on, marking it as started."""
+        with closing(self._connect()) as conn, conn:
+            while True:
+                row = conn.execute(
+                    "SELECT id, kind, path FROM jobs WHERE status = 'queued' AND owner IS NULL AND NOT EXISTS "
+                    "(SELECT 1 FROM jobs AS running WHERE running.path = jobs.path "
+                    f"AND running.status IN ({', '.join('?' * len(ACTIVE_STATUSES))})) "
+                    "ORDER BY id LIMIT 1", ACTIVE_STATUSES).fetchone()
+                if row is None:
+                    return None
+                job_id, kind, path = row
+                status = "removing" if kind == "delete" else "extracting"
+                # Another process may have claimed the job in the meantime
+                claimed = conn.execute(
+                    "UPDATE jobs SET status = ?, owner = ?, updated_at = ? "
+                    "WHERE id = ? AND status = 'queued' AND owner IS NULL",
+                    (status, os.getpid(), time.time(), job_id)).rowcount
+                if claimed:
+                    return {"id": job_id, "kind": kind, "path": path}
+
+    def _set_status(self, job_id: int, status: str, message: str = "") -> None:
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("UPDATE jobs SET status = ?, message = ?, updated_at = ? WHERE id = ?",
+                             (status, message, time.time(), job_id))
+                if status in ("done", "failed"):
+                    conn.execute(
+                        "DELETE FROM jobs WHERE status IN ('done', 'failed') AND id NOT IN "
+                        "(SELECT id FROM jobs WHERE status IN ('done', 'failed') ORDER BY id DESC LIMIT ?)",
+                        (self.history,))
+        except sqlite3.Error as e:
+            print(f"Error updating job {job_id}: {e}")
+
+    def jobs(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Most recent jobs, newest first, as dicts with id, kind, path, status, message and times."""
+        try:
+            with closing(self._connect()) as conn:
+                rows = conn.execute("SELECT id, kind, path, status, message, created_at, updated_at "
+                                    "FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error reading job queue: {e}")
+            return []
+        return [dict(zip(("id", "kind", "path", "status", "message", "created_at", "updated_at"), row))
+                for row in rows]
+
+    def pending_count(self) -> int:
+        """Number of jobs queued or running."""
+        try:
+            with closing(self._connect()) as conn:
+                (count,) = conn.execute("SELECT COUNT(*) FROM jobs WHERE status NOT IN ('done', 'failed')").fetchone()
+        except sqlite3.Error as e:
+            print(f"Error reading job queue: {e}")
+            return 0
+        return count
+
+    def start_worker(self) -> None:
+        """Start this process's worker thread if it isn't running."""
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="ingest-jobs", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"Error reading job queue: {e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(JOBS_POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            try:
+                message = self._execute(job)
+                self._set_status(job["id"], "done", message)
+            except Exception as e:
+                self._set_status(job["id"], "failed", str(e))
+
+    def _execute(self, job: Dict[str, Any]) -> str:
+        """Run one claimed job, returning a message for the admin panel."""
+        path = job["path"]
+        name = os.path.basename(path)
+        if job["kind"] == "delete":
+            try:
+                if not remove_from_index(path):
+                    raise RuntimeError(f"Could not remove {name} from the index")
+            except Exception:
+                # Still indexed: list it again, so it can be deleted again
+                _restore_deleted(path, job["id"])
+                raise
+            # The file was moved aside when the job was queued; whatever is
+            # at path now was uploaded after the delete
+            try:
+                os.remove(deleted_path(path, job["id"]))
+            except FileNotFoundError:
+                pass
+            return f"{name} deleted"
+
+        if not os.path.exists(path):
+            return f"{name} was deleted before it was indexed"
+        chunks, content_hash = chunk_document(iter_text_from_file(path))
+        if not chunks:
+            raise RuntimeError(f"No text could be extracted from {name}")
+        self._set_status(job["id"], "indexing")
+        if not get_vector_store().add_chunked_documents([(path, chunks, content_hash)]):
+            return f"{name} is unchanged"
+        return f"{name} indexed ({len(chunks)} chunks)"
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue() -> JobQueue:
+    """Return the process-wide job queue, opening it and starting its worker on first use."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+            _job_queue.start_worker()
+        return _job_queue
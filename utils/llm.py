@@ -1,14 +1,121 @@
 import streamlit as st
 import os
+from utils.llm_cache import get_response_cache
+from utils.llm_clients import get_llm_client
+from utils.llm_async import HEDGE_ENABLED, query_hedged, stream_hedged
 
-def query_model(prompt, model_choice, api_key):
+# Map display names to actual model identifiers
+OPENAI_MODELS = {
+    "OpenAI GPT-4o": "gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
+    "OpenAI GPT-4": "gpt-4",
+    "OpenAI GPT-3.5 Turbo": "gpt-3.5-turbo"
+}
+OPENAI_DEFAULT_MODEL = "gpt-4o"
+
+GEMINI_MODELS = {
+    "Google Gemini Pro": "gemini-pro",
+    "Google Gemini Flash": "gemini-flash",
+    "Google Gemini 1.0 Pro Vision": "gemini-1.0-pro-vision",
+    "Google Gemini 1.5 Pro": "gemini-1.5-pro",
+    "Google Gemini 1.5 Flash": "gemini-1.5-flash",
+    "Google Gemini 1.5 Pro Latest": "gemini-1.5-pro-latest",
+    "Google Gemini 1.5 Flash Latest": "gemini-1.5-flash-latest",
+    "Google Gemini 2.0 Pro Vision": "gemini-2.0-pro-vision",
+    "Google Gemini 2.0 Pro": "gemini-2.0-pro",
+    "Google Gemini 2.5 Pro": "gemini-2.5-pro",
+    "Google Gemini 2.5 Flash": "gemini-2.5-flash"
+}
+GEMINI_DEFAULT_MODEL = "gemini-pro"
+
+CLAUDE_MODELS = {
+    "Claude 3.5 Sonnet": "claude-3-5-sonnet-20241022",  # the newest Anthropic model is "claude-3-5-sonnet-20241022" which was released October 22, 2024
+    "Claude 3 Opus": "claude-3-opus-20240229",
+    "Claude 3 Sonnet": "claude-3-sonnet-20240229",
+    "Claude 3 Haiku": "claude-3-haiku-20240307"
+}
+CLAUDE_DEFAULT_MODEL = "claude-3-5-sonnet-20241022"
+
+# Context window of each model id, in tokens
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "gemini-pro": 32760,
+    "gemini-flash": 32760,
+    "gemini-1.0-pro-vision": 16384,
+    "gemini-1.5-pro": 2097152,
+    "gemini-1.5-flash": 1048576,
+    "gemini-1.5-pro-latest": 2097152,
+    "gemini-1.5-flash-latest": 1048576,
+    "gemini-2.0-pro-vision": 1048576,
+    "gemini-2.0-pro": 2097152,
+    "gemini-2.5-pro": 1048576,
+    "gemini-2.5-flash": 1048576,
+    "claude-3-5-sonnet-20241022": 200000,
+    "claude-3-opus-20240229": 200000,
+    "claude-3-sonnet-20240229": 200000,
+    "claude-3-haiku-20240307": 200000
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Tokens left free in the context window for the model's answer
+RESPONSE_TOKEN_RESERVE = 1024
+
+# Provider -> (display name mapping, default model id, sampling temperature);
+# None means the provider's default temperature
+PROVIDERS = {
+    "OpenAI GPT": (OPENAI_MODELS, OPENAI_DEFAULT_MODEL, 0.3),
+    "Google Gemini": (GEMINI_MODELS, GEMINI_DEFAULT_MODEL, None),
+    "Claude": (CLAUDE_MODELS, CLAUDE_DEFAULT_MODEL, None),
+}
+
+# Second model raced against the selected one once the request deadline
+# passes, as "<provider>|<display name>", e.g. "Claude|Claude 3 Haiku".
+# Its API key defaults to the user's, which only works for the same provider.
+LLM_FALLBACK_MODEL = os.environ.get("RAG_LLM_FALLBACK", "")
+LLM_FALLBACK_API_KEY = os.environ.get("RAG_LLM_FALLBACK_API_KEY", "")
+
+# Prefixes of the messages returned instead of an answer when a call fails;
+# these are never cached
+ERROR_RESPONSE_PREFIXES = ("Error ", "No response generated", "Could not extract text")
+
+def resolve_model_id(model_choice, specific_model):
+    """Return the provider model identifier for a display name."""
+    models, default_model, _ = PROVIDERS[model_choice]
+    return models.get(specific_model, default_model)
+
+def context_window(model_choice, specific_model):
+    """Context window, in tokens, of the model selected by display name."""
+    if model_choice not in PROVIDERS:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS.get(resolve_model_id(model_choice, specific_model), DEFAULT_CONTEXT_WINDOW)
+
+def _fallback_target(api_key):
+    """(provider, model id, API key, temperature) of the configured fallback model, or None."""
+    if not LLM_FALLBACK_MODEL:
+        return None
+    provider, _, specific_model = LLM_FALLBACK_MODEL.partition("|")
+    if provider not in PROVIDERS:
+        print(f"Unknown fallback provider: {provider}")
+        return None
+    return (provider, resolve_model_id(provider, specific_model),
+            LLM_FALLBACK_API_KEY or api_key, PROVIDERS[provider][2])
+
+def query_model(prompt, model_choice, api_key, question=None, context=None):
     """
     Query the selected AI model with the given prompt.
     
+    Responses are served from the persistent response cache when the same
+    prompt was already answered by the same model. Otherwise the request is
+    hedged and raced against the fallback model, if either is enabled.
+    
     Args:
         prompt: The prompt to send to the AI
         model_choice: Which AI model to use
         api_key: API key for the selected model
+        question: Optional user question the prompt was built for
+        context: Optional retrieved context the prompt was built from; with
+            question, lets near-identical questions share a cached answer
         
     Returns:
         Response text from the AI model
@@ -18,37 +125,110 @@ def query_model(prompt, model_choice, api_key):
         return "Please provide a valid API key in the sidebar to use this model."
     
     try:
+        if model_choice not in PROVIDERS:
+            return "Unknown model selected."
+        
         # Get the specific model name from session state
         specific_model = st.session_state.get("specific_model", "")
+        model_id = resolve_model_id(model_choice, specific_model)
+        temperature = PROVIDERS[model_choice][2]
         
-        if model_choice == "OpenAI GPT":
-            return query_openai(prompt, api_key, specific_model)
+        cache = get_response_cache()
+        cached = cache.get(model_choice, model_id, temperature, prompt, question, context)
+        if cached is not None:
+            return cached
+        
+        fallback = _fallback_target(api_key)
+        if HEDGE_ENABLED or fallback is not None:
+            # Cached under the model that answered, which may be the fallback
+            response, (model_choice, model_id, _, temperature) = query_hedged(
+                prompt, (model_choice, model_id, api_key, temperature), fallback)
+        elif model_choice == "OpenAI GPT":
+            response = query_openai(prompt, api_key, specific_model)
         elif model_choice == "Google Gemini":
-            return query_gemini(prompt, api_key, specific_model)
-        elif model_choice == "Claude":
-            return query_claude(prompt, api_key, specific_model)
+            response = query_gemini(prompt, api_key, specific_model)
         else:
-            return "Unknown model selected."
+            response = query_claude(prompt, api_key, specific_model)
+        
+        if response and not response.startswith(ERROR_RESPONSE_PREFIXES):
+            cache.put(model_choice, model_id, temperature, prompt, response, question, context)
+        return response
     except Exception as e:
         return f"Error querying {model_choice}: {str(e)}"
 
-def query_openai(prompt, api_key, specific_model="OpenAI GPT-4o"):
-    """Query OpenAI's GPT model."""
+def stream_model(prompt, model_choice, api_key, question=None, context=None):
+    """
+    Stream the selected AI model's answer to the given prompt.
+    
+    Yields text deltas as the provider produces them, so the first words can
+    be shown before the answer is complete. A cached answer is yielded in one
+    piece, and a completed answer is added to the cache. With hedging or a
+    fallback model, attempts race until one produces text, as in query_model.
+    
+    Args:
+        prompt: The prompt to send to the AI
+        model_choice: Which AI model to use
+        api_key: API key for the selected model
+        question: Optional user question the prompt was built for
+        context: Optional retrieved context the prompt was built from
+        
+    Yields:
+        Successive pieces of the response text
+    """
+    # First check if API key is provided
+    if not api_key:
+        yield "Please provide a valid API key in the sidebar to use this model."
+        return
+    if model_choice not in PROVIDERS:
+        yield "Unknown model selected."
+        return
+    
     try:
-        from openai import OpenAI
+        # Get the specific model name from session state
+        specific_model = st.session_state.get("specific_model", "")
+        model_id = resolve_model_id(model_choice, specific_model)
+        temperature = PROVIDERS[model_choice][2]
+        
+        cache = get_response_cache()
+        cached = cache.get(model_choice, model_id, temperature, prompt, question, context)
+        if cached is not None:
+            yield cached
+            return
         
-        # Map display names to actual model identifiers
-        model_mapping = {
-            "OpenAI GPT-4o": "gpt-4o",  # the newest OpenAI model is "gpt-4o" which was released May 13, 2024. do not change this unless explicitly requested by the user
-            "OpenAI GPT-4": "gpt-4",
-            "OpenAI GPT-3.5 Turbo": "gpt-3.5-turbo"
-        }
+        fallback = _fallback_target(api_key)
+        if HEDGE_ENABLED or fallback is not None:
+            # Cached under the model that answered, which may be the fallback
+            (model_choice, model_id, _, temperature), deltas = stream_hedged(
+                prompt, (model_choice, model_id, api_key, temperature), fallback)
+        elif model_choice == "OpenAI GPT":
+            deltas = stream_openai(prompt, api_key, specific_model)
+        elif model_choice == "Google Gemini":
+            deltas = stream_gemini(prompt, api_key, specific_model)
+        else:
+            deltas = stream_claude(prompt, api_key, specific_model)
         
+        parts = []
+        for delta in deltas:
+            parts.append(delta)
+            yield delta
+    except Exception as e:
+        yield f"Error querying {model_choice}: {str(e)}"
+        return
+    
+    response = "".join(parts)
+    if response:
+        cache.put(model_choice, model_id, temperature, prompt, response, question, context)
+    else:
+        yield "No response generated from the model."
+
+def query_openai(prompt, api_key, specific_model="OpenAI GPT-4o"):
+    """Query OpenAI's GPT model."""
+    try:
         # Get the actual model identifier to use
-        model_id = model_mapping.get(specific_model, "gpt-4o")
+        model_id = OPENAI_MODELS.get(specific_model, OPENAI_DEFAULT_MODEL)
         
-        # Initialize the client
-        client = OpenAI(api_key=api_key)
+        # Reuse the pooled client for this API key
+        client = get_llm_client("OpenAI GPT", api_key)
         
         # Create the completion
         response = client.chat.completions.create(
@@ -70,30 +250,25 @@ def query_openai(prompt, api_key, specific_model="OpenAI GPT-4o"):
     except Exception as e:
         return f"Error with OpenAI API: {str(e)}"
 
-def query_gemini(prompt, api_key, specific_model="Google Gemini Pro"):
-    """Query Google's Gemini model."""
+def _gemini_model(genai, api_key, model_id):
+    """Create a Gemini model instance that calls the API with the given key."""
+    # Create a model instance - handle different parameter naming
     try:
-        import google.generativeai as genai
-        import os
-        
-        # Map display names to actual model identifiers
-        model_mapping = {
-            "Google Gemini Pro": "gemini-pro",
-            "Google Gemini Flash": "gemini-flash",
-            "Google Gemini 1.0 Pro Vision": "gemini-1.0-pro-vision",
-            "Google Gemini 1.5 Pro": "gemini-1.5-pro",
-            "Google Gemini 1.5 Flash": "gemini-1.5-flash",
-            "Google Gemini 1.5 Pro Latest": "gemini-1.5-pro-latest",
-            "Google Gemini 1.5 Flash Latest": "gemini-1.5-flash-latest",
-            "Google Gemini 2.0 Pro Vision": "gemini-2.0-pro-vision",
-            "Google Gemini 2.0 Pro": "gemini-2.0-pro",
-            "Google Gemini 2.5 Pro": "gemini-2.5-pro",
-            "Google Gemini 2.5 Flash": "gemini-2.5-flash"
-        }
-        
-        # Get the actual model identifier to use
-        model_id = model_mapping.get(specific_model, "gemini-pro")
-        
+        # Try the first method with model_name parameter
+        model = genai.GenerativeModel(model_name=model_id)
+    except:
+        try:
+            # Try alternative method with model parameter
+            model = genai.GenerativeModel(model=model_id)
+        except:
+            # Final fallback using positional argument
+            model = genai.GenerativeModel(model_id)
+    
+    try:
+        # Use the pooled client for this key rather than genai.configure,
+        # which sets one key for every session in the process
+        model._client = get_llm_client("Google Gemini", api_key)
+    except ImportError:
         # Try different API configuration methods to handle different versions
         try:
             # Method 1: Newer versions use configure
@@ -108,18 +283,18 @@ def query_gemini(prompt, api_key, specific_model="Google Gemini Pro"):
         except Exception as config_error:
             # Final fallback for environment variable
             os.environ["GOOGLE_API_KEY"] = api_key
+    
+    return model
+
+def query_gemini(prompt, api_key, specific_model="Google Gemini Pro"):
+    """Query Google's Gemini model."""
+    try:
+        import google.generativeai as genai
         
-        # Create a model instance - handle different parameter naming
-        try:
-            # Try the first method with model_name parameter
-            model = genai.GenerativeModel(model_name=model_id)
-        except:
-            try:
-                # Try alternative method with model parameter
-                model = genai.GenerativeModel(model=model_id)
-            except:
-                # Final fallback using positional argument
-                model = genai.GenerativeModel(model_id)
+        # Get the actual model identifier to use
+        model_id = GEMINI_MODELS.get(specific_model, GEMINI_DEFAULT_MODEL)
+        
+        model = _gemini_model(genai, api_key, model_id)
         
         # Generate content with safety settings for better compatability
         try:
@@ -173,22 +348,13 @@ def query_gemini(prompt, api_key, specific_model="Google Gemini Pro"):
 def query_claude(prompt, api_key, specific_model="Claude 3.5 Sonnet"):
     """Query Anthropic's Claude model."""
     try:
-        import anthropic
         import json
         
-        # Map display names to actual model identifiers
-        model_mapping = {
-            "Claude 3.5 Sonnet": "claude-3-5-sonnet-20241022",  # the newest Anthropic model is "claude-3-5-sonnet-20241022" which was released October 22, 2024
-            "Claude 3 Opus": "claude-3-opus-20240229",
-            "Claude 3 Sonnet": "claude-3-sonnet-20240229",
-            "Claude 3 Haiku": "claude-3-haiku-20240307"
-        }
-        
         # Get the actual model identifier to use
-        model_id = model_mapping.get(specific_model, "claude-3-5-sonnet-20241022")
+        model_id = CLAUDE_MODELS.get(specific_model, CLAUDE_DEFAULT_MODEL)
         
-        # Initialize the client
-        client = anthropic.Anthropic(api_key=api_key)
+        # Reuse the pooled client for this API key
+        client = get_llm_client("Claude", api_key)
         
         # Create the message with safe parameter handling
         try:
@@ -266,3 +432,51 @@ def query_claude(prompt, api_key, specific_model="Claude 3.5 Sonnet"):
     
     except Exception as e:
         return f"Error with Claude API: {str(e)}"
+
+def stream_openai(prompt, api_key, specific_model="OpenAI GPT-4o"):
+    """Stream text deltas from OpenAI's GPT model. Raises on API errors."""
+    model_id = OPENAI_MODELS.get(specific_model, OPENAI_DEFAULT_MODEL)
+    client = get_llm_client("OpenAI GPT", api_key)
+    stream = client.chat.completions.create(
+        model=model_id,
+        messages=[
+            {"role": "system", "content": "You are a helpful company assistant that provides factual information based on company documents."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.3,
+        max_tokens=1000,
+        stream=True
+    )
+    for chunk in stream:
+        # The final chunk carries the finish reason and no content
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def stream_gemini(prompt, api_key, specific_model="Google Gemini Pro"):
+    """Stream text deltas from Google's Gemini model. Raises on API errors."""
+    import google.generativeai as genai
+    
+    model_id = GEMINI_MODELS.get(specific_model, GEMINI_DEFAULT_MODEL)
+    model = _gemini_model(genai, api_key, model_id)
+    for chunk in model.generate_content(prompt, stream=True):
+        # Chunks without text parts (e.g. safety metadata) raise on .text
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            yield text
+
+def stream_claude(prompt, api_key, specific_model="Claude 3.5 Sonnet"):
+    """Stream text deltas from Anthropic's Claude model. Raises on API errors."""
+    model_id = CLAUDE_MODELS.get(specific_model, CLAUDE_DEFAULT_MODEL)
+    client = get_llm_client("Claude", api_key)
+    with client.messages.stream(
+        model=model_id,
+        max_tokens=1024,
+        messages=[
+            {"role": "user", "content": prompt}
+        ]
+    ) as stream:
+        for text in stream.text_stream:
+            yield text
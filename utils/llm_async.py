@@ -0,0 +1,456 @@
+import os
+import math
+import time
+import queue
+import asyncio
+import threading
+import concurrent.futures
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+from utils.llm_clients import ClientRegistry
+
+# Fire a duplicate of a slow request after the hedge delay. Off unless
+# enabled, as every hedge that fires is a second paid request
+HEDGE_ENABLED = os.environ.get("RAG_LLM_HEDGE", "0") == "1"
+
+# The hedge delay is this quantile of the model's observed latency, clamped
+# to [HEDGE_MIN_DELAY, HEDGE_MAX_DELAY]; HEDGE_DEFAULT_DELAY is used until
+# HEDGE_MIN_SAMPLES latencies have been recorded
+HEDGE_QUANTILE = 0.95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 8.0
+HEDGE_MIN_DELAY = 1.0
+HEDGE_MAX_DELAY = 30.0
+
+# Seconds after which the fallback model, if configured, is raced against
+# the primary one, and the overall limit for a hedged query
+LLM_DEADLINE = float(os.environ.get("RAG_LLM_DEADLINE", "20"))
+LLM_TIMEOUT = 120.0
+
+SYSTEM_PROMPT = "You are a helpful company assistant that provides factual information based on company documents."
+
+# Latency histogram buckets: upper bounds growing 25% per bucket from 50ms
+LATENCY_BUCKETS = [0.05 * 1.25 ** i for i in range(40)]
+
+class LatencyHistogram:
+    """Thread-safe histogram of request latencies with fixed log-spaced buckets."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        """Record one latency."""
+        if seconds <= LATENCY_BUCKETS[0]:
+            bucket = 0
+        else:
+            bucket = min(len(LATENCY_BUCKETS), math.ceil(math.log(seconds / 0.05, 1.25)))
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-quantile, or None if empty."""
+        with self._lock:
+            if not self.count:
+                return None
+            target = q * self.count
+            seen = 0
+            for bucket, count in enumerate(self.counts):
+                seen += count
+                if seen >= target:
+                    return LATENCY_BUCKETS[min(bucket, len(LATENCY_BUCKETS) - 1)]
+        return LATENCY_BUCKETS[-1]
+
+# Latencies measured per model: until the complete answer ("response"), and
+# until the first streamed text ("first_delta"), which streaming hedges on
+LATENCY_METRICS = ("response", "first_delta")
+
+# (provider, model id, metric) -> latency histogram
+_histograms: Dict[Tuple[str, str, str], LatencyHistogram] = {}
+_histograms_lock = threading.Lock()
+
+def get_latency_histogram(provider: str, model_id: str, metric: str = "response") -> LatencyHistogram:
+    """Return the histogram of one latency metric of a provider model, creating it on first use."""
+    with _histograms_lock:
+        return _histograms.setdefault((provider, model_id, metric), LatencyHistogram())
+
+def latency_stats() -> Dict[str, Dict[str, Any]]:
+    """Sample counts and p50/p95/p99 latencies per provider model and metric, for monitoring."""
+    with _histograms_lock:
+        histograms = dict(_histograms)
+    return {
+        f"{provider}/{model_id}/{metric}": {
+            "count": histogram.count,
+            "p50": histogram.quantile(0.5),
+            "p95": histogram.quantile(0.95),
+            "p99": histogram.quantile(0.99),
+        }
+        for (provider, model_id, metric), histogram in histograms.items()
+    }
+
+def hedge_delay(provider: str, model_id: str, metric: str = "response") -> float:
+    """Seconds to wait for a model, by the given latency metric, before firing a hedged duplicate request."""
+    histogram = get_latency_histogram(provider, model_id, metric)
+    if histogram.count < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, histogram.quantile(HEDGE_QUANTILE)))
+
+# Async clients are bound to the event loop they were created on, so every
+# async request runs on one long-lived loop in a background thread
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+def _event_loop() -> asyncio.AbstractEventLoop:
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="llm-async", daemon=True).start()
+        return _loop
+
+def _openai_async_client(api_key: str):
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=api_key)
+
+def _anthropic_async_client(api_key: str):
+    import anthropic
+    return anthropic.AsyncAnthropic(api_key=api_key)
+
+def _gemini_async_client(api_key: str):
+    from google.ai import generativelanguage as glm
+    return glm.GenerativeServiceAsyncClient(client_options={"api_key": api_key})
+
+def _close_async_client(client: Any) -> None:
+    """Close an async client on the event loop it belongs to."""
+    try:
+        closing = client.close() if hasattr(client, "close") else client.transport.close()
+        asyncio.run_coroutine_threadsafe(closing, _event_loop())
+    except Exception as e:
+        print(f"Error closing LLM client: {e}")
+
+_async_clients = ClientRegistry(factories={
+    "OpenAI GPT": _openai_async_client,
+    "Google Gemini": _gemini_async_client,
+    "Claude": _anthropic_async_client,
+}, close=_close_async_client)
+
+async def _openai_call(api_key: str, model_id: str, prompt: str, temperature: Optional[float]) -> str:
+    client = _async_clients.get("OpenAI GPT", api_key)
+    options = {} if temperature is None else {"temperature": temperature}
+    response = await client.chat.completions.create(
+        model=model_id,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=1000,
+        **options
+    )
+    if not response.choices or not response.choices[0].message.content:
+        raise RuntimeError("No response generated from the model.")
+    return response.choices[0].message.content
+
+async def _gemini_call(api_key: str, model_id: str, prompt: str, temperature: Optional[float]) -> str:
+    import google.generativeai as genai
+
+    model = genai.GenerativeModel(model_name=model_id)
+    model._async_client = _async_clients.get("Google Gemini", api_key)
+    config = {} if temperature is None else {"generation_config": {"temperature": temperature}}
+    response = await model.generate_content_async(prompt, **config)
+    return response.text
+
+async def _claude_call(api_key: str, model_id: str, prompt: str, temperature: Optional[float]) -> str:
+    client = _async_clients.get("Claude", api_key)
+    options = {} if temperature is None else {"temperature": temperature}
+    message = await client.messages.create(
+        model=model_id,
+        max_tokens=1024,
+        messages=[
+            {"role": "user", "content": prompt}
+        ],
+        **options
+    )
+    text = "".join(block.text for block in message.content if getattr(block, "type", None) == "text")
+    if not text:
+        raise RuntimeError("No response generated from the model.")
+    return text
+
+# Provider -> coroutine function returning the answer text, raising on failure
+ASYNC_CALLS = {
+    "OpenAI GPT": _openai_call,
+    "Google Gemini": _gemini_call,
+    "Claude": _claude_call,
+}
+
+async def _openai_stream(api_key: str, model_id: str, prompt: str, temperature: Optional[float]) -> AsyncIterator[str]:
+    client = _async_clients.get("OpenAI GPT", api_key)
+    options = {} if temperature is None else {"temperature": temperature}
+    stream = await client.chat.completions.create(
+        model=model_id,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=1000,
+        stream=True,
+        **options
+    )
+    try:
+        async for chunk in stream:
+            # The final chunk carries the finish reason and no content
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        await stream.close()
+
+async def _gemini_stream(api_key: str, model_id: str, prompt: str, temperature: Optional[float]) -> AsyncIterator[str]:
+    import google.generativeai as genai
+
+    model = genai.GenerativeModel(model_name=model_id)
+    model._async_client = _async_clients.get("Google Gemini", api_key)
+    config = {} if temperature is None else {"generation_config": {"temperature": temperature}}
+    response = await model.generate_content_async(prompt, stream=True, **config)
+    async for chunk in response:
+        # Chunks without text parts (e.g. safety metadata) raise on .text
+        try:
+            text = chunk.text
+        except ValueError:
+            continue
+        if text:
+            yield text
+
+async def _claude_stream(api_key: str, model_id: str, prompt: str, temperature: Optional[float]) -> AsyncIterator[str]:
+    client = _async_clients.get("Claude", api_key)
+    options = {} if temperature is None else {"temperature": temperature}
+    async with client.messages.stream(
+        model=model_id,
+        max_tokens=1024,
+        messages=[
+            {"role": "user", "content": prompt}
+        ],
+        **options
+    ) as stream:
+        async for text in stream.text_stream:
+            yield text
+
+# Provider -> async generator function yielding answer text deltas, raising on failure
+ASYNC_STREAMS = {
+    "OpenAI GPT": _openai_stream,
+    "Google Gemini": _gemini_stream,
+    "Claude": _claude_stream,
+}
+
+async def _wait_to_start(delay: float, start_now: asyncio.Event) -> None:
+    """Wait for an attempt's start time (or an early start), then mark it as started."""
+    if delay > 0:
+        try:
+            await asyncio.wait_for(start_now.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+    start_now.set()
+
+async def _attempt(target: Tuple[str, str, str, Optional[float]], prompt: str,
+                   delay: float, start_now: asyncio.Event) -> str:
+    """Wait for the attempt's start time (or an early start), then query the model."""
+    await _wait_to_start(delay, start_now)
+    provider, model_id, api_key, temperature = target
+    return await ASYNC_CALLS[provider](api_key, model_id, prompt, temperature)
+
+async def _stream_attempt(target: Tuple[str, str, str, Optional[float]], prompt: str,
+                          delay: float, start_now: asyncio.Event) -> Tuple[str, AsyncIterator[str]]:
+    """
+    Wait for the attempt's start time (or an early start), then open a
+    stream and read up to its first text.
+
+    Returns:
+        (first delta, the stream positioned after it)
+    """
+    await _wait_to_start(delay, start_now)
+    provider, model_id, api_key, temperature = target
+    deltas = ASYNC_STREAMS[provider](api_key, model_id, prompt, temperature)
+    try:
+        async for delta in deltas:
+            return delta, deltas
+    except BaseException:
+        await deltas.aclose()
+        raise
+    raise RuntimeError("No response generated from the model.")
+
+async def _race(prompt: str, attempts: List[Tuple[Tuple[str, str, str, Optional[float]], float]],
+                attempt: Callable = _attempt, discard: Optional[Callable] = None,
+                metric: str = "response") -> Tuple[Tuple[str, str, str, Optional[float]], Any]:
+    """
+    Run staggered attempts, returning the first result and cancelling the rest.
+
+    The request's latency, from the first attempt's start until the winner's
+    result, is recorded for the first attempt's model under metric. Timing
+    the request rather than the winning attempt keeps the primary's slow
+    tail in its histogram when a hedge or the fallback beats it.
+
+    Args:
+        prompt: The prompt to send
+        attempts: (target, delay) of each attempt, by increasing delay
+        attempt: Coroutine function run per attempt, like _attempt
+        discard: Optional coroutine function releasing the result of an
+            attempt that finished together with the winner
+        metric: Latency metric the request's time is recorded as
+
+    Returns:
+        (target of the winning attempt, its result)
+    """
+    started = time.monotonic()
+    start_events = [asyncio.Event() for _ in attempts]
+    tasks = [asyncio.ensure_future(attempt(target, prompt, delay, start_now))
+             for (target, delay), start_now in zip(attempts, start_events)]
+    pending = set(tasks)
+    first_error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            if winners:
+                provider, model_id = attempts[0][0][:2]
+                get_latency_histogram(provider, model_id, metric).observe(time.monotonic() - started)
+                if discard is not None:
+                    for task in winners[1:]:
+                        await discard(task.result())
+                return attempts[tasks.index(winners[0])][0], winners[0].result()
+            for task in done:
+                first_error = first_error or task.exception()
+            # A failed attempt starts the next one still waiting right away
+            for task, start_now in zip(tasks, start_events):
+                if task in pending and not start_now.is_set():
+                    start_now.set()
+                    break
+        raise first_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+def query_hedged(prompt: str, primary: Tuple[str, str, str, Optional[float]],
+                 fallback: Optional[Tuple[str, str, str, Optional[float]]] = None,
+                 hedge: bool = HEDGE_ENABLED,
+                 deadline: float = LLM_DEADLINE) -> Tuple[str, Tuple[str, str, str, Optional[float]]]:
+    """
+    Query a model with hedging and an optional fallback, blocking for the answer.
+
+    The primary request starts immediately. With hedge, a duplicate starts
+    once the primary has taken longer than the model's hedge delay; the
+    fallback model starts once the deadline has passed. The first answer
+    wins and the other requests are cancelled.
+
+    Args:
+        prompt: The prompt to send
+        primary: (provider, model id, API key, temperature) of the selected model
+        fallback: Optional (provider, model id, API key, temperature) of a second model
+        hedge: Whether to fire a hedged duplicate of the primary request
+        deadline: Seconds before the fallback model is started
+
+    Returns:
+        (answer text, target that produced it: primary or fallback)
+
+    Raises:
+        The first request's error if every request fails, or
+        concurrent.futures.TimeoutError
+    """
+    attempts = [(primary, 0.0)]
+    if hedge:
+        attempts.append((primary, hedge_delay(primary[0], primary[1])))
+    if fallback is not None:
+        attempts.append((fallback, deadline))
+    attempts.sort(key=lambda attempt: attempt[1])
+
+    future = asyncio.run_coroutine_threadsafe(_race(prompt, attempts), _event_loop())
+    try:
+        target, answer = future.result(LLM_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+        # The builtin TimeoutError only became this class in Python 3.11
+        future.cancel()
+        raise
+    return answer, target
+
+# Marks the end of a hedged stream in its delta queue
+_STREAM_END = object()
+
+def stream_hedged(prompt: str, primary: Tuple[str, str, str, Optional[float]],
+                  fallback: Optional[Tuple[str, str, str, Optional[float]]] = None,
+                  hedge: bool = HEDGE_ENABLED, deadline: float = LLM_DEADLINE
+                  ) -> Tuple[Tuple[str, str, str, Optional[float]], Iterator[str]]:
+    """
+    Stream a model's answer with hedging and an optional fallback.
+
+    Attempts start like in query_hedged, with the hedge delay taken from the
+    model's time to first text. The first attempt to produce text wins: the
+    others are cancelled and its deltas are streamed to the end. This blocks
+    until there is a winner; read the returned deltas to the end, or close
+    them, to release its request.
+
+    Args:
+        prompt: The prompt to send
+        primary: (provider, model id, API key, temperature) of the selected model
+        fallback: Optional (provider, model id, API key, temperature) of a second model
+        hedge: Whether to fire a hedged duplicate of the primary request
+        deadline: Seconds before the fallback model is started
+
+    Returns:
+        (target that won: primary or fallback, iterator over successive
+        pieces of its answer text)
+
+    Raises:
+        The first request's error if every request fails, or TimeoutError
+        if no text arrives for LLM_TIMEOUT seconds; reading the deltas
+        raises likewise if the winner's stream fails or stalls
+    """
+    attempts = [(primary, 0.0)]
+    if hedge:
+        attempts.append((primary, hedge_delay(primary[0], primary[1], "first_delta")))
+    if fallback is not None:
+        attempts.append((fallback, deadline))
+    attempts.sort(key=lambda attempt: attempt[1])
+
+    deltas: "queue.Queue[Any]" = queue.Queue()
+
+    async def discard(result: Tuple[str, AsyncIterator[str]]) -> None:
+        await result[1].aclose()
+
+    async def pump() -> None:
+        try:
+            target, (first, stream) = await _race(prompt, attempts, _stream_attempt, discard, "first_delta")
+            try:
+                deltas.put(target)
+                deltas.put(first)
+                async for delta in stream:
+                    deltas.put(delta)
+            finally:
+                await stream.aclose()
+            deltas.put(_STREAM_END)
+        except Exception as e:
+            deltas.put(e)
+
+    def next_delta() -> Any:
+        try:
+            delta = deltas.get(timeout=LLM_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError(f"No response from the model for {LLM_TIMEOUT:.0f}s")
+        if isinstance(delta, Exception):
+            raise delta
+        return delta
+
+    def read() -> Iterator[str]:
+        try:
+            while True:
+                delta = next_delta()
+                if delta is _STREAM_END:
+                    return
+                yield delta
+        finally:
+            # Stops the request if the reader gave up early
+            future.cancel()
+
+    future = asyncio.run_coroutine_threadsafe(pump(), _event_loop())
+    try:
+        target = next_delta()
+    except BaseException:
+        future.cancel()
+        raise
+    return target, read()
@@ -0,0 +1,186 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from contextlib import closing
+from typing import Any, Dict, Optional
+
+# SQLite file holding cached model responses
+LLM_CACHE_PATH = os.environ.get("RAG_LLM_CACHE", "llm_cache.sqlite3")
+
+# Seconds a cached response stays valid, and maximum number of cached responses
+LLM_CACHE_TTL = 7 * 24 * 3600
+LLM_CACHE_MAX_ENTRIES = 5000
+
+# Similarity tier: reuse the answer to a near-identical question asked over
+# exactly the same retrieved context. Off unless enabled, since two questions
+# can differ in a single word ("not") and still pass a token-overlap test.
+LLM_CACHE_SIMILAR_QUESTIONS = os.environ.get("RAG_LLM_CACHE_SIMILAR", "0") == "1"
+LLM_CACHE_SIMILARITY_THRESHOLD = 0.85
+
+TOKEN_PATTERN = re.compile(r'\b\w+\b')
+
+def _hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def _question_terms(question: str) -> frozenset:
+    return frozenset(TOKEN_PATTERN.findall(question.lower()))
+
+class ResponseCache:
+    """
+    Persistent cache of model responses in a SQLite file.
+
+    Exact hits are keyed on provider, model id, temperature and the SHA-256
+    of the full prompt. Entries expire after a TTL, and the least recently
+    used ones are evicted once the cache exceeds its size limit. Cache
+    errors are reported and treated as misses, so they never fail a chat.
+    """
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl: float = LLM_CACHE_TTL,
+                 max_entries: int = LLM_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        provider TEXT NOT NULL,
+                        model TEXT NOT NULL,
+                        temperature TEXT NOT NULL,
+                        context_hash TEXT,
+                        question TEXT,
+                        response TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_used REAL NOT NULL
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS responses_context "
+                             "ON responses (provider, model, temperature, context_hash)")
+                conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        except sqlite3.Error as e:
+            print(f"Error initializing LLM response cache: {e}")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=5)
+
+    @staticmethod
+    def _key(provider: str, model: str, temperature: Any, prompt: str) -> str:
+        return _hash(f"{provider}\0{model}\0{temperature!r}\0{_hash(prompt)}")
+
+    def get(self, provider: str, model: str, temperature: Any, prompt: str,
+            question: Optional[str] = None, context: Optional[str] = None) -> Optional[str]:
+        """
+        Look up a cached response.
+
+        Args:
+            provider: Model provider, e.g. "OpenAI GPT"
+            model: Provider model identifier
+            temperature: Sampling temperature the call would use
+            prompt: Full prompt sent to the model
+            question: Optional user question, for the similarity tier
+            context: Optional retrieved context the prompt was built from
+
+        Returns:
+            The cached response, or None on a miss
+        """
+        now = time.time()
+        try:
+            with closing(self._connect()) as conn, conn:
+                key = self._key(provider, model, temperature, prompt)
+                row = conn.execute("SELECT response FROM responses WHERE key = ? AND created_at > ?",
+                                   (key, now - self.ttl)).fetchone()
+                if row is None and LLM_CACHE_SIMILAR_QUESTIONS and question and context is not None:
+                    key, row = self._find_similar(conn, provider, model, temperature, question, context, now)
+                    if row is not None:
+                        with self._lock:
+                            self.similar_hits += 1
+                if row is None:
+                    with self._lock:
+                        self.misses += 1
+                    return None
+                conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            print(f"Error reading LLM response cache: {e}")
+            return None
+        with self._lock:
+            self.hits += 1
+        return row[0]
+
+    def _find_similar(self, conn: sqlite3.Connection, provider: str, model: str, temperature: Any,
+                      question: str, context: str, now: float):
+        """Find the cached answer to the most similar question over the same context."""
+        terms = _question_terms(question)
+        if not terms:
+            return None, None
+        best_key, best_row, best_score = None, None, LLM_CACHE_SIMILARITY_THRESHOLD
+        rows = conn.execute(
+            "SELECT key, question, response FROM responses "
+            "WHERE provider = ? AND model = ? AND temperature = ? AND context_hash = ? AND created_at > ?",
+            (provider, model, repr(temperature), _hash(context), now - self.ttl))
+        for key, cached_question, response in rows:
+            cached_terms = _question_terms(cached_question or "")
+            # Jaccard similarity of the two questions' word sets
+            score = len(terms & cached_terms) / len(terms | cached_terms)
+            if score >= best_score:
+                best_key, best_row, best_score = key, (response,), score
+        return best_key, best_row
+
+    def put(self, provider: str, model: str, temperature: Any, prompt: str, response: str,
+            question: Optional[str] = None, context: Optional[str] = None) -> None:
+        """Store a response, evicting expired and least recently used entries."""
+        now = time.time()
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses "
+                    "(key, provider, model, temperature, context_hash, question, response, created_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self._key(provider, model, temperature, prompt), provider, model, repr(temperature),
+                     _hash(context) if context is not None else None, question, response, now, now))
+                conn.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl,))
+                (count,) = conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+                if count > self.max_entries:
+                    conn.execute(
+                        "DELETE FROM responses WHERE key IN "
+                        "(SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                        (count - self.max_entries,))
+        except sqlite3.Error as e:
+            print(f"Error writing LLM response cache: {e}")
+
+    def clear(self) -> None:
+        """Delete every cached response."""
+        try:
+            with closing(self._connect()) as conn, conn:
+                conn.execute("DELETE FROM responses")
+        except sqlite3.Error as e:
+            print(f"Error clearing LLM response cache: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of this process, for monitoring."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache() -> ResponseCache:
+    """Return the process-wide response cache, opening it on first use."""
+    global _response_cache
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
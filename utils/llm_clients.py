@@ -0,0 +1,119 @@
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Tuple
+
+# Seconds a client may sit unused before it is closed, and the most clients
+# (distinct provider/API key pairs) kept open at once
+CLIENT_IDLE_TTL = 15 * 60
+CLIENT_POOL_MAX = 32
+
+def _openai_client(api_key: str):
+    from openai import OpenAI
+    return OpenAI(api_key=api_key)
+
+def _anthropic_client(api_key: str):
+    import anthropic
+    return anthropic.Anthropic(api_key=api_key)
+
+def _gemini_client(api_key: str):
+    # The low-level service client takes its key per instance, unlike
+    # genai.configure, which sets one key for the whole process
+    from google.ai import generativelanguage as glm
+    return glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+# Provider -> function creating a client for an API key
+CLIENT_FACTORIES: Dict[str, Callable[[str], Any]] = {
+    "OpenAI GPT": _openai_client,
+    "Google Gemini": _gemini_client,
+    "Claude": _anthropic_client,
+}
+
+def _close_client(client: Any) -> None:
+    """Release a client's connection pool."""
+    try:
+        if hasattr(client, "close"):
+            client.close()
+        elif hasattr(client, "transport"):
+            client.transport.close()
+    except Exception as e:
+        print(f"Error closing LLM client: {e}")
+
+class ClientRegistry:
+    """
+    Long-lived provider clients shared across requests and sessions.
+
+    Clients are keyed by provider and the SHA-256 of the API key, so each
+    key gets its own client (and HTTP/gRPC connection pool) and the raw key
+    is never used as a dictionary key. The provider SDK clients are safe to
+    share between threads. Clients unused for CLIENT_IDLE_TTL seconds, or
+    beyond the CLIENT_POOL_MAX most recently used, are closed.
+    """
+    def __init__(self, idle_ttl: float = CLIENT_IDLE_TTL, max_clients: int = CLIENT_POOL_MAX,
+                 factories: Dict[str, Callable[[str], Any]] = CLIENT_FACTORIES,
+                 close: Callable[[Any], None] = _close_client):
+        self.idle_ttl = idle_ttl
+        self.max_clients = max_clients
+        self.factories = factories
+        self._close = close
+        self._clients: "OrderedDict[Tuple[str, str], list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, provider: str, api_key: str) -> Any:
+        """
+        Return the client for a provider and API key, creating it on first use.
+
+        Args:
+            provider: Provider name, a key of the registry's factories
+            api_key: API key the client authenticates with
+
+        Returns:
+            The provider SDK client
+        """
+        key = (provider, hashlib.sha256(api_key.encode('utf-8')).hexdigest())
+        now = time.monotonic()
+        with self._lock:
+            evicted = self._evict_idle(now)
+            entry = self._clients.get(key)
+            if entry is None:
+                entry = [self.factories[provider](api_key), now]
+                self._clients[key] = entry
+                while len(self._clients) > self.max_clients:
+                    evicted.append(self._clients.popitem(last=False)[1][0])
+            else:
+                entry[1] = now
+            self._clients.move_to_end(key)
+            client = entry[0]
+        for stale in evicted:
+            self._close(stale)
+        return client
+
+    def _evict_idle(self, now: float) -> list:
+        """Remove clients idle past the TTL, returning them to be closed."""
+        evicted = []
+        # Entries are in least recently used order, so stop at the first fresh one
+        while self._clients:
+            key, (client, last_used) = next(iter(self._clients.items()))
+            if now - last_used <= self.idle_ttl:
+                break
+            del self._clients[key]
+            evicted.append(client)
+        return evicted
+
+    def clear(self) -> None:
+        """Close and forget every client."""
+        with self._lock:
+            clients = [entry[0] for entry in self._clients.values()]
+            self._clients.clear()
+        for client in clients:
+            self._close(client)
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+_client_registry = ClientRegistry()
+
+def get_llm_client(provider: str, api_key: str) -> Any:
+    """Return the shared client for a provider and API key."""
+    return _client_registry.get(provider, api_key)
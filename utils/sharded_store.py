@@ -0,0 +1,277 @@
+import os
+import atexit
+import heapq
+import hashlib
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
+from utils.embeddings import get_embedder
+from utils.vector_store import (HYBRID_CANDIDATES, HYBRID_DENSE_WEIGHT, HYBRID_KEYWORD_WEIGHT, SimpleVectorStore,
+                                VectorStoreBase, chunk_document, reciprocal_rank_fusion)
+from utils.workers import worker_context
+
+# Number of shards a new sharded store is split into; an existing store
+# keeps the count recorded in its SHARDS file
+SHARD_COUNT = int(os.environ.get("RAG_SHARDS", "0")) or os.cpu_count() or 1
+
+def shard_for(document_path: str, shards: int) -> int:
+    """Shard holding a document: its path's MD5, like chunk ids, modulo the shard count."""
+    return int(hashlib.md5(document_path.encode()).hexdigest(), 16) % shards
+
+def _merge_ranked(ranked_lists: Iterable[List[Dict[str, Any]]], top_k: int) -> List[Dict[str, Any]]:
+    """
+    Merge per-shard rankings into the global top_k.
+
+    Each list is ordered by score (descending), then document name and
+    position, as search_chunks returns them, so a k-way merge on the same
+    key reproduces the order of a single store.
+    """
+    merged = heapq.merge(*ranked_lists, key=lambda chunk: (-chunk["score"], chunk["doc_name"], chunk["position"]))
+    return list(itertools.islice(merged, max(top_k, 0)))
+
+def _sum_keyword_stats(shard_stats: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Corpus-wide BM25 statistics from the keyword_stats of every shard."""
+    doc_freqs: Dict[str, int] = {}
+    for stats in shard_stats:
+        for term, doc_freq in stats["doc_freqs"].items():
+            doc_freqs[term] = doc_freqs.get(term, 0) + doc_freq
+    return {
+        "num_chunks": sum(stats["num_chunks"] for stats in shard_stats),
+        "total_length": sum(stats["total_length"] for stats in shard_stats),
+        "doc_freqs": doc_freqs,
+    }
+
+class _Shard(SimpleVectorStore):
+    """A SimpleVectorStore held resident in a shard process."""
+    def current_generation(self) -> int:
+        """Catch up with changes on disk and return the generation."""
+        self.refresh()
+        return self.generation
+
+    def keyword_chunks(self, query: str, top_k: int, doc_paths: Optional[List[str]],
+                       stats: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Like search_chunks in "keyword" mode, with BM25 idf and average length from corpus-wide stats."""
+        with self._lock.read():
+            if not self.num_chunks:
+                return []
+            scores = self._keyword_scores(query, self._search_scope(doc_paths), top_k, stats)
+            return [self._chunk_info(key, scores[key]) for key in self._rank(scores, top_k)]
+
+class _ShardManager(BaseManager):
+    pass
+
+_ShardManager.register("Shard", _Shard, exposed=(
+    "add_chunked_documents", "remove_document", "has_document", "search_chunks", "keyword_chunks", "keyword_stats",
+    "compact", "current_generation"))
+
+def _init_shard_process() -> None:
+    # Exit with the store that started us, even if it was killed outright.
+    # That is the multiprocessing parent, not the OS one: shards are forked
+    # from the forkserver.
+    parent = multiprocessing.parent_process()
+    def watch_parent() -> None:
+        parent.join()
+        os._exit(0)
+    threading.Thread(target=watch_parent, name="shard-parent-watch", daemon=True).start()
+
+class ShardedVectorStore(VectorStoreBase):
+    """
+    Vector store partitioned into shards, each resident in its own process.
+
+    Documents are assigned to shards by the MD5 of their path, so a
+    document and all its chunks always live in one shard, and every shard
+    is an ordinary SimpleVectorStore in <directory>/shard-NN. Each shard is
+    served by a manager process that keeps its index loaded and handles
+    each caller thread on its own connection.
+
+    Searches fan out to the shards concurrently, so a query uses one core
+    per shard, and the per-shard top-k rankings are merged into the global
+    top-k. A search restricted to some documents only asks the shards
+    holding them. Writes are grouped by shard and applied in parallel.
+
+    Keyword searches first collect the query terms' BM25 statistics from
+    all shards, so every shard scores with corpus-wide idf and average
+    length and the merged ranking matches that of a single store.
+
+    It is selected with VECTOR_STORE_BACKEND = "sharded".
+    """
+    def __init__(self, directory: str = "simple_vector_store", shards: int = SHARD_COUNT):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Documents are routed by the shard count, so it is fixed once the
+        # store exists
+        shards_file = os.path.join(directory, "SHARDS")
+        try:
+            with open(shards_file, 'r', encoding='utf-8') as f:
+                shards = int(f.read())
+        except FileNotFoundError:
+            with open(shards_file, 'w', encoding='utf-8') as f:
+                f.write(str(shards))
+        self.embedder = get_embedder()
+        # Two calls per shard for a hybrid search
+        self._executor = ThreadPoolExecutor(max_workers=2 * shards, thread_name_prefix="shard-fanout")
+        # Not forked, as the app process runs threads, and not plainly
+        # spawned, which would re-run the app's main script in every shard
+        context = worker_context()
+        self._managers = [_ShardManager(ctx=context) for _ in range(shards)]
+        list(self._executor.map(lambda manager: manager.start(_init_shard_process), self._managers))
+        atexit.register(self.close)
+        self._shards = list(self._executor.map(
+            lambda i: self._managers[i].Shard(os.path.join(directory, f"shard-{i:02d}")), range(shards)))
+        self.generation = 0
+        self.refresh()
+
+    def close(self) -> None:
+        """Stop the shard processes; also run at exit."""
+        atexit.unregister(self.close)
+        self._executor.shutdown()
+        for manager in self._managers:
+            manager.shutdown()
+
+    def _fan_out(self, calls: List[Tuple[Callable, tuple, dict]]) -> List[Any]:
+        """Run (method, args, kwargs) shard calls concurrently, returning their results in order."""
+        futures = [self._executor.submit(method, *args, **kwargs) for method, args, kwargs in calls]
+        return [future.result() for future in futures]
+
+    def _shard(self, document_path: str):
+        return self._shards[shard_for(document_path, len(self._shards))]
+
+    def _by_shard(self, doc_paths: Optional[List[str]]) -> Dict[int, Optional[List[str]]]:
+        """Shards to search, each with the documents it holds, or None for an unscoped search."""
+        if not doc_paths:
+            return {i: None for i in range(len(self._shards))}
+        by_shard: Dict[int, Optional[List[str]]] = {}
+        for doc_path in doc_paths:
+            by_shard.setdefault(shard_for(doc_path, len(self._shards)), []).append(doc_path)
+        return by_shard
+
+    @contextmanager
+    def reading(self):
+        """
+        No cross-shard snapshot: each shard call sees its own shard
+        consistently, and refresh() reads the generation before searching,
+        so results are never cached under a newer generation than theirs.
+        """
+        yield self
+
+    def refresh(self) -> bool:
+        """
+        Have every shard catch up with changes on disk.
+
+        Returns:
+            bool: True if any shard changed
+        """
+        generations = self._fan_out([(shard.current_generation, (), {}) for shard in self._shards])
+        generation = sum(generations)
+        changed = generation != self.generation
+        self.generation = generation
+        return changed
+
+    def compact(self) -> None:
+        """Compact all shards in parallel."""
+        self._fan_out([(shard.compact, (), {}) for shard in self._shards])
+
+    def has_document(self, document_path: str) -> bool:
+        """Check whether any chunks of a document are indexed."""
+        return self._shard(document_path).has_document(document_path)
+
+    def add_document(self, document_path: str, content: Union[str, Iterable[str]]) -> bool:
+        """
+        Add document content to the index, or update a re-indexed document.
+
+        The text is chunked here and embedded by the document's shard.
+
+        Args:
+            document_path: Path identifying the document
+            content: The document text, or consecutive pieces of it such as
+                pages, which are chunked as they arrive
+
+        Returns:
+            bool: True if the index changed
+        """
+        chunks, content_hash = chunk_document(content)
+        return self.add_chunked_documents([(document_path, chunks, content_hash)]) > 0
+
+    def add_chunked_documents(self, documents: List[Tuple[str, List[str], str]],
+                              vectors: Optional[List[np.ndarray]] = None) -> int:
+        """
+        Add or update already chunked documents, writing to their shards in parallel.
+
+        Each shard applies its share with a single durable log write, as
+        SimpleVectorStore.add_chunked_documents does.
+
+        Args:
+            documents: (document_path, chunks, content_hash) tuples, as built
+                by chunk_document
+            vectors: Optional per-document (len(chunks), dim) matrices of chunk
+                vectors from this store's embedder, so they aren't computed again
+
+        Returns:
+            int: Number of documents that changed the index
+        """
+        groups: Dict[int, Tuple[list, Optional[list]]] = {}
+        for i, document in enumerate(documents):
+            shard_documents, shard_vectors = groups.setdefault(
+                shard_for(document[0], len(self._shards)), ([], None if vectors is None else []))
+            shard_documents.append(document)
+            if vectors is not None:
+                shard_vectors.append(vectors[i])
+        changed = sum(self._fan_out([(self._shards[i].add_chunked_documents, group, {})
+                                     for i, group in groups.items()]))
+        self.refresh()
+        return changed
+
+    def remove_document(self, document_path: str) -> None:
+        """Remove a document and its chunks from the index."""
+        self._shard(document_path).remove_document(document_path)
+        self.refresh()
+
+    def _search_calls(self, mode: str, query: str, top_k: int,
+                      doc_paths: Optional[List[str]]) -> List[Tuple[Callable, tuple, dict]]:
+        """Calls of a "keyword" or "dense" search on every shard holding any of doc_paths."""
+        by_shard = self._by_shard(doc_paths)
+        if mode == "dense":
+            return [(self._shards[i].search_chunks, (query, top_k, shard_docs, mode), {})
+                    for i, shard_docs in by_shard.items()]
+        # Every shard scores with the idf of the whole corpus, so merged
+        # scores compare as if the chunks were in one store
+        stats = _sum_keyword_stats(self._fan_out([(shard.keyword_stats, (query,), {}) for shard in self._shards]))
+        if not stats["num_chunks"]:
+            return []
+        return [(self._shards[i].keyword_chunks, (query, top_k, shard_docs, stats), {})
+                for i, shard_docs in by_shard.items()]
+
+    def _search_chunks(self, mode: str, query: str, top_k: int, doc_paths: Optional[List[str]],
+                       keyword_weight: float = HYBRID_KEYWORD_WEIGHT,
+                       dense_weight: float = HYBRID_DENSE_WEIGHT) -> List[Dict[str, Any]]:
+        """Top chunks of a search across all shards, with their metadata."""
+        if mode in ("keyword", "dense"):
+            return _merge_ranked(self._fan_out(self._search_calls(mode, query, top_k, doc_paths)), top_k)
+        if mode != "hybrid":
+            raise ValueError(f"Unknown search mode: {mode}")
+
+        # Fuse the global keyword and dense rankings, as a single store does
+        depth = max(top_k, HYBRID_CANDIDATES)
+        keyword_calls = self._search_calls("keyword", query, depth, doc_paths)
+        results = self._fan_out(keyword_calls + self._search_calls("dense", query, depth, doc_paths))
+        if not any(results[:len(keyword_calls)]):
+            return []
+        # Chunks are keyed by document and position, which identify them across shards
+        chunks: Dict[Tuple[str, int], Dict[str, Any]] = {}
+        rankings = []
+        for weight, ranked_lists in ((keyword_weight, results[:len(keyword_calls)]),
+                                     (dense_weight, results[len(keyword_calls):])):
+            keys = []
+            for chunk in _merge_ranked(ranked_lists, depth):
+                key = (chunk["doc_path"], chunk["position"])
+                chunks.setdefault(key, chunk)
+                keys.append(key)
+            rankings.append((weight, keys))
+        fused = [dict(chunks[key], score=score) for key, score in reciprocal_rank_fusion(rankings).items()]
+        fused.sort(key=lambda chunk: (-chunk["score"], chunk["doc_name"], chunk["position"]))
+        return fused[:top_k]
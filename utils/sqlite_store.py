@@ -0,0 +1,416 @@
+import os
+import json
+import heapq
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+import numpy as np
+from utils.embeddings import get_embedder
+from utils.vector_store import (DENSE_MIN_SIMILARITY, EMBED_BATCH_SIZE, HYBRID_CANDIDATES, HYBRID_DENSE_WEIGHT,
+                                HYBRID_KEYWORD_WEIGHT, VectorStoreBase, _tokenize, chunk_document,
+                                reciprocal_rank_fusion)
+
+# File holding the index inside the store directory
+SQLITE_STORE_FILE = "index.sqlite3"
+
+# Seconds a writer waits for another connection's write transaction
+SQLITE_BUSY_TIMEOUT = 30
+
+# Rows of stored vectors scored per numpy batch in dense search
+DENSE_SCAN_BATCH = 4096
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY,
+        path TEXT NOT NULL UNIQUE,
+        name TEXT NOT NULL,
+        content_hash TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS chunks (
+        id INTEGER PRIMARY KEY,
+        doc_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        content TEXT NOT NULL,
+        vector BLOB NOT NULL,
+        UNIQUE (doc_id, position)
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+        content, content='chunks', content_rowid='id'
+    );
+    CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+        INSERT INTO chunks_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+        INSERT INTO chunks_fts (chunks_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END;
+    CREATE TRIGGER IF NOT EXISTS chunks_au AFTER UPDATE OF content ON chunks BEGIN
+        INSERT INTO chunks_fts (chunks_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chunks_fts (rowid, content) VALUES (new.id, new.content);
+    END;
+"""
+
+def fts5_available() -> bool:
+    """Whether this Python's SQLite library was built with FTS5."""
+    try:
+        conn = sqlite3.connect(":memory:")
+        try:
+            conn.execute("CREATE VIRTUAL TABLE probe USING fts5(content)")
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    return True
+
+def _match_expression(query: str) -> Optional[str]:
+    """FTS5 query matching chunks with any of the query's terms, or None if it has none."""
+    terms = list(dict.fromkeys(_tokenize(query)))
+    if not terms:
+        return None
+    # Quoted, so words like AND, NEAR or "-" are taken literally
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+class SQLiteVectorStore(VectorStoreBase):
+    """
+    Vector store backed by a single SQLite file.
+
+    Documents and their chunks live in ordinary tables, with each chunk's
+    embedding stored next to its text; an external-content FTS5 table kept
+    in sync by triggers serves keyword search with SQLite's bm25 ranking.
+    Nothing is loaded into memory up front: searches read from disk
+    through the page cache, and every change is one transaction, so a crash
+    leaves either the old or the new version of a document.
+
+    The database runs in WAL mode, so any number of readers in any number
+    of processes search while a writer commits. Each thread uses its own
+    connection; reading() holds a read transaction on it, so everything
+    read inside sees one consistent snapshot.
+
+    Keyword search ranks with FTS5's bm25. It is selected with
+    VECTOR_STORE_BACKEND = "sqlite".
+    """
+    def __init__(self, path: str = SQLITE_STORE_FILE):
+        self.path = path
+        # Identifies the store in query cache keys
+        self.directory = os.path.abspath(path)
+        self.embedder = get_embedder()
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("BEGIN IMMEDIATE;" + SCHEMA + "COMMIT;")
+        self._check_embedder()
+
+    def _connection(self) -> sqlite3.Connection:
+        """This thread's connection, opened on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Transactions are managed explicitly, see reading() and _writing()
+            conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None)
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def reading(self):
+        """Hold a read transaction on this thread's connection; reads inside see one snapshot."""
+        conn = self._connection()
+        if self._local.depth == 0:
+            conn.execute("BEGIN")
+        self._local.depth += 1
+        try:
+            yield conn
+        finally:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute("COMMIT")
+
+    @contextmanager
+    def _writing(self):
+        """Run a write transaction, bumping the generation if it changed any rows."""
+        conn = self._connection()
+        if self._local.depth:
+            raise RuntimeError("Cannot write to the index while reading from it")
+        self._local.depth += 1
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                changes = conn.total_changes
+                yield conn
+                # Unchanged re-adds and removals of unknown documents keep
+                # cached search results valid
+                if conn.total_changes != changes:
+                    conn.execute("INSERT INTO meta (key, value) VALUES ('generation', '1') "
+                                 "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            self._local.depth -= 1
+
+    def _check_embedder(self) -> None:
+        """Re-embed stored chunks if they were embedded by a different embedder."""
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'embedder'").fetchone()
+        if row is not None and row[0] == self.embedder.name:
+            return
+        with self._writing() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'embedder'").fetchone()
+            if row is not None and row[0] == self.embedder.name:
+                return
+            if row is not None:
+                print(f"Re-embedding indexed chunks for embedder {self.embedder.name}")
+                rows = conn.execute("SELECT id, content FROM chunks").fetchall()
+                for start in range(0, len(rows), EMBED_BATCH_SIZE):
+                    batch = rows[start:start + EMBED_BATCH_SIZE]
+                    vectors = self.embedder.embed_documents([content for _, content in batch])
+                    conn.executemany("UPDATE chunks SET vector = ? WHERE id = ?",
+                                     [(vector.tobytes(), chunk_id) for (chunk_id, _), vector in zip(batch, vectors)])
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('embedder', ?)", (self.embedder.name,))
+
+    @property
+    def generation(self) -> int:
+        """Counter bumped by every committed change, in any process, to invalidate cached results."""
+        row = self._connection().execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def refresh(self) -> bool:
+        """Nothing to reload: every read sees the latest committed changes. Returns False."""
+        return False
+
+    def compact(self) -> None:
+        """Merge the full-text index's segments and fold the WAL back into the database file."""
+        conn = self._connection()
+        if self._local.depth:
+            raise RuntimeError("Cannot write to the index while reading from it")
+        # Its own transaction, outside _writing: search results don't change
+        conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('optimize')")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def has_document(self, document_path: str) -> bool:
+        """Check whether any chunks of a document are indexed."""
+        with self.reading() as conn:
+            return conn.execute("SELECT 1 FROM documents WHERE path = ?", (document_path,)).fetchone() is not None
+
+    def _document_state(self, conn: sqlite3.Connection,
+                        document_path: str) -> Tuple[Optional[int], Optional[str], Dict[int, str]]:
+        """Row id, content hash and {position: text} of the chunks of an indexed document."""
+        row = conn.execute("SELECT id, content_hash FROM documents WHERE path = ?", (document_path,)).fetchone()
+        if row is None:
+            return None, None, {}
+        doc_id, content_hash = row
+        chunks = dict(conn.execute("SELECT position, content FROM chunks WHERE doc_id = ?", (doc_id,)))
+        return doc_id, content_hash, chunks
+
+    @staticmethod
+    def _changed_positions(chunks: List[str], existing: Dict[int, str]) -> List[int]:
+        return [i for i, chunk in enumerate(chunks) if existing.get(i) != chunk]
+
+    def add_document(self, document_path: str, content: Union[str, Iterable[str]]) -> bool:
+        """
+        Add document content to the index, or update a re-indexed document.
+
+        Re-adding content identical to what is indexed does nothing. For
+        changed content only the chunks whose text differs are rewritten,
+        and chunks past the new end of the document are removed, in one
+        transaction.
+
+        Args:
+            document_path: Path identifying the document
+            content: The document text, or consecutive pieces of it such as
+                pages, which are chunked as they arrive
+
+        Returns:
+            bool: True if the index changed
+        """
+        chunks, content_hash = chunk_document(content)
+        return self.add_chunked_documents([(document_path, chunks, content_hash)]) > 0
+
+    def add_chunked_documents(self, documents: List[Tuple[str, List[str], str]],
+                              vectors: Optional[List[np.ndarray]] = None) -> int:
+        """
+        Add or update already chunked documents in a single transaction.
+
+        Each document is applied like add_document; documents without chunks
+        or with an unchanged content hash are skipped. Changed chunks are
+        embedded before the write transaction starts, so other writers
+        aren't blocked meanwhile; the diff is then recomputed inside it, and
+        only chunks another writer changed in between are embedded there.
+
+        Args:
+            documents: (document_path, chunks, content_hash) tuples, as built
+                by chunk_document
+            vectors: Optional per-document (len(chunks), dim) matrices of chunk
+                vectors from this store's embedder, so they aren't computed here
+
+        Returns:
+            int: Number of documents that changed the index
+        """
+        # Vectors computed so far: one {position: vector} map per document
+        known: List[Dict[int, np.ndarray]] = [{} for _ in documents]
+        if vectors is None:
+            with self.reading() as conn:
+                changed = []
+                for document_path, chunks, content_hash in documents:
+                    _, indexed_hash, existing = self._document_state(conn, document_path)
+                    changed.append(self._changed_positions(chunks, existing)
+                                   if chunks and indexed_hash != content_hash else [])
+            for document_vectors, (_, chunks, _), positions in zip(known, documents, changed):
+                if positions:
+                    document_vectors.update(zip(positions, self.embedder.embed_documents([chunks[p] for p in positions])))
+
+        with self._writing() as conn:
+            count = 0
+            for i, (document_path, chunks, content_hash) in enumerate(documents):
+                doc_id, indexed_hash, existing = self._document_state(conn, document_path)
+                if not chunks or indexed_hash == content_hash:
+                    continue
+                positions = self._changed_positions(chunks, existing)
+                if vectors is not None:
+                    document_vectors = dict(zip(positions, vectors[i][positions]))
+                else:
+                    missing = [position for position in positions if position not in known[i]]
+                    if missing:
+                        known[i].update(zip(missing, self.embedder.embed_documents([chunks[p] for p in missing])))
+                    document_vectors = known[i]
+
+                if doc_id is None:
+                    doc_id = conn.execute("INSERT INTO documents (path, name, content_hash) VALUES (?, ?, ?)",
+                                          (document_path, os.path.basename(document_path), content_hash)).lastrowid
+                else:
+                    conn.execute("UPDATE documents SET content_hash = ? WHERE id = ?", (content_hash, doc_id))
+                # Whatever lies past the new end of the document goes
+                conn.execute("DELETE FROM chunks WHERE doc_id = ? AND position >= ?", (doc_id, len(chunks)))
+                for position in positions:
+                    row = (chunks[position], np.asarray(document_vectors[position], dtype=np.float32).tobytes(),
+                           doc_id, position)
+                    if position in existing:
+                        conn.execute("UPDATE chunks SET content = ?, vector = ? WHERE doc_id = ? AND position = ?", row)
+                    else:
+                        conn.execute("INSERT INTO chunks (content, vector, doc_id, position) VALUES (?, ?, ?, ?)", row)
+                count += 1
+            return count
+
+    def remove_document(self, document_path: str) -> None:
+        """Remove a document and its chunks from the index."""
+        with self._writing() as conn:
+            row = conn.execute("SELECT id FROM documents WHERE path = ?", (document_path,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM chunks WHERE doc_id = ?", row)
+                conn.execute("DELETE FROM documents WHERE id = ?", row)
+
+    @staticmethod
+    def _scope_filter(doc_paths: Optional[List[str]]) -> Tuple[str, tuple]:
+        """
+        SQL condition on documents d restricting a search to doc_paths, and its
+        parameters; no or empty doc_paths search everything, as in the other stores.
+        """
+        if not doc_paths:
+            return "", ()
+        return " AND d.path IN (SELECT value FROM json_each(?))", (json.dumps(list(doc_paths)),)
+
+    def _keyword_scores(self, conn: sqlite3.Connection, query: str, top_k: int,
+                        doc_paths: Optional[List[str]]) -> Dict[int, float]:
+        """bm25 scores (higher is better) of the top_k chunks matching any query term, by chunk id."""
+        expression = _match_expression(query)
+        if expression is None or top_k <= 0:
+            return {}
+        condition, params = self._scope_filter(doc_paths)
+        rows = conn.execute(
+            "SELECT c.id, -bm25(chunks_fts) AS score FROM chunks_fts "
+            "JOIN chunks c ON c.id = chunks_fts.rowid JOIN documents d ON d.id = c.doc_id "
+            f"WHERE chunks_fts MATCH ?{condition} ORDER BY score DESC, d.name, c.position LIMIT ?",
+            (expression, *params, top_k))
+        return dict(rows)
+
+    def _dense_scores(self, conn: sqlite3.Connection, query: str, top_k: int,
+                      doc_paths: Optional[List[str]]) -> Dict[int, float]:
+        """
+        Cosine similarity of the top_k chunks nearest to the query embedding,
+        by chunk id, leaving out chunks below DENSE_MIN_SIMILARITY.
+
+        Stored vectors are scanned in batches of DENSE_SCAN_BATCH rows, keeping
+        only the best candidates of each, so memory stays bounded by the
+        batch size rather than the corpus.
+        """
+        if top_k <= 0:
+            return {}
+        query_vector = np.asarray(self.embedder.embed_query(query), dtype=np.float32)
+        condition, params = self._scope_filter(doc_paths)
+        cursor = conn.execute("SELECT c.id, c.vector FROM chunks c JOIN documents d ON d.id = c.doc_id "
+                              f"WHERE 1{condition}", params)
+        scores: Dict[int, float] = {}
+        while True:
+            rows = cursor.fetchmany(DENSE_SCAN_BATCH)
+            if not rows:
+                break
+            ids = np.fromiter((chunk_id for chunk_id, _ in rows), dtype=np.int64, count=len(rows))
+            matrix = np.frombuffer(b"".join(vector for _, vector in rows), dtype=np.float32).reshape(len(rows), -1)
+            batch_scores = matrix @ query_vector
+            keep = batch_scores >= DENSE_MIN_SIMILARITY
+            ids, batch_scores = ids[keep], batch_scores[keep]
+            if len(batch_scores) > top_k:
+                # Keep ties at the cutoff; the final order breaks them
+                cutoff = np.partition(batch_scores, -top_k)[-top_k]
+                keep = batch_scores >= cutoff
+                ids, batch_scores = ids[keep], batch_scores[keep]
+            scores.update(zip(ids.tolist(), batch_scores.tolist()))
+            if len(scores) > 2 * top_k:
+                cutoff = heapq.nlargest(top_k, scores.values())[-1]
+                scores = {chunk_id: score for chunk_id, score in scores.items() if score >= cutoff}
+        return scores
+
+    def _fused_scores(self, conn: sqlite3.Connection, query: str, top_k: int, doc_paths: Optional[List[str]],
+                      keyword_weight: float = HYBRID_KEYWORD_WEIGHT,
+                      dense_weight: float = HYBRID_DENSE_WEIGHT) -> Dict[int, float]:
+        """
+        Reciprocal rank fusion of the keyword and dense rankings; empty if
+        no chunk matches the query's terms, without scanning the vectors.
+        """
+        depth = max(top_k, HYBRID_CANDIDATES)
+        keyword_scores = self._keyword_scores(conn, query, depth, doc_paths)
+        if not keyword_scores:
+            return {}
+        return reciprocal_rank_fusion(
+            (weight, [chunk["id"] for chunk in self._rank(conn, scores, depth)])
+            for weight, scores in ((keyword_weight, keyword_scores),
+                                   (dense_weight, self._dense_scores(conn, query, depth, doc_paths))))
+
+    def _rank(self, conn: sqlite3.Connection, scores: Dict[int, float], top_k: int) -> List[Dict[str, Any]]:
+        """
+        The top_k scored chunks with their metadata, ordered by score
+        (descending), then document name and position.
+        """
+        if top_k <= 0 or not scores:
+            return []
+        rows = conn.execute("SELECT c.id, c.content, d.path, d.name, c.position FROM chunks c "
+                            "JOIN documents d ON d.id = c.doc_id WHERE c.id IN (SELECT value FROM json_each(?))",
+                            (json.dumps(list(scores)),))
+        chunks = [{"id": chunk_id, "content": content, "doc_path": doc_path, "doc_name": doc_name,
+                   "position": position, "score": scores[chunk_id]}
+                  for chunk_id, content, doc_path, doc_name, position in rows]
+        chunks.sort(key=lambda chunk: (-chunk["score"], chunk["doc_name"], chunk["position"]))
+        return chunks[:top_k]
+
+    def _search_chunks(self, mode: str, query: str, top_k: int, doc_paths: Optional[List[str]],
+                       **weights: float) -> List[Dict[str, Any]]:
+        """Top chunks of a search, with their metadata, all read in one snapshot."""
+        with self.reading() as conn:
+            if mode == "keyword":
+                scores = self._keyword_scores(conn, query, top_k, doc_paths)
+            elif mode == "dense":
+                scores = self._dense_scores(conn, query, top_k, doc_paths)
+            elif mode == "hybrid":
+                scores = self._fused_scores(conn, query, top_k, doc_paths, **weights)
+            else:
+                raise ValueError(f"Unknown search mode: {mode}")
+            chunks = self._rank(conn, scores, top_k)
+        for chunk in chunks:
+            del chunk["id"]
+        return chunks
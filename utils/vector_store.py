@@ -1,12 +1,28 @@
 import os
 import re
+import atexit
 import json
+import math
+import heapq
+import bisect
 import hashlib
+import itertools
 import shutil
 import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
+from contextlib import contextmanager
+from collections import OrderedDict
 from pathlib import Path
+from abc import ABC, abstractmethod
 import numpy as np
-from typing import List, Dict, Any, Optional, Tuple
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple, Union
+from utils.embeddings import get_embedder
+from utils.workers import worker_context
+from utils.dense_index import DenseIndex, NumpyDenseIndex, build_dense_index, load_dense_index
 
 # Import these at top level to avoid unbound references
 try:
@@ -41,138 +57,1906 @@ try:
 except ImportError:
     docx_available = False
 
+# Advisory file locks coordinate writers across processes where available
+try:
+    import fcntl
+    fcntl_available = True
+except ImportError:
+    fcntl_available = False
+
 # Define constants
 INDEX_DIR = "vector_index"
+
+# Storage engine behind get_vector_store: "simple" (memory-mapped segments
+# and a mutation log), "sqlite" (one SQLite file with an FTS5 index) or
+# "sharded" (simple stores split by document, searched in parallel processes)
+VECTOR_STORE_BACKEND = os.environ.get("RAG_VECTOR_STORE", "simple")
 CHUNK_SIZE = 1000
 CHUNK_OVERLAP = 200
 
-class SimpleVectorStore:
+# Retrieval used by search_index: "keyword" (BM25), "dense" (embeddings)
+# or "hybrid" (both, fused with reciprocal rank fusion)
+SEARCH_MODE = os.environ.get("RAG_SEARCH_MODE", "hybrid")
+
+# Reciprocal rank fusion: rank offset, per-retriever weights, and how many
+# candidates each retriever contributes before fusion
+RRF_K = 60
+HYBRID_KEYWORD_WEIGHT = 1.0
+HYBRID_DENSE_WEIGHT = 1.0
+HYBRID_CANDIDATES = 20
+
+# Dense hits need at least this cosine similarity to the query, and hybrid
+# search only fuses them into queries the keyword ranking matched, so a query
+# unrelated to every document retrieves nothing instead of its nearest chunks
+DENSE_MIN_SIMILARITY = float(os.environ.get("RAG_DENSE_MIN_SIMILARITY", "0.15"))
+TOKEN_PATTERN = re.compile(r'\b\w+\b')
+SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?])\s+')
+
+# Compact the mutation log into a new segment once it reaches this size,
+# or this fraction of the segment size for large indexes
+LOG_COMPACT_MIN_BYTES = 4 * 1024 * 1024
+LOG_COMPACT_RATIO = 0.5
+
+# Number of chunks embedded per batch when (re)building dense vectors
+EMBED_BATCH_SIZE = 256
+
+# BM25 ranking parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Extracted text cache: directory, size limit, and a version to bump whenever
+# extraction output changes so stale entries stop matching
+EXTRACTION_CACHE_DIR = "extraction_cache"
+EXTRACTION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+EXTRACTOR_VERSION = 2
+
+# Seconds after its last write an unfinished cache entry counts as abandoned
+EXTRACTION_CACHE_TMP_MAX_AGE = 3600
+
+# PDFs with at least this many pages are extracted by a process pool, in
+# ranges of PDF_PAGE_BATCH pages with at most PDF_PREFETCH_BATCHES ranges
+# per worker in flight; RAG_PDF_WORKERS=1 disables the pool
+PDF_PARALLEL_MIN_PAGES = 200
+PDF_PAGE_BATCH = 100
+PDF_PREFETCH_BATCHES = 2
+PDF_WORKERS = int(os.environ.get("RAG_PDF_WORKERS", "0")) or os.cpu_count() or 1
+
+# search_index result cache: maximum number of entries, and seconds an entry
+# stays valid even if the index hasn't changed
+QUERY_CACHE_SIZE = 512
+QUERY_CACHE_TTL = 600
+
+def split_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
+    """Split text into overlapping chunks."""
+    if not text:
+        return []
+        
+    # Clean and normalize text
+    text = re.sub(r'\s+', ' ', text).strip()
+    
+    # Split by sentences to avoid breaking in the middle of sentences
+    sentences = SENTENCE_BOUNDARY.split(text)
+    return list(_chunk_sentences(sentences, chunk_size, overlap))
+
+def iter_chunks(pieces: Iterable[str], chunk_size: int = CHUNK_SIZE,
+                overlap: int = CHUNK_OVERLAP) -> Iterator[str]:
+    """
+    Split text arriving in pieces into the chunks split_text would produce.
+    
+    Only the unfinished trailing sentence is buffered, so a document can be
+    chunked while it is still being extracted.
+    
+    Args:
+        pieces: Consecutive parts of the text, e.g. extracted pages
+        chunk_size: Maximum chunk length in characters
+        overlap: Characters repeated between pieces of an over-long sentence
+        
+    Returns:
+        Iterator over the chunks
+    """
+    def sentences() -> Iterator[str]:
+        buffer = ""
+        for piece in pieces:
+            # A boundary can only be new from the buffer's last non-space character on
+            search_from = max(0, len(buffer.rstrip()) - 1)
+            buffer += piece
+            last = None
+            for last in SENTENCE_BOUNDARY.finditer(buffer, search_from):
+                pass
+            if last is None:
+                continue
+            # Cut before the whitespace, which may continue in the next piece
+            complete = re.sub(r'\s+', ' ', buffer[:last.start()]).strip()
+            buffer = buffer[last.start():]
+            yield from SENTENCE_BOUNDARY.split(complete)
+        rest = re.sub(r'\s+', ' ', buffer).strip()
+        if rest:
+            yield from SENTENCE_BOUNDARY.split(rest)
+    
+    return _chunk_sentences(sentences(), chunk_size, overlap)
+
+def _chunk_sentences(sentences: Iterable[str], chunk_size: int, overlap: int) -> Iterator[str]:
+    """Pack sentences into chunks of at most chunk_size characters."""
+    current_chunk = ""
+    
+    for sentence in sentences:
+        if len(current_chunk) + len(sentence) <= chunk_size:
+            current_chunk += " " + sentence if current_chunk else sentence
+        else:
+            if current_chunk:
+                yield current_chunk.strip()
+            current_chunk = sentence
+            
+            # If a single sentence is longer than chunk_size, split it
+            while len(current_chunk) > chunk_size:
+                yield current_chunk[:chunk_size].strip()
+                current_chunk = current_chunk[chunk_size-overlap:].strip()
+    
+    if current_chunk:
+        yield current_chunk.strip()
+
+def chunk_document(content: Union[str, Iterable[str]]) -> Tuple[List[str], str]:
+    """
+    Chunk a document and hash it in one pass.
+    
+    The hash covers the document's text and the chunking settings it is
+    split with, so documents indexed under other settings count as changed
+    and are re-chunked on the next upload.
+    
+    Args:
+        content: The document text, or consecutive pieces of it
+        
+    Returns:
+        (chunks, content_hash)
+    """
+    if isinstance(content, str):
+        content = [content]
+    digest = _document_digest()
+    def hashed_pieces() -> Iterator[str]:
+        for piece in content:
+            digest.update(piece.encode('utf-8'))
+            yield piece
+    chunks = list(iter_chunks(hashed_pieces()))
+    return chunks, digest.hexdigest()
+
+def _document_digest():
+    """SHA-256 object seeded with the chunking settings, for chunk_document."""
+    return hashlib.sha256(f"{CHUNK_SIZE}:{CHUNK_OVERLAP}\0".encode('utf-8'))
+
+def _tokenize(text: str) -> List[str]:
+    """Lowercase and split text into word terms, as used by the keyword index."""
+    return TOKEN_PATTERN.findall(text.lower())
+
+def _term_counts(text: str) -> Tuple[Dict[str, int], int]:
+    """Count term frequencies in a chunk, returning them with the chunk length."""
+    terms = _tokenize(text)
+    term_counts: Dict[str, int] = {}
+    for term in terms:
+        term_counts[term] = term_counts.get(term, 0) + 1
+    return term_counts, len(terms)
+
+def _load_array(path: str) -> np.ndarray:
+    """Memory-map a .npy file, reading it normally when it is empty."""
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # Zero-length arrays cannot be memory-mapped
+        return np.load(path)
+
+def _save_array(path: str, array: np.ndarray) -> None:
+    """Write a .npy file and flush it to disk."""
+    with open(path, 'wb') as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _string_table(strings: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+    """Pack byte strings into an offsets array and one contiguous byte array."""
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    if strings:
+        np.cumsum([len(s) for s in strings], out=offsets[1:])
+    data = np.frombuffer(b"".join(strings), dtype=np.uint8)
+    return offsets, data
+
+class _ReadWriteLock:
+    """
+    Lets many threads read or one thread write, preferring waiting writers.
+    
+    A thread holding the write lock may take either lock again, and a thread
+    holding the read lock may take it again even while a writer waits. A
+    read lock can't be upgraded to a write lock.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._waiting_writers = 0
+        self._writer: Optional[int] = None
+        self._local = threading.local()
+    
+    @contextmanager
+    def read(self):
+        if self._writer == threading.get_ident():
+            yield
+            return
+        depth = getattr(self._local, "depth", 0)
+        if not depth:
+            with self._cond:
+                while self._writer is not None or self._waiting_writers:
+                    self._cond.wait()
+                self._readers += 1
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            if not depth:
+                with self._cond:
+                    self._readers -= 1
+                    if not self._readers:
+                        self._cond.notify_all()
+    
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        if getattr(self._local, "depth", 0):
+            raise RuntimeError("A read lock can't be upgraded to a write lock")
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+class _FileLock:
+    """
+    Advisory flock on a lock file, shared between processes.
+    
+    Sections nested inside one that already holds the lock run without
+    taking it again, so callers must only use it from one thread at a time
+    (the store does so under its in-process write lock) and never nest an
+    exclusive section inside a shared one.
+    """
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._fd: Optional[int] = None
+        self._held = False
+    
+    @contextmanager
+    def hold(self, exclusive: bool):
+        if self.path is None or not fcntl_available or self._held:
+            yield
+            return
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        self._held = True
+        try:
+            yield
+        finally:
+            self._held = False
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+class _StringTable:
+    """Read-only sequence view over a packed string table."""
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+    
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+    
+    def __getitem__(self, i: int) -> bytes:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+class _Segment:
+    """
+    An immutable, memory-mapped snapshot of the index.
+    
+    Chunks are stored as rows grouped by document and ordered by position.
+    Text and the sorted term vocabulary are packed string tables, and each
+    term's postings are a slice of parallel row / term-frequency arrays, so
+    opening a segment only maps files and reads the small document table.
+    """
+    FORMAT_VERSION = 1
+    
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), 'r') as f:
+            meta = json.load(f)
+        if meta["format"] != self.FORMAT_VERSION:
+            raise ValueError(f"Unsupported index segment format: {meta['format']}")
+        self.generation = meta["generation"]
+        self.total_length = meta["total_length"]
+        
+        # Document table: paths, and md5 ids as used in chunk ids
+        self.doc_paths: List[str] = meta["docs"]
+        self.doc_names = [os.path.basename(doc_path) for doc_path in self.doc_paths]
+        self.doc_index = {hashlib.md5(doc_path.encode()).hexdigest(): i
+                          for i, doc_path in enumerate(self.doc_paths)}
+        self.doc_offsets = _load_array(os.path.join(path, "doc_offsets.npy"))
+        
+        # Per-chunk arrays
+        self.chunk_doc = _load_array(os.path.join(path, "chunk_doc.npy"))
+        self.chunk_position = _load_array(os.path.join(path, "chunk_position.npy"))
+        self.chunk_length = _load_array(os.path.join(path, "chunk_length.npy"))
+        # Content hash of each document, for skipping unchanged re-uploads
+        self.doc_hashes: Dict[str, str] = meta.get("doc_hashes", {})
+        self.text = _StringTable(_load_array(os.path.join(path, "text_offsets.npy")),
+                                 _load_array(os.path.join(path, "text.npy")))
+        
+        # Sorted vocabulary and postings
+        self.terms = _StringTable(_load_array(os.path.join(path, "term_offsets.npy")),
+                                  _load_array(os.path.join(path, "terms.npy")))
+        self.postings_offsets = _load_array(os.path.join(path, "postings_offsets.npy"))
+        self.postings_rows = _load_array(os.path.join(path, "postings_rows.npy"))
+        self.postings_tfs = _load_array(os.path.join(path, "postings_tfs.npy"))
+        self._term_ids: Dict[str, int] = {}
+        
+        # Dense vectors per row, and the embedder that produced them
+        self.embedder_name = meta.get("embedder")
+        vectors_file = os.path.join(path, "vectors.npy")
+        self.vectors = _load_array(vectors_file) if os.path.exists(vectors_file) else None
+        
+        self.num_chunks = len(self.chunk_doc)
+        self.nbytes = self.text.data.nbytes + self.postings_rows.nbytes + self.postings_tfs.nbytes
+    
+    def term_id(self, term: str) -> int:
+        """Binary search the vocabulary for a term, returning -1 if absent."""
+        term_id = self._term_ids.get(term)
+        if term_id is None:
+            key = term.encode('utf-8')
+            term_id = bisect.bisect_left(self.terms, key)
+            if term_id == len(self.terms) or self.terms[term_id] != key:
+                term_id = -1
+            self._term_ids[term] = term_id
+        return term_id
+    
+    def postings(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the (rows, term frequencies) arrays for a term."""
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return self.postings_rows[:0], self.postings_tfs[:0]
+        start, end = self.postings_offsets[term_id], self.postings_offsets[term_id + 1]
+        return self.postings_rows[start:end], self.postings_tfs[start:end]
+    
+    def doc_freq(self, term: str) -> int:
+        """Number of chunks in the segment containing a term."""
+        term_id = self.term_id(term)
+        if term_id < 0:
+            return 0
+        return int(self.postings_offsets[term_id + 1] - self.postings_offsets[term_id])
+    
+    def doc_rows(self, doc_idx: int) -> range:
+        """Rows belonging to a document."""
+        return range(int(self.doc_offsets[doc_idx]), int(self.doc_offsets[doc_idx + 1]))
+    
+    def find_row(self, chunk_id: str) -> int:
+        """Return the row holding a chunk id, or -1 if it isn't in the segment."""
+        doc_id, _, position = chunk_id.rpartition("_")
+        doc_idx = self.doc_index.get(doc_id)
+        if doc_idx is None:
+            return -1
+        rows = self.doc_rows(doc_idx)
+        positions = self.chunk_position[rows.start:rows.stop]
+        i = int(np.searchsorted(positions, int(position)))
+        if i < len(positions) and positions[i] == int(position):
+            return rows.start + i
+        return -1
+    
+    def chunk_text(self, row: int) -> str:
+        return self.text[row].decode('utf-8')
+    
+    def chunk_id(self, row: int) -> str:
+        doc_id = hashlib.md5(self.doc_paths[self.chunk_doc[row]].encode()).hexdigest()
+        return f"{doc_id}_{self.chunk_position[row]}"
+
+def _embed_rows(embedder, segment: _Segment, rows) -> np.ndarray:
+    """Embed the text of segment rows in batches."""
+    rows = list(rows)
+    vectors = np.zeros((len(rows), embedder.dim), dtype=np.float32)
+    for start in range(0, len(rows), EMBED_BATCH_SIZE):
+        batch = rows[start:start + EMBED_BATCH_SIZE]
+        vectors[start:start + len(batch)] = embedder.embed_documents([segment.chunk_text(row) for row in batch])
+    return vectors
+
+def _write_segment(path: str, generation: int, segment: Optional[_Segment],
+                   live_rows: Optional[np.ndarray], overlay: Dict[str, Dict[str, Any]],
+                   embedder, segment_vectors: Optional[np.ndarray],
+                   overlay_vectors: Dict[str, np.ndarray],
+                   doc_hashes: Optional[Dict[str, str]] = None) -> None:
+    """
+    Merge a segment's live rows with overlay chunks into a new segment at path.
+    
+    Postings of the old segment are remapped with array operations; only
+    overlay chunks are re-tokenized, so the cost of a merge is dominated by
+    copying, not by re-analyzing the whole corpus. Dense vectors are copied
+    the same way, and only embedded when segment_vectors is not given.
+    """
+    # Group surviving chunks by document: old segment rows first, then overlay chunks
+    doc_paths: List[str] = []
+    doc_chunks: Dict[str, List[Tuple[int, int, Optional[str]]]] = {}
+    if segment is not None:
+        for doc_idx, doc_path in enumerate(segment.doc_paths):
+            rows = segment.doc_rows(doc_idx)
+            live = np.flatnonzero(live_rows[rows.start:rows.stop]) + rows.start
+            if len(live):
+                doc_paths.append(doc_path)
+                positions = segment.chunk_position[live].tolist()
+                doc_chunks[doc_path] = [(position, row, None) for position, row in zip(positions, live.tolist())]
+    for chunk_id, chunk_data in overlay.items():
+        doc_path = chunk_data["doc_path"]
+        if doc_path not in doc_chunks:
+            doc_paths.append(doc_path)
+            doc_chunks[doc_path] = []
+        doc_chunks[doc_path].append((chunk_data["position"], -1, chunk_id))
+    
+    # Lay out the new rows
+    doc_offsets = np.zeros(len(doc_paths) + 1, dtype=np.int64)
+    chunk_doc: List[int] = []
+    chunk_position: List[int] = []
+    old_rows: List[int] = []
+    texts: List[bytes] = []
+    new_chunk_ids: List[Tuple[int, str]] = []
+    for doc_idx, doc_path in enumerate(doc_paths):
+        for position, old_row, chunk_id in sorted(doc_chunks[doc_path], key=lambda c: c[0]):
+            new_row = len(chunk_doc)
+            chunk_doc.append(doc_idx)
+            chunk_position.append(position)
+            old_rows.append(old_row)
+            if chunk_id is None:
+                texts.append(segment.text[old_row])
+            else:
+                texts.append(overlay[chunk_id]["content"].encode('utf-8'))
+                new_chunk_ids.append((new_row, chunk_id))
+        doc_offsets[doc_idx + 1] = len(chunk_doc)
+    num_chunks = len(chunk_doc)
+    old_rows_array = np.array(old_rows, dtype=np.int64)
+    from_segment = old_rows_array >= 0
+    
+    # Chunk lengths: copied for old rows, computed for overlay chunks
+    chunk_length = np.zeros(num_chunks, dtype=np.int32)
+    
+    # Dense vectors: copied (or embedded) for old rows, taken from the overlay otherwise
+    vectors = np.zeros((num_chunks, embedder.dim), dtype=np.float32)
+    if segment is not None and from_segment.any():
+        old = old_rows_array[from_segment]
+        if segment_vectors is not None:
+            vectors[from_segment] = segment_vectors[old]
+        else:
+            vectors[from_segment] = _embed_rows(embedder, segment, old.tolist())
+    for new_row, chunk_id in new_chunk_ids:
+        vectors[new_row] = overlay_vectors[chunk_id]
+    
+    # Postings as parallel (term, row, tf) arrays
+    term_parts: List[np.ndarray] = []
+    row_parts: List[np.ndarray] = []
+    tf_parts: List[np.ndarray] = []
+    vocabulary: Dict[str, int] = {}
+    if segment is not None and segment.num_chunks:
+        chunk_length[from_segment] = segment.chunk_length[old_rows_array[from_segment]]
+        remap = np.full(segment.num_chunks, -1, dtype=np.int64)
+        remap[old_rows_array[from_segment]] = np.flatnonzero(from_segment)
+        old_terms = [segment.terms[i].decode('utf-8') for i in range(len(segment.terms))]
+        vocabulary = {term: i for i, term in enumerate(old_terms)}
+        term_ids = np.repeat(np.arange(len(old_terms), dtype=np.int64), np.diff(segment.postings_offsets))
+        rows = remap[segment.postings_rows]
+        keep = rows >= 0
+        term_parts.append(term_ids[keep])
+        row_parts.append(rows[keep])
+        tf_parts.append(np.asarray(segment.postings_tfs)[keep].astype(np.int64))
+    overlay_terms: List[int] = []
+    overlay_rows: List[int] = []
+    overlay_tfs: List[int] = []
+    for new_row, chunk_id in new_chunk_ids:
+        term_counts, length = _term_counts(overlay[chunk_id]["content"])
+        chunk_length[new_row] = length
+        for term, count in term_counts.items():
+            overlay_terms.append(vocabulary.setdefault(term, len(vocabulary)))
+            overlay_rows.append(new_row)
+            overlay_tfs.append(count)
+    term_parts.append(np.array(overlay_terms, dtype=np.int64))
+    row_parts.append(np.array(overlay_rows, dtype=np.int64))
+    tf_parts.append(np.array(overlay_tfs, dtype=np.int64))
+    all_terms = np.concatenate(term_parts)
+    all_rows = np.concatenate(row_parts)
+    all_tfs = np.concatenate(tf_parts)
+    
+    # Renumber terms in sorted order, dropping terms with no remaining postings
+    term_strings = list(vocabulary)
+    counts = np.bincount(all_terms, minlength=len(term_strings))
+    sorted_terms = sorted((term for term, i in vocabulary.items() if counts[i]),
+                          key=lambda t: t.encode('utf-8'))
+    renumber = np.full(len(term_strings), -1, dtype=np.int64)
+    for new_id, term in enumerate(sorted_terms):
+        renumber[vocabulary[term]] = new_id
+    all_terms = renumber[all_terms]
+    order = np.lexsort((all_rows, all_terms))
+    postings_offsets = np.zeros(len(sorted_terms) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(all_terms, minlength=len(sorted_terms)), out=postings_offsets[1:])
+    
+    # Write every file into a temporary directory, then rename it into place
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    text_offsets, text = _string_table(texts)
+    term_offsets, terms = _string_table([term.encode('utf-8') for term in sorted_terms])
+    arrays = {
+        "doc_offsets": doc_offsets,
+        "chunk_doc": np.array(chunk_doc, dtype=np.int32),
+        "chunk_position": np.array(chunk_position, dtype=np.int32),
+        "chunk_length": chunk_length,
+        "text_offsets": text_offsets,
+        "text": text,
+        "term_offsets": term_offsets,
+        "terms": terms,
+        "postings_offsets": postings_offsets,
+        "postings_rows": all_rows[order].astype(np.int32),
+        "postings_tfs": all_tfs[order].astype(np.int32),
+        "vectors": vectors,
+    }
+    for name, array in arrays.items():
+        _save_array(os.path.join(tmp_path, f"{name}.npy"), array)
+    # Persist the configured ANN structure (if any) next to the vectors
+    build_dense_index(vectors).save(tmp_path)
+    meta = {
+        "format": _Segment.FORMAT_VERSION,
+        "generation": generation,
+        "num_chunks": num_chunks,
+        "total_length": int(chunk_length.sum()),
+        "docs": doc_paths,
+        "doc_hashes": {doc_path: doc_hashes[doc_path] for doc_path in doc_paths
+                       if doc_hashes and doc_path in doc_hashes},
+        "embedder": embedder.name,
+    }
+    with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+def reciprocal_rank_fusion(rankings: Iterable[Tuple[float, Iterable[Any]]]) -> Dict[Any, float]:
+    """
+    Fuse rankings with reciprocal rank fusion.
+    
+    Args:
+        rankings: (weight, keys best first) pairs; a key at 1-based rank r
+            in a ranking gains weight / (RRF_K + r)
+        
+    Returns:
+        Dict[Any, float]: Fused score of every ranked key
+    """
+    fused: Dict[Any, float] = {}
+    for weight, keys in rankings:
+        for rank, key in enumerate(keys):
+            fused[key] = fused.get(key, 0.0) + weight / (RRF_K + rank + 1)
+    return fused
+
+class VectorStoreBase(ABC):
+    """
+    Interface shared by the vector store backends.
+    
+    Backends rank chunks in _search_chunks; the public search methods here
+    are built on it. Each store also has a generation attribute, bumped
+    whenever its contents change, to invalidate cached results.
+    """
+    generation: int
+    
+    @abstractmethod
+    def reading(self):
+        """Context manager under which consecutive reads see one state of the index."""
+    
+    @abstractmethod
+    def refresh(self) -> bool:
+        """Catch up with changes other processes made on disk, returning True if any."""
+    
+    @abstractmethod
+    def compact(self) -> None:
+        """Rewrite the on-disk index to reclaim space and speed up loading."""
+    
+    @abstractmethod
+    def has_document(self, document_path: str) -> bool:
+        """Check whether any chunks of a document are indexed."""
+    
+    @abstractmethod
+    def add_document(self, document_path: str, content: Union[str, Iterable[str]]) -> bool:
+        """Add document content to the index, returning True if the index changed."""
+    
+    @abstractmethod
+    def add_chunked_documents(self, documents: List[Tuple[str, List[str], str]],
+                              vectors: Optional[List[np.ndarray]] = None) -> int:
+        """Add already chunked documents, returning how many changed the index."""
+    
+    @abstractmethod
+    def remove_document(self, document_path: str) -> None:
+        """Remove a document and its chunks from the index."""
+    
+    @abstractmethod
+    def _search_chunks(self, mode: str, query: str, top_k: int, doc_paths: Optional[List[str]],
+                       keyword_weight: float = HYBRID_KEYWORD_WEIGHT,
+                       dense_weight: float = HYBRID_DENSE_WEIGHT) -> List[Dict[str, Any]]:
+        """
+        Top chunks of a "keyword", "dense" or "hybrid" search, best first, as
+        dicts with content, doc_path, doc_name, position and score. Ties are
+        broken by document name and chunk position so results are stable
+        between calls.
+        """
+    
+    def search(self, query: str, top_k: int = 3, doc_paths: Optional[List[str]] = None) -> List[str]:
+        """
+        Rank chunks against the query with BM25.
+        
+        Args:
+            query: Query string to search for
+            top_k: Number of results to return
+            doc_paths: Optional document paths to restrict the search to
+        """
+        return [chunk["content"] for chunk in self._search_chunks("keyword", query, top_k, doc_paths)]
+    
+    def dense_search(self, query: str, top_k: int = 3, doc_paths: Optional[List[str]] = None) -> List[str]:
+        """
+        Rank chunks by embedding similarity to the query.
+        
+        Args:
+            query: Query string to search for
+            top_k: Number of results to return
+            doc_paths: Optional document paths to restrict the search to
+        """
+        return [chunk["content"] for chunk in self._search_chunks("dense", query, top_k, doc_paths)]
+    
+    def hybrid_search(self, query: str, top_k: int = 3, doc_paths: Optional[List[str]] = None,
+                      keyword_weight: float = HYBRID_KEYWORD_WEIGHT,
+                      dense_weight: float = HYBRID_DENSE_WEIGHT) -> List[str]:
+        """
+        Rank chunks by fusing keyword and dense rankings with reciprocal rank fusion.
+        
+        Args:
+            query: Query string to search for
+            top_k: Number of results to return
+            doc_paths: Optional document paths to restrict the search to
+            keyword_weight: Weight of the BM25 ranking in the fusion
+            dense_weight: Weight of the embedding ranking in the fusion
+        """
+        chunks = self._search_chunks("hybrid", query, top_k, doc_paths,
+                                     keyword_weight=keyword_weight, dense_weight=dense_weight)
+        return [chunk["content"] for chunk in chunks]
+    
+    def search_chunks(self, query: str, top_k: int = 3, doc_paths: Optional[List[str]] = None,
+                      mode: str = SEARCH_MODE) -> List[Dict[str, Any]]:
+        """
+        Rank chunks like search, dense_search or hybrid_search, with their metadata.
+        
+        Args:
+            query: Query string to search for
+            top_k: Number of results to return
+            doc_paths: Optional document paths to restrict the search to
+            mode: "keyword", "dense" or "hybrid"
+            
+        Returns:
+            List of dicts with content, doc_path, doc_name, position and score,
+            best first. Scores are only comparable within one mode.
+        """
+        return self._search_chunks(mode, query, top_k, doc_paths)
+
+class SimpleVectorStore(VectorStoreBase):
     """
     A simple vector store implementation that doesn't require external libraries.
     Used as a fallback when LangChain is not available.
+    
+    The index is an immutable memory-mapped segment plus an in-memory overlay
+    of the chunks added since it was written. Mutations go to an append-only
+    log; removing a segment chunk marks its row dead. Compaction merges the
+    overlay into a new segment and points CURRENT at it.
+    
+    Searches share a read lock; writers take the write lock plus an
+    exclusive file lock, so stores in any number of sessions and processes
+    apply their mutations one at a time on top of each other's.
+    
+    With directory=None the store is purely in memory: nothing is read or
+    written on disk and all chunks live in the overlay.
     """
-    def __init__(self, directory: str = "simple_vector_store"):
+    def __init__(self, directory: Optional[str] = "simple_vector_store"):
         self.directory = directory
-        os.makedirs(directory, exist_ok=True)
-        self.content_file = os.path.join(directory, "content.json")
-        self.index = self._load_index()
+        self.in_memory = directory is None
+        if self.in_memory:
+            self.current_file = self.log_file = self.content_file = None
+        else:
+            os.makedirs(directory, exist_ok=True)
+            # Names the live segment; replaced atomically by compaction
+            self.current_file = os.path.join(directory, "CURRENT")
+            # Mutations since the segment was written, one JSON record per line
+            self.log_file = os.path.join(directory, "content.log")
+            # Legacy JSON index, migrated to a segment on first load
+            self.content_file = os.path.join(directory, "content.json")
+        # Guards the in-memory index when the store is shared between sessions:
+        # searches share it, mutations and reloads take it exclusively
+        self._lock = _ReadWriteLock()
+        # Across processes, writers hold LOCK exclusively while they append
+        # or swap in a new segment, and loaders hold it shared, so a load
+        # never pairs a new CURRENT with an old log
+        self._file_lock = _FileLock(None if self.in_memory else os.path.join(directory, "LOCK"))
+        self._compacting = False
+        # Serializes compactions, in this process and across processes, as
+        # they write to the same temporary segment path
+        self._compaction_lock = threading.Lock()
+        self._compaction_file_lock = _FileLock(None if self.in_memory else os.path.join(directory, "COMPACT.lock"))
+        # Bumped whenever the in-memory index changes, to invalidate cached results
+        self.generation = 0
+        self.embedder = get_embedder()
+        with self._lock.write(), self._file_lock.hold(exclusive=False):
+            self._load()
+        if self._segment is None and self.content_file and os.path.exists(self.content_file):
+            self._migrate_json_index()
+        
+    def _load(self) -> None:
+        """(Re)build the in-memory index and keyword statistics from disk."""
+        self.generation += 1
+        self._signature = self._disk_signature()
+        self._segment = self._open_segment()
+        
+        # Rows of the segment that have not been removed or replaced
+        num_rows = self._segment.num_chunks if self._segment else 0
+        self._live_rows = np.ones(num_rows, dtype=bool)
+        # Per-term count of dead segment rows, to correct segment document frequencies
+        self._dead_doc_freq: Dict[str, int] = {}
+        
+        # Chunks added since the segment was written: chunk_id -> chunk data
+        self.overlay: Dict[str, Dict[str, Any]] = {}
+        # Inverted index of the overlay: term -> {chunk_id: term frequency}
+        self.postings: Dict[str, Dict[str, int]] = {}
+        # Overlay chunks of each document: doc_path -> {chunk_id}
+        self.doc_chunks: Dict[str, set] = {}
+        self.chunk_lengths: Dict[str, int] = {}
+        # Content hash of each indexed document: doc_path -> hash
+        self.doc_hashes: Dict[str, str] = dict(self._segment.doc_hashes) if self._segment else {}
         
-    def _load_index(self) -> Dict[str, Any]:
-        """Load the content index from disk."""
-        if os.path.exists(self.content_file):
+        # Dense vectors: the segment's are loaded on first use, the overlay's
+        # are kept in slots that are cleared (not reused) when a chunk is dropped
+        self._segment_vectors: Optional[np.ndarray] = None
+        self._segment_dense: Optional[DenseIndex] = None
+        self._overlay_dense = NumpyDenseIndex(self.embedder.dim)
+        self._overlay_dense_ids: List[Optional[str]] = []
+        self._overlay_dense_slot: Dict[str, int] = {}
+        # Which overlay slots hold a live chunk, grown alongside the slots
+        self._overlay_live = np.zeros(0, dtype=bool)
+        
+        # Corpus statistics for BM25 over all live chunks
+        self.num_chunks = num_rows
+        self.total_length = self._segment.total_length if self._segment else 0
+        
+        # Replay mutations logged since the segment was written, on top of
+        # the legacy JSON index if it hasn't been migrated yet
+        self._log_offset = 0
+        if self._segment is None and self.content_file and os.path.exists(self.content_file):
             with open(self.content_file, 'r') as f:
-                return json.load(f)
-        return {}
+                self._apply_record({"op": "add", "chunks": json.load(f)})
+        self._replay_log()
+    
+    def _open_segment(self) -> Optional[_Segment]:
+        """Memory-map the segment named by CURRENT, if there is one."""
+        if self.in_memory:
+            return None
+        try:
+            with open(self.current_file, 'r') as f:
+                current = json.load(f)
+        except FileNotFoundError:
+            return None
+        return _Segment(os.path.join(self.directory, current["segment"]))
+    
+    def _migrate_json_index(self) -> None:
+        """Convert a content.json index from earlier versions into a segment."""
+        with self._compaction_lock, self._compaction_file_lock.hold(exclusive=True):
+            # Another process opening the store may have migrated it first
+            if not os.path.exists(self.content_file):
+                self.refresh()
+                return
+            self._compact()
+            if self._segment is not None:
+                os.replace(self.content_file, self.content_file + ".migrated")
+    
+    def _replay_log(self) -> None:
+        """Apply complete log records written after the current log offset."""
+        if self.in_memory:
+            return
+        try:
+            with open(self.log_file, 'rb') as f:
+                f.seek(self._log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        
+        # A trailing partial line is an append still in progress (or torn by a crash)
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f"Skipping corrupt record in {self.log_file}")
+                continue
+            self._apply_record(record)
+        self._log_offset += end
+    
+    def _apply_record(self, record: Dict[str, Any], vectors: Optional[np.ndarray] = None) -> None:
+        """
+        Apply one logged mutation to the in-memory index.
+        
+        Records set or delete whole chunks, so replaying one that the segment
+        already reflects leaves the index unchanged. The vectors of the
+        record's chunks are computed unless given, in chunk order.
+        """
+        self.generation += 1
+        if record["op"] == "add":
+            chunks = record["chunks"]
+            if vectors is None:
+                vectors = self.embedder.embed_documents([chunk_data["content"] for chunk_data in chunks.values()])
+            for (chunk_id, chunk_data), vector in zip(chunks.items(), vectors):
+                self._drop_chunk(chunk_id)
+                self._index_chunk(chunk_id, chunk_data, vector)
+        elif record["op"] == "update":
+            # A changed document: stale chunks go and changed ones are
+            # (re)written together, so readers never see a half-updated document
+            for chunk_id in record["chunk_ids"]:
+                self._drop_chunk(chunk_id)
+            chunks = record["chunks"]
+            if vectors is None:
+                vectors = self.embedder.embed_documents([chunk_data["content"] for chunk_data in chunks.values()])
+            for (chunk_id, chunk_data), vector in zip(chunks.items(), vectors):
+                self._drop_chunk(chunk_id)
+                self._index_chunk(chunk_id, chunk_data, vector)
+            self.doc_hashes[record["doc_path"]] = record["content_hash"]
+        elif record["op"] == "remove":
+            for chunk_id in record["chunk_ids"]:
+                self._drop_chunk(chunk_id)
+            if "doc_path" in record:
+                self.doc_hashes.pop(record["doc_path"], None)
     
-    def _save_index(self) -> None:
-        """Save the content index to disk."""
-        with open(self.content_file, 'w') as f:
-            json.dump(self.index, f, indent=2)
+    @contextmanager
+    def _writing(self):
+        """Hold the in-process write lock and the cross-process writer lock."""
+        with self._lock.write(), self._file_lock.hold(exclusive=True):
+            yield
     
-    def add_document(self, document_path: str, content: str) -> None:
-        """Add document content to the index."""
+    def reading(self):
+        """
+        Context manager holding off writers, so several calls in a row see
+        the same generation of the index.
+        """
+        return self._lock.read()
+    
+    def _append_log(self, *records: Dict[str, Any],
+                    vectors: Optional[List[Optional[np.ndarray]]] = None) -> None:
+        """
+        Durably append mutation records with one write and fsync, then apply them in memory.
+        
+        Callers hold the writer locks, so the log can't change between
+        catching up with it and appending. vectors optionally holds
+        precomputed chunk vectors per record.
+        """
+        vectors = vectors or [None] * len(records)
+        if self.in_memory:
+            for record, record_vectors in zip(records, vectors):
+                self._apply_record(record, record_vectors)
+            return
+        lines = b"".join((json.dumps(record, separators=(',', ':')) + "\n").encode('utf-8')
+                         for record in records)
+        with open(self.log_file, 'ab') as f:
+            # With every writer holding the lock, bytes past the last complete
+            # record are a torn line left by a crash; drop it so it can't
+            # swallow these records
+            size = f.seek(0, os.SEEK_END)
+            if size > self._log_offset:
+                self._replay_log()
+                f.truncate(self._log_offset)
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_offset += len(lines)
+        for record, record_vectors in zip(records, vectors):
+            self._apply_record(record, record_vectors)
+        self._signature = self._disk_signature()
+        self._maybe_compact()
+    
+    def _maybe_compact(self) -> None:
+        """Start a background compaction once the log outgrows the segment."""
+        segment_size = self._segment.nbytes if self._segment else 0
+        threshold = max(LOG_COMPACT_MIN_BYTES, segment_size * LOG_COMPACT_RATIO)
+        if self._compacting or self._log_offset < threshold:
+            return
+        self._compacting = True
+        threading.Thread(target=self.compact, name="vector-store-compaction", daemon=True).start()
+    
+    def compact(self) -> None:
+        """
+        Merge the overlay and dead rows into a new segment.
+        
+        The segment is written outside the locks so searches and appends keep
+        running; records appended meanwhile, by any process, are carried over
+        to the new log.
+        CURRENT and the log are each replaced atomically, and a crash between
+        the two replacements only causes already-applied records to be replayed.
+        """
+        if self.in_memory:
+            return
+        with self._compaction_lock, self._compaction_file_lock.hold(exclusive=True):
+            self._compact()
+    
+    def _compact(self) -> None:
+        try:
+            self.refresh()
+            with self._lock.read():
+                segment = self._segment
+                live_rows = self._live_rows.copy()
+                overlay = dict(self.overlay)
+                overlay_vectors = {chunk_id: self._overlay_dense.vectors[slot].copy()
+                                   for chunk_id, slot in self._overlay_dense_slot.items()}
+                segment_vectors = self._segment_vectors
+                if segment_vectors is None and segment is not None and segment.embedder_name == self.embedder.name:
+                    segment_vectors = segment.vectors
+                doc_hashes = dict(self.doc_hashes)
+                snapshot_offset = self._log_offset
+                generation = (segment.generation if segment else 0) + 1
+            
+            segment_name = f"segment-{generation:08d}"
+            _write_segment(os.path.join(self.directory, segment_name), generation,
+                           segment, live_rows, overlay,
+                           self.embedder, segment_vectors, overlay_vectors, doc_hashes)
+            
+            with self._writing():
+                try:
+                    with open(self.log_file, 'rb') as f:
+                        f.seek(snapshot_offset)
+                        tail = f.read()
+                except FileNotFoundError:
+                    tail = b""
+                tmp_current = self.current_file + ".tmp"
+                with open(tmp_current, 'w') as f:
+                    json.dump({"generation": generation, "segment": segment_name}, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_current, self.current_file)
+                tmp_log = self.log_file + ".tmp"
+                with open(tmp_log, 'wb') as f:
+                    f.write(tail)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_log, self.log_file)
+                self._load()
+                
+                # Processes still reading the old segment keep their mappings
+                # open; new loads wait for the lock and see the new segment
+                if segment is not None:
+                    shutil.rmtree(segment.path, ignore_errors=True)
+        except Exception as e:
+            print(f"Error compacting vector store: {e}")
+        finally:
+            self._compacting = False
+    
+    def _disk_signature(self) -> Tuple[Optional[Tuple[int, int, int]], Optional[int]]:
+        """Identify the on-disk segment by CURRENT's inode, size and mtime, and the log by inode."""
+        if self.in_memory:
+            return None, None
+        try:
+            stat = os.stat(self.current_file)
+            current_signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            current_signature = None
+        try:
+            log_inode = os.stat(self.log_file).st_ino
+        except FileNotFoundError:
+            log_inode = None
+        return current_signature, log_inode
+    
+    def refresh(self) -> bool:
+        """
+        Catch up with changes another store instance or process made on disk.
+        
+        Records appended to the log are replayed incrementally; a new segment
+        or a rewritten log triggers a full reload.
+        
+        Returns:
+            bool: True if the in-memory index changed
+        """
+        if self.in_memory:
+            return False
+        # Checked without locks first, so searches only wait when there is something to load
+        if not self._disk_changed():
+            return False
+        with self._lock.write(), self._file_lock.hold(exclusive=False):
+            if self._disk_signature() != self._signature:
+                self._load()
+                return True
+            if not self._disk_changed():
+                return False
+            self._replay_log()
+            return True
+    
+    def _disk_changed(self) -> bool:
+        """Whether the on-disk index differs from what has been loaded."""
+        if self._disk_signature() != self._signature:
+            return True
+        try:
+            return os.path.getsize(self.log_file) > self._log_offset
+        except FileNotFoundError:
+            return False
+    
+    def _index_chunk(self, chunk_id: str, chunk_data: Dict[str, Any], vector: np.ndarray) -> None:
+        """Add a chunk to the overlay, its inverted index and its dense vectors."""
+        term_counts, length = _term_counts(chunk_data["content"])
+        for term, count in term_counts.items():
+            self.postings.setdefault(term, {})[chunk_id] = count
+        self.overlay[chunk_id] = chunk_data
+        self.doc_chunks.setdefault(chunk_data["doc_path"], set()).add(chunk_id)
+        self.chunk_lengths[chunk_id] = length
+        slot = self._overlay_dense.add(vector[np.newaxis])
+        self._overlay_dense_slot[chunk_id] = slot
+        self._overlay_dense_ids.append(chunk_id)
+        if slot >= len(self._overlay_live):
+            grown = np.zeros(max(slot + 1, 2 * len(self._overlay_live), 64), dtype=bool)
+            grown[:len(self._overlay_live)] = self._overlay_live
+            self._overlay_live = grown
+        self._overlay_live[slot] = True
+        self.num_chunks += 1
+        self.total_length += length
+    
+    def _drop_chunk(self, chunk_id: str) -> None:
+        """Remove a chunk from the overlay, or mark its segment row dead."""
+        chunk_data = self.overlay.pop(chunk_id, None)
+        if chunk_data is not None:
+            for term in set(_tokenize(chunk_data["content"])):
+                chunk_postings = self.postings.get(term)
+                if chunk_postings is None:
+                    continue
+                chunk_postings.pop(chunk_id, None)
+                if not chunk_postings:
+                    del self.postings[term]
+            slot = self._overlay_dense_slot.pop(chunk_id)
+            self._overlay_dense_ids[slot] = None
+            self._overlay_live[slot] = False
+            doc_chunk_ids = self.doc_chunks[chunk_data["doc_path"]]
+            doc_chunk_ids.discard(chunk_id)
+            if not doc_chunk_ids:
+                del self.doc_chunks[chunk_data["doc_path"]]
+            self.num_chunks -= 1
+            self.total_length -= self.chunk_lengths.pop(chunk_id, 0)
+            return
+        
+        row = self._segment.find_row(chunk_id) if self._segment else -1
+        if row < 0 or not self._live_rows[row]:
+            return
+        self._live_rows[row] = False
+        for term in set(_tokenize(self._segment.chunk_text(row))):
+            self._dead_doc_freq[term] = self._dead_doc_freq.get(term, 0) + 1
+        self.num_chunks -= 1
+        self.total_length -= int(self._segment.chunk_length[row])
+    
+    def _segment_doc_rows(self, document_path: str) -> range:
+        """Segment rows of a document, live or dead."""
+        if self._segment is None:
+            return range(0)
+        doc_idx = self._segment.doc_index.get(hashlib.md5(document_path.encode()).hexdigest())
+        if doc_idx is None:
+            return range(0)
+        return self._segment.doc_rows(doc_idx)
+    
+    def _document_chunk_ids(self, document_path: str) -> List[str]:
+        """Ids of all live chunks, in the segment or the overlay, of a document."""
+        chunk_ids = list(self.doc_chunks.get(document_path, ()))
+        for row in self._segment_doc_rows(document_path):
+            if self._live_rows[row]:
+                chunk_ids.append(self._segment.chunk_id(row))
+        return chunk_ids
+    
+    def _document_chunk_texts(self, document_path: str) -> Dict[str, str]:
+        """Live chunks of a document as chunk_id -> content."""
+        chunk_texts = {chunk_id: self.overlay[chunk_id]["content"]
+                       for chunk_id in self.doc_chunks.get(document_path, ())}
+        for row in self._segment_doc_rows(document_path):
+            if self._live_rows[row]:
+                chunk_texts[self._segment.chunk_id(row)] = self._segment.chunk_text(row)
+        return chunk_texts
+    
+    def _chunked_documents(self) -> List[Tuple[str, List[str], str]]:
+        """
+        Every indexed document as a (document_path, chunks, content_hash) tuple.
+        
+        Documents indexed before content hashes were recorded get an empty
+        hash, so re-uploading them still updates their chunks.
+        """
+        with self._lock.read():
+            doc_paths = set(self.doc_hashes) | set(self.doc_chunks)
+            if self._segment is not None:
+                doc_paths.update(self._segment.doc_paths)
+            documents = []
+            for document_path in sorted(doc_paths):
+                chunk_texts = self._document_chunk_texts(document_path)
+                if not chunk_texts:
+                    continue
+                positions = sorted(chunk_texts, key=lambda chunk_id: int(chunk_id.rpartition("_")[2]))
+                documents.append((document_path, [chunk_texts[chunk_id] for chunk_id in positions],
+                                  self.doc_hashes.get(document_path, "")))
+            return documents
+    
+    def has_document(self, document_path: str) -> bool:
+        """Check whether any chunks of a document are indexed."""
+        with self._lock.read():
+            if document_path in self.doc_chunks:
+                return True
+            rows = self._segment_doc_rows(document_path)
+            return bool(self._live_rows[rows.start:rows.stop].any())
+    
+    def add_document(self, document_path: str, content: Union[str, Iterable[str]]) -> bool:
+        """
+        Add document content to the index, or update a re-indexed document.
+        
+        Re-adding content identical to what is indexed does nothing. For
+        changed content only the chunks whose text differs are written, and
+        chunks past the new end of the document are removed, in one log record.
+        
+        Args:
+            document_path: Path identifying the document
+            content: The document text, or consecutive pieces of it such as
+                pages, which are chunked as they arrive
+        
+        Returns:
+            bool: True if the index changed
+        """
+        # Hash and chunk outside the lock
+        chunks, content_hash = chunk_document(content)
+        return self.add_chunked_documents([(document_path, chunks, content_hash)]) > 0
+    
+    def add_chunked_documents(self, documents: List[Tuple[str, List[str], str]],
+                              vectors: Optional[List[np.ndarray]] = None) -> int:
+        """
+        Add or update already chunked documents with a single durable log write.
+        
+        Each document is applied like add_document; documents without chunks
+        or with an unchanged content hash are skipped. Changed chunks are
+        embedded before the write lock is taken, so searches keep running
+        meanwhile; the diff is then recomputed under the lock, and only chunks
+        another writer changed in between are embedded while holding it.
+        
+        Args:
+            documents: (document_path, chunks, content_hash) tuples, as built
+                by chunk_document
+            vectors: Optional per-document (len(chunks), dim) matrices of chunk
+                vectors from this store's embedder, so they aren't computed here
+        
+        Returns:
+            int: Number of documents that changed the index
+        """
+        # Vectors computed so far: one {position: vector} map per document
+        known: List[Dict[int, np.ndarray]] = [{} for _ in documents]
+        if vectors is None:
+            self.refresh()
+            with self._lock.read():
+                changed = [self._update_record(*document)["chunks"]
+                           if document[1] and self.doc_hashes.get(document[0]) != document[2] else {}
+                           for document in documents]
+            for document_vectors, chunks in zip(known, changed):
+                if chunks:
+                    embedded = self.embedder.embed_documents([chunk_data["content"] for chunk_data in chunks.values()])
+                    document_vectors.update(zip((chunk_data["position"] for chunk_data in chunks.values()), embedded))
+        
+        with self._writing():
+            # Start from the latest on-disk state so other writers' chunks are kept
+            self.refresh()
+            records = []
+            record_vectors = []
+            for i, (document_path, chunks, content_hash) in enumerate(documents):
+                if not chunks or self.doc_hashes.get(document_path) == content_hash:
+                    continue
+                record = self._update_record(document_path, chunks, content_hash)
+                positions = [chunk_data["position"] for chunk_data in record["chunks"].values()]
+                if vectors is not None:
+                    record_vectors.append(vectors[i][positions])
+                else:
+                    missing = [position for position in positions if position not in known[i]]
+                    if missing:
+                        known[i].update(zip(missing, self.embedder.embed_documents([chunks[p] for p in missing])))
+                    record_vectors.append(np.array([known[i][position] for position in positions],
+                                                   dtype=np.float32).reshape(len(positions), self.embedder.dim))
+                records.append(record)
+            if records:
+                self._append_log(*records, vectors=record_vectors)
+            return len(records)
+    
+    def _update_record(self, document_path: str, chunks: List[str], content_hash: str) -> Dict[str, Any]:
+        """Log record turning a document's indexed chunks into the given ones."""
         doc_id = hashlib.md5(document_path.encode()).hexdigest()
-        chunks = self._split_text(content)
+        existing = self._document_chunk_texts(document_path)
         
-        # Store each chunk with its document info
+        # Store each changed chunk with its document info
+        new_chunks = {}
         for i, chunk in enumerate(chunks):
             chunk_id = f"{doc_id}_{i}"
-            self.index[chunk_id] = {
+            if existing.pop(chunk_id, None) == chunk:
+                continue
+            new_chunks[chunk_id] = {
                 "doc_path": document_path,
                 "doc_name": os.path.basename(document_path),
                 "content": chunk,
                 "position": i
             }
         
-        self._save_index()
+        # Whatever is left of the old chunks lies past the new end
+        return {"op": "update", "doc_path": document_path, "content_hash": content_hash,
+                "chunks": new_chunks, "chunk_ids": sorted(existing)}
     
     def _split_text(self, text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[str]:
         """Split text into overlapping chunks."""
-        if not text:
-            return []
-            
-        # Clean and normalize text
-        text = re.sub(r'\s+', ' ', text).strip()
+        return split_text(text, chunk_size, overlap)
+    
+    def _doc_freq(self, term: str) -> int:
+        """Number of live chunks containing a term."""
+        doc_freq = len(self.postings.get(term, ()))
+        if self._segment is not None:
+            doc_freq += self._segment.doc_freq(term) - self._dead_doc_freq.get(term, 0)
+        return doc_freq
+    
+    def _bm25_idf(self, term: str, stats: Optional[Dict[str, Any]] = None) -> float:
+        """Inverse document frequency of a term over the live chunks, or over the corpus stats describe."""
+        if stats is None:
+            num_chunks, doc_freq = self.num_chunks, self._doc_freq(term)
+        else:
+            num_chunks, doc_freq = stats["num_chunks"], stats["doc_freqs"].get(term, 0)
+        return math.log(1 + (num_chunks - doc_freq + 0.5) / (doc_freq + 0.5))
+    
+    def keyword_stats(self, query: str) -> Dict[str, Any]:
+        """
+        BM25 corpus statistics for a query, to score against several stores as one corpus.
         
-        # Split by sentences to avoid breaking in the middle of sentences
-        sentences = re.split(r'(?<=[.!?])\s+', text)
-        chunks = []
-        current_chunk = ""
+        Returns:
+            Dict with num_chunks, total_length and the doc_freqs of the query terms;
+            summed over stores, they can be passed to _keyword_scores
+        """
+        with self._lock.read():
+            return {
+                "num_chunks": self.num_chunks,
+                "total_length": self.total_length,
+                "doc_freqs": {term: self._doc_freq(term) for term in set(_tokenize(query))},
+            }
+    
+    
+    def _search_scope(self, doc_paths: Optional[List[str]]) -> Optional[Tuple[List[range], set]]:
+        """
+        Resolve a document filter to segment row ranges and overlay chunk ids.
         
-        for sentence in sentences:
-            if len(current_chunk) + len(sentence) <= chunk_size:
-                current_chunk += " " + sentence if current_chunk else sentence
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence
-                
-                # If a single sentence is longer than chunk_size, split it
-                while len(current_chunk) > chunk_size:
-                    chunks.append(current_chunk[:chunk_size].strip())
-                    current_chunk = current_chunk[chunk_size-overlap:].strip()
+        Returns None for an unscoped search.
+        """
+        if not doc_paths:
+            return None
+        doc_ranges = sorted((self._segment_doc_rows(doc_path) for doc_path in set(doc_paths)),
+                            key=lambda rows: rows.start)
+        scope_chunk_ids = set()
+        for doc_path in doc_paths:
+            scope_chunk_ids.update(self.doc_chunks.get(doc_path, ()))
+        return [rows for rows in doc_ranges if len(rows)], scope_chunk_ids
+    
+    def _segment_term_postings(self, term: str, scope: Optional[Tuple[List[range], set]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Live (rows, tfs) of a term in the segment, restricted to the search scope."""
+        rows, tfs = self._segment.postings(term)
+        if scope is not None:
+            # Postings rows are sorted, so each document is one slice
+            bounds = np.searchsorted(rows, [(r.start, r.stop) for r in scope[0]]).reshape(-1, 2)
+            rows = np.concatenate([rows[a:b] for a, b in bounds] or [rows[:0]])
+            tfs = np.concatenate([tfs[a:b] for a, b in bounds] or [tfs[:0]])
+        keep = self._live_rows[rows]
+        return rows[keep], tfs[keep]
+    
+    def _keyword_scores(self, query: str, scope: Optional[Tuple[List[range], set]],
+                        top_k: Optional[int] = None, stats: Optional[Dict[str, Any]] = None) -> Dict[Any, float]:
+        """
+        BM25 scores of the chunks matching the query.
+        Segment rows are keyed by row number, overlay chunks by chunk id.
+        Term frequencies and lengths come from this store; idf and the
+        average length from stats, as returned by keyword_stats, if given.
         
-        if current_chunk:
-            chunks.append(current_chunk.strip())
+        With top_k, MaxScore pruning is applied: terms are scored in order of
+        decreasing upper bound, and once the k-th best partial score exceeds
+        what the remaining terms could add to an unseen chunk, those terms
+        only update existing candidates instead of walking their postings.
+        The top_k entries are exact; lower-ranked chunks may be missing.
+        """
+        # Tokenize query into terms
+        query_terms = set(_tokenize(query))
+        if stats is None:
+            avg_length = self.total_length / self.num_chunks or 1.0
+        else:
+            avg_length = stats["total_length"] / stats["num_chunks"] or 1.0
+        segment = self._segment
+        
+        # BM25 term scores are below idf * (k1 + 1) whatever the tf and length
+        bounds = sorted(((self._bm25_idf(term, stats) * (BM25_K1 + 1), term) for term in query_terms), reverse=True)
+        remaining = [0.0] * (len(bounds) + 1)
+        for i in range(len(bounds) - 1, -1, -1):
+            remaining[i] = remaining[i + 1] + bounds[i][0]
+        
+        # Accumulate BM25 scores over each query term's postings
+        scores: Dict[Any, float] = {}
+        threshold = 0.0
+        for i, (bound, term) in enumerate(bounds):
+            idf = bound / (BM25_K1 + 1)
+            if top_k is not None and len(scores) >= top_k:
+                threshold = heapq.nlargest(top_k, scores.values())[-1]
+            # No chunk unseen so far can still reach the top_k
+            essential = top_k is None or len(scores) < top_k or remaining[i] >= threshold
+            if not essential:
+                # Drop candidates that cannot reach the threshold either
+                scores = {key: score for key, score in scores.items() if score + remaining[i] >= threshold}
+            
+            if segment is not None:
+                rows, tfs = self._segment_term_postings(term, scope)
+                if not essential:
+                    # Look up only the candidate rows in the sorted postings
+                    candidates = np.fromiter((key for key in scores if not isinstance(key, str)), dtype=np.int64)
+                    candidates.sort()
+                    found = np.minimum(np.searchsorted(rows, candidates), max(len(rows) - 1, 0))
+                    found = found[rows[found] == candidates] if len(rows) else found[:0]
+                    rows, tfs = rows[found], tfs[found]
+                length_norm = 1 - BM25_B + BM25_B * segment.chunk_length[rows] / avg_length
+                term_scores = idf * tfs * (BM25_K1 + 1) / (tfs + BM25_K1 * length_norm)
+                for row, term_score in zip(rows.tolist(), term_scores.tolist()):
+                    scores[row] = scores.get(row, 0.0) + term_score
             
-        return chunks
+            chunk_postings = self.postings.get(term, {})
+            if not essential:
+                chunk_postings = {key: chunk_postings[key] for key in scores
+                                  if isinstance(key, str) and key in chunk_postings}
+            elif scope is not None:
+                chunk_postings = {chunk_id: chunk_postings[chunk_id]
+                                  for chunk_id in scope[1] if chunk_id in chunk_postings}
+            for chunk_id, tf in chunk_postings.items():
+                length_norm = 1 - BM25_B + BM25_B * self.chunk_lengths[chunk_id] / avg_length
+                term_score = idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * length_norm)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + term_score
+        return scores
     
-    def search(self, query: str, top_k: int = 3) -> List[str]:
+    def _segment_vectors_matrix(self) -> Optional[np.ndarray]:
         """
-        Simple search functionality that looks for keyword matches.
-        Returns the top k chunks that contain the most terms from the query.
+        Dense vectors of the segment's rows.
+        
+        Uses the vectors stored in the segment when they came from the current
+        embedder; otherwise the rows are embedded once here, and the next
+        compaction stores the result.
         """
-        if not self.index:
+        segment = self._segment
+        if segment is None:
+            return None
+        if self._segment_vectors is None:
+            if segment.vectors is not None and segment.embedder_name == self.embedder.name:
+                self._segment_vectors = segment.vectors
+            else:
+                self._segment_vectors = _embed_rows(self.embedder, segment, range(segment.num_chunks))
+        return self._segment_vectors
+    
+    def _segment_dense_index(self) -> Optional[DenseIndex]:
+        """Dense index over the segment's rows, loaded from the segment when persisted."""
+        vectors = self._segment_vectors_matrix()
+        if vectors is None:
+            return None
+        if self._segment_dense is None:
+            if vectors is self._segment.vectors:
+                self._segment_dense = load_dense_index(self._segment.path, vectors)
+            else:
+                self._segment_dense = build_dense_index(vectors)
+        return self._segment_dense
+    
+    def _dense_scores(self, query: str, top_k: int, scope: Optional[Tuple[List[range], set]]) -> Dict[Any, float]:
+        """
+        Cosine similarity of the top_k chunks nearest to the query embedding,
+        keyed like _keyword_scores. Chunks below DENSE_MIN_SIMILARITY are left out.
+        """
+        query_vector = self.embedder.embed_query(query)
+        scores: Dict[Any, float] = {}
+        
+        segment_index = self._segment_dense_index()
+        if segment_index is not None:
+            candidates = None
+            if scope is not None:
+                candidates = np.concatenate([np.arange(r.start, r.stop) for r in scope[0]] or [np.zeros(0, dtype=np.int64)])
+            rows, row_scores = segment_index.search(query_vector, top_k, live=self._live_rows, candidates=candidates)
+            scores.update(zip(rows.tolist(), row_scores.tolist()))
+        
+        if self.overlay:
+            candidates = None
+            if scope is not None:
+                candidates = np.array([self._overlay_dense_slot[chunk_id] for chunk_id in scope[1]], dtype=np.int64)
+            slots, slot_scores = self._overlay_dense.search(query_vector, top_k, live=self._overlay_live, candidates=candidates)
+            scores.update((self._overlay_dense_ids[slot], score)
+                          for slot, score in zip(slots.tolist(), slot_scores.tolist()))
+        return {key: score for key, score in scores.items() if score >= DENSE_MIN_SIMILARITY}
+    
+    def _rank(self, scores: Dict[Any, float], top_k: int) -> List[Any]:
+        """Order the top_k scored chunks by score (descending), then document order."""
+        if top_k <= 0 or not scores:
             return []
-            
-        # Tokenize query into terms
-        query_terms = set(re.findall(r'\b\w+\b', query.lower()))
+        # Bounded heap selection of the k-th best score, then only the chunks
+        # at or above it (ties included) are sorted with the full tie-break
+        if len(scores) > top_k:
+            cutoff = heapq.nlargest(top_k, scores.values())[-1]
+            scores = {key: score for key, score in scores.items() if score >= cutoff}
         
-        # Score each chunk based on term matches
+        segment = self._segment
         results = []
-        for chunk_id, chunk_data in self.index.items():
-            content = chunk_data["content"].lower()
-            match_count = sum(1 for term in query_terms if term in content)
-            if match_count > 0:
-                results.append((chunk_data["content"], match_count))
+        for key, score in scores.items():
+            if isinstance(key, str):
+                chunk_data = self.overlay[key]
+                results.append((-score, chunk_data["doc_name"], chunk_data["position"], key))
+            else:
+                results.append((-score, segment.doc_names[segment.chunk_doc[key]],
+                                int(segment.chunk_position[key]), key))
+        results.sort(key=lambda x: x[:3])
+        return [key for _, _, _, key in results[:top_k]]
+    
+    def _chunk_text(self, key: Any) -> str:
+        """Text of a chunk given its segment row or overlay chunk id."""
+        if isinstance(key, str):
+            return self.overlay[key]["content"]
+        return self._segment.chunk_text(key)
+    
+    def _chunk_info(self, key: Any, score: float) -> Dict[str, Any]:
+        """Content, source document, position and score of a ranked chunk."""
+        if isinstance(key, str):
+            chunk_data = self.overlay[key]
+            doc_path, doc_name, position = chunk_data["doc_path"], chunk_data["doc_name"], chunk_data["position"]
+        else:
+            doc = self._segment.chunk_doc[key]
+            doc_path, doc_name = self._segment.doc_paths[doc], self._segment.doc_names[doc]
+            position = int(self._segment.chunk_position[key])
+        return {
+            "content": self._chunk_text(key),
+            "doc_path": doc_path,
+            "doc_name": doc_name,
+            "position": position,
+            "score": score,
+        }
+    
+    def _fused_scores(self, query: str, top_k: int, scope: Optional[Tuple[List[range], set]],
+                      keyword_weight: float = HYBRID_KEYWORD_WEIGHT,
+                      dense_weight: float = HYBRID_DENSE_WEIGHT) -> Dict[Any, float]:
+        """
+        Reciprocal rank fusion of the keyword and dense rankings; empty if
+        no chunk matches the query's terms.
         
-        # Sort by match count (descending)
-        results.sort(key=lambda x: x[1], reverse=True)
+        Both retrievers run concurrently over the same chunks: the keyword
+        ranking on the shared retrieval thread pool, the dense one (whose
+        matrix product releases the GIL) on the calling thread. The lock is
+        held by the caller throughout, so neither sees a partial update.
+        """
+        depth = max(top_k, HYBRID_CANDIDATES)
         
-        # Return top k chunks
-        return [result[0] for result in results[:top_k]]
+        keyword_future = _retrieval_executor.submit(
+            lambda: self._rank(self._keyword_scores(query, scope, depth), depth))
+        dense_keys = self._rank(self._dense_scores(query, depth, scope), depth)
+        keyword_keys = keyword_future.result()
+        if not keyword_keys:
+            return {}
+        return reciprocal_rank_fusion([(keyword_weight, keyword_keys), (dense_weight, dense_keys)])
+    
+    def _ranked(self, mode: str, query: str, top_k: int, doc_paths: Optional[List[str]],
+                **weights: float) -> List[Tuple[Any, float]]:
+        """Top (key, score) pairs of a "keyword", "dense" or "hybrid" search. Caller holds the lock."""
+        if not self.num_chunks:
+            return []
+        scope = self._search_scope(doc_paths)
+        if mode == "keyword":
+            scores = self._keyword_scores(query, scope, top_k)
+        elif mode == "dense":
+            scores = self._dense_scores(query, top_k, scope)
+        elif mode == "hybrid":
+            scores = self._fused_scores(query, top_k, scope, **weights)
+        else:
+            raise ValueError(f"Unknown search mode: {mode}")
+        return [(key, scores[key]) for key in self._rank(scores, top_k)]
+    
+    def _search_chunks(self, mode: str, query: str, top_k: int, doc_paths: Optional[List[str]],
+                       **weights: float) -> List[Dict[str, Any]]:
+        """
+        Top chunks of a search, with their metadata.
+        
+        Keyword searches only visit the postings of the query terms, so the
+        cost depends on how many chunks contain those terms rather than on
+        corpus size.
+        """
+        with self._lock.read():
+            return [self._chunk_info(key, score) for key, score in self._ranked(mode, query, top_k, doc_paths, **weights)]
     
     def remove_document(self, document_path: str) -> None:
         """Remove a document and its chunks from the index."""
-        doc_id = hashlib.md5(document_path.encode()).hexdigest()
-        new_index = {}
+        with self._writing():
+            # Start from the latest on-disk state so other writers' chunks are kept
+            self.refresh()
+            
+            # Tombstone the chunks that belong to the removed document
+            chunk_ids = self._document_chunk_ids(document_path)
+            if chunk_ids or document_path in self.doc_hashes:
+                self._append_log({"op": "remove", "doc_path": document_path, "chunk_ids": chunk_ids})
+
+# Threads that run retrievers in parallel for hybrid search
+_retrieval_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval")
+
+# Process-wide store instances, shared across Streamlit reruns and sessions
+_shared_stores: Dict[str, VectorStoreBase] = {}
+_shared_stores_lock = threading.Lock()
+
+# Files whose presence means a directory holds a SimpleVectorStore index
+SIMPLE_STORE_FILES = ("CURRENT", "content.log", "content.json")
+
+def _has_simple_store(directory: str) -> bool:
+    """Check whether a directory holds a SimpleVectorStore index."""
+    return any(os.path.exists(os.path.join(directory, name)) for name in SIMPLE_STORE_FILES)
+
+def migrate_simple_store(directory: str, vector_store: VectorStoreBase) -> int:
+    """
+    Copy the SimpleVectorStore index in a directory into another backend's store.
+    
+    Without this, switching VECTOR_STORE_BACKEND on an existing index would
+    serve an empty one. The simple store's files are then renamed with a
+    .migrated suffix, as content.json is when it is converted, so this runs
+    once; renaming them back restores the simple store.
+    
+    Args:
+        directory: Directory that may hold a simple store's index files
+        vector_store: Store to copy the documents into
         
-        # Keep only chunks that don't belong to the removed document
-        for chunk_id, chunk_data in self.index.items():
-            if not chunk_id.startswith(doc_id):
-                new_index[chunk_id] = chunk_data
+    Returns:
+        int: Number of documents migrated
+    """
+    if not _has_simple_store(directory):
+        return 0
+    simple_store = SimpleVectorStore(directory)
+    with simple_store._writing():
+        # Another process may have migrated the store while this one loaded it
+        if not _has_simple_store(directory):
+            return 0
+        simple_store.refresh()
+        documents = simple_store._chunked_documents()
+        print(f"Migrating {len(documents)} documents from the simple vector store in {directory}")
+        vector_store.add_chunked_documents(documents)
+        for name in SIMPLE_STORE_FILES:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                os.replace(path, path + ".migrated")
+    return len(documents)
+
+def _open_vector_store(directory: str) -> VectorStoreBase:
+    """Open the store in a directory with the configured VECTOR_STORE_BACKEND."""
+    if VECTOR_STORE_BACKEND == "sqlite":
+        # Imported here: the SQLite store builds on this module
+        from utils.sqlite_store import SQLITE_STORE_FILE, SQLiteVectorStore, fts5_available
+        if fts5_available():
+            vector_store = SQLiteVectorStore(os.path.join(directory, SQLITE_STORE_FILE))
+            migrate_simple_store(directory, vector_store)
+            return vector_store
+        print("SQLite was built without FTS5; using the simple vector store")
+    elif VECTOR_STORE_BACKEND == "sharded":
+        from utils.sharded_store import ShardedVectorStore
+        vector_store = ShardedVectorStore(directory)
+        migrate_simple_store(directory, vector_store)
+        return vector_store
+    elif VECTOR_STORE_BACKEND != "simple":
+        print(f"Unknown vector store backend {VECTOR_STORE_BACKEND!r}; using the simple vector store")
+    return SimpleVectorStore(directory)
+
+def get_vector_store(directory: str = "simple_vector_store") -> VectorStoreBase:
+    """
+    Return the long-lived store for a directory, creating it on first use.
+    
+    The store is parsed from disk once per process and only reloaded when the
+    on-disk index changes, so callers don't pay for a full load on every query.
+    
+    Args:
+        directory: Directory holding the store's index files
         
-        self.index = new_index
-        self._save_index()
+    Returns:
+        The shared store instance: a SimpleVectorStore, or the
+        SQLiteVectorStore or ShardedVectorStore VECTOR_STORE_BACKEND selects
+    """
+    key = os.path.abspath(directory)
+    with _shared_stores_lock:
+        vector_store = _shared_stores.get(key)
+        if vector_store is None:
+            vector_store = _open_vector_store(directory)
+            _shared_stores[key] = vector_store
+            return vector_store
+    
+    vector_store.refresh()
+    return vector_store
 
-def extract_text_from_pdf(file_path: str) -> str:
-    """Extract text from a PDF file."""
+class QueryCache:
+    """
+    Bounded LRU cache of search results with a time-to-live.
+    
+    Keys include the store's generation, so results computed before an add
+    or remove are never returned again; they simply age out of the LRU.
+    """
+    def __init__(self, max_entries: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, Tuple[float, List[Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: tuple) -> Optional[List[Any]]:
+        """Return the cached results for key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+    
+    def put(self, key: tuple, results: List[Any]) -> None:
+        """Store results for key, evicting the least recently used entries."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), list(results))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        """Drop all entries and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and current size, for monitoring."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+_query_cache = QueryCache()
+
+def get_query_cache_stats() -> Dict[str, Any]:
+    """
+    Return the search_index cache counters.
+    
+    Returns:
+        Dict with hits, misses, hit_rate, entries and max_entries
+    """
+    return _query_cache.stats()
+
+def _normalize_query(query: str) -> str:
+    """Case-fold and collapse whitespace so trivially different queries share a cache entry."""
+    return " ".join(query.casefold().split())
+
+class ExtractionCache:
+    """
+    On-disk cache of text extracted from documents.
+    
+    Entries are keyed by the SHA-256 of the file bytes together with the
+    file type and extractor version, so identical uploads skip parsing
+    whatever their name, and upgrading an extractor invalidates its entries.
+    A hit refreshes the entry's mtime; once the cache outgrows max_bytes the
+    least recently used entries are deleted.
+    """
+    def __init__(self, directory: str = EXTRACTION_CACHE_DIR, max_bytes: int = EXTRACTION_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+    
+    def key(self, file_path: str, ext: str) -> str:
+        """Cache key of a file: extractor version, file type and content hash."""
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return f"{_extractor_version(ext)}-{ext.lstrip('.')}-{digest.hexdigest()}"
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached text for key, or None on a miss."""
+        path = os.path.join(self.directory, key + ".txt")
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            os.utime(path)
+        except (FileNotFoundError, UnicodeDecodeError):
+            return None
+        return text
+    
+    def put_stream(self, key: str, pieces: Iterable[str]) -> Iterator[str]:
+        """
+        Pass pieces of text through while storing them for key.
+        
+        The entry is only committed once the pieces are exhausted and were not
+        all empty; a consumer that stops early or an extraction error leaves
+        the cache unchanged.
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        except OSError as e:
+            print(f"Error writing extraction cache: {e}")
+            yield from pieces
+            return
+        committed = False
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                written = False
+                for piece in pieces:
+                    f.write(piece)
+                    written = written or bool(piece.strip())
+                    yield piece
+            if written:
+                os.replace(tmp_path, os.path.join(self.directory, key + ".txt"))
+                committed = True
+                self._evict()
+        except OSError as e:
+            print(f"Error writing extraction cache: {e}")
+        finally:
+            if not committed:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+    
+    def _evict(self) -> None:
+        with self._lock:
+            entries = []
+            # Entries being written count toward the limit
+            total = 0
+            now = time.time()
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith((".txt", ".tmp")):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith(".txt"):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                elif now - stat.st_mtime > EXTRACTION_CACHE_TMP_MAX_AGE:
+                    # Left behind by an extraction that was killed
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                total += stat.st_size
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+_extraction_cache = ExtractionCache()
+
+def _extractor_version(ext: str) -> str:
+    """Version tag of the extractor for a file type, including its parsing library."""
+    if ext == '.pdf' and pdf_available:
+        return f"v{EXTRACTOR_VERSION}.{PyPDF2.__version__}"
+    if ext == '.docx' and docx_available:
+        return f"v{EXTRACTOR_VERSION}.{getattr(docx, '__version__', '0')}"
+    return f"v{EXTRACTOR_VERSION}"
+
+def _normalize_extracted_text(text: str) -> str:
+    """Normalize line endings and drop NUL characters some PDFs produce."""
+    return text.replace('\r\n', '\n').replace('\r', '\n').replace('\x00', '')
+
+def _extract_pdf_pages(file_path: str, start: int, stop: int) -> List[str]:
+    """Extract the text of pages [start, stop) of a PDF; runs in pool workers."""
+    import PyPDF2
+    
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        return [_normalize_extracted_text(pdf_reader.pages[page_num].extract_text() or "")
+                for page_num in range(start, stop)]
+
+# Process pool extracting the pages of large PDFs, shared by all of them;
+# started on first use, as most sessions never see one
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """The shared PDF extraction pool of PDF_WORKERS processes, started on first use."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # Workers come from worker_context: forking this process would
+            # copy locks held by other threads (this runs on the app's job
+            # thread), and spawning would re-run the app's main script
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=worker_context())
+            atexit.register(_pdf_pool.shutdown)
+        return _pdf_pool
+
+def _discard_pdf_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken pool so the next large PDF starts a new one."""
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is pool:
+            _pdf_pool = None
+    pool.shutdown(wait=False)
+
+def iter_pdf_pages(file_path: str, workers: Optional[int] = None) -> Iterator[str]:
+    """
+    Extract the text of a PDF page by page, in page order.
+    
+    PDFs of at least PDF_PARALLEL_MIN_PAGES pages are split into page ranges
+    extracted by the shared process pool. Only a few ranges per worker are
+    in flight at a time, so memory stays bounded however large the file is.
+    
+    Args:
+        file_path: Path to the PDF file
+        workers: Number of pool workers to keep busy; defaults to
+            PDF_WORKERS, and 1 extracts in this process
+        
+    Returns:
+        Iterator over the text of each page
+        
+    Raises:
+        ImportError if PyPDF2 is missing, or the parser's error for a broken file
+    """
     if not pdf_available:
         raise ImportError("PyPDF2 is required to process PDF files. Install it with 'pip install PyPDF2'.")
-        
-    text = ""
+    workers = workers or PDF_WORKERS
+    
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        num_pages = len(pdf_reader.pages)
+        if workers <= 1 or num_pages < PDF_PARALLEL_MIN_PAGES:
+            for page in pdf_reader.pages:
+                yield _normalize_extracted_text(page.extract_text() or "")
+            return
+    
+    # Each worker parses the file itself; only page text crosses processes
+    pool = _get_pdf_pool()
+    pending = deque()
+    try:
+        for start in range(0, num_pages, PDF_PAGE_BATCH):
+            stop = min(start + PDF_PAGE_BATCH, num_pages)
+            pending.append(pool.submit(_extract_pdf_pages, file_path, start, stop))
+            if len(pending) >= workers * PDF_PREFETCH_BATCHES:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory); the pool can't be reused
+        _discard_pdf_pool(pool)
+        raise
+    finally:
+        # A consumer that stops early shouldn't wait for pages it won't read
+        for future in pending:
+            future.cancel()
+
+def extract_text_from_pdf(file_path: str) -> str:
+    """Extract text from a PDF file."""
+    pages = []
     try:
-        # Handle the PyPDF2 import safely
-        import PyPDF2
-        
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            for page_num in range(len(pdf_reader.pages)):
-                page = pdf_reader.pages[page_num]
-                text += page.extract_text() + "\n"
+        for page in iter_pdf_pages(file_path):
+            pages.append(page + "\n")
+    except ImportError:
+        raise
     except Exception as e:
         print(f"Error extracting text from PDF: {e}")
-    return text
+    return "".join(pages)
 
 def extract_text_from_docx(file_path: str) -> str:
     """Extract text from a DOCX file."""
@@ -185,8 +1969,7 @@ def extract_text_from_docx(file_path: str) -> str:
         import docx
         
         doc = docx.Document(file_path)
-        for para in doc.paragraphs:
-            text += para.text + "\n"
+        text = "".join(para.text + "\n" for para in doc.paragraphs)
     except Exception as e:
         print(f"Error extracting text from DOCX: {e}")
     return text
@@ -208,24 +1991,59 @@ def extract_text_from_txt(file_path: str) -> str:
         print(f"Error reading TXT file: {e}")
     return text
 
-def extract_text_from_file(file_path: str) -> str:
-    """Extract text from a file based on its extension."""
+def iter_text_from_file(file_path: str) -> Iterator[str]:
+    """
+    Extract text from a file based on its extension, in pieces.
+    
+    PDF text is produced page by page as it is extracted. PDF and DOCX text
+    is cached on disk by content hash, so a file that was extracted before
+    is never parsed again; a cached file is returned as a single piece.
+    
+    Args:
+        file_path: Path to the file to extract
+        
+    Returns:
+        Iterator over consecutive pieces of the file's text
+    """
     ext = os.path.splitext(file_path)[1].lower()
     
-    if ext == '.pdf':
-        return extract_text_from_pdf(file_path)
-    elif ext == '.docx':
-        return extract_text_from_docx(file_path)
+    if ext in ('.pdf', '.docx'):
+        cache_key = _extraction_cache.key(file_path, ext)
+        text = _extraction_cache.get(cache_key)
+        if text is not None:
+            yield text
+            return
+        
+        if ext == '.pdf':
+            pieces = (page + "\n" for page in iter_pdf_pages(file_path))
+        else:
+            pieces = iter([_normalize_extracted_text(extract_text_from_docx(file_path))])
+        # Failed extractions are retried next time rather than cached
+        yield from _extraction_cache.put_stream(cache_key, pieces)
     elif ext == '.txt':
-        return extract_text_from_txt(file_path)
+        yield _normalize_extracted_text(extract_text_from_txt(file_path))
     else:
         print(f"Unsupported file format: {ext}")
-        return ""
+
+def extract_text_from_file(file_path: str) -> str:
+    """Extract text from a file based on its extension."""
+    pieces = []
+    try:
+        for piece in iter_text_from_file(file_path):
+            pieces.append(piece)
+    except ImportError:
+        raise
+    except Exception as e:
+        print(f"Error extracting text from {file_path}: {e}")
+    return "".join(pieces)
 
 def update_index_from_file(file_path: str) -> bool:
     """
     Process a file and update the vector store index.
     
+    The text is chunked while it is being extracted, so large PDFs are never
+    held in memory as a whole before indexing starts.
+    
     Args:
         file_path: Path to the file to process
         
@@ -233,18 +2051,23 @@ def update_index_from_file(file_path: str) -> bool:
         bool: True if successful, False otherwise
     """
     try:
-        # Extract text from the file
-        text = extract_text_from_file(file_path)
-        
-        if not text:
+        # Extract text from the file, up to the first piece with any text
+        pieces = iter_text_from_file(file_path)
+        head = []
+        for piece in pieces:
+            head.append(piece)
+            if piece.strip():
+                break
+        else:
             print(f"No text could be extracted from {file_path}")
             return False
         
-        # Create vector store instance
-        vector_store = SimpleVectorStore()
+        # Get the shared vector store instance
+        vector_store = get_vector_store()
         
-        # Add document to the vector store
-        vector_store.add_document(file_path, text)
+        # Add document to the vector store; unchanged content is skipped
+        if not vector_store.add_document(file_path, itertools.chain(head, pieces)):
+            print(f"{file_path} is unchanged; index not updated")
         
         return True
         
@@ -252,50 +2075,63 @@ def update_index_from_file(file_path: str) -> bool:
         print(f"Error processing file: {e}")
         return False
 
-def search_index(query: str, top_k: int = 3, specific_docs: Optional[List[str]] = None) -> List[str]:
+def search_index(query: str, top_k: int = 3, specific_docs: Optional[List[str]] = None,
+                 mode: Optional[str] = None) -> List[str]:
     """
     Search the vector store index for relevant document chunks.
     
+    Results are cached per store generation, so repeated questions skip
+    retrieval until a document is added or removed.
+    
     Args:
         query: Query string to search for
         top_k: Number of results to return
         specific_docs: Optional list of specific document paths to search within
+        mode: "keyword" (BM25), "dense" (embedding similarity) or "hybrid";
+            defaults to SEARCH_MODE
         
     Returns:
         List of relevant document chunks
     """
+    return [chunk["content"] for chunk in search_index_chunks(query, top_k, specific_docs, mode)]
+
+def search_index_chunks(query: str, top_k: int = 3, specific_docs: Optional[List[str]] = None,
+                        mode: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Search the vector store index like search_index, returning chunk metadata.
+    
+    Args:
+        query: Query string to search for
+        top_k: Number of results to return
+        specific_docs: Optional list of specific document paths to search within
+        mode: "keyword" (BM25), "dense" (embedding similarity) or "hybrid";
+            defaults to SEARCH_MODE
+        
+    Returns:
+        List of dicts with content, doc_path, doc_name, position and score, best first
+    """
     try:
-        # Create vector store instance
-        vector_store = SimpleVectorStore()
-        
-        # Initialize a filtered index if specific docs are provided
-        if specific_docs and len(specific_docs) > 0:
-            # Filter to only include chunks from the specified documents
-            filtered_index = {}
-            for chunk_id, chunk_data in vector_store.index.items():
-                if chunk_data["doc_path"] in specific_docs:
-                    filtered_index[chunk_id] = chunk_data
-            
-            # If we have a filtered index
-            if filtered_index:
-                # Create a temporary copy of the full index
-                original_index = vector_store.index
-                
-                # Replace with filtered index temporarily
-                vector_store.index = filtered_index
-                
-                # Search the filtered index
-                results = vector_store.search(query, top_k=top_k)
-                
-                # Restore original index
-                vector_store.index = original_index
-                
-                return results
+        # Get the shared vector store instance
+        vector_store = get_vector_store()
+        mode = mode or SEARCH_MODE
         
-        # If no specific docs or empty filtered index, search all
-        results = vector_store.search(query, top_k=top_k)
+        # Writers wait until the search is done, so the results belong to
+        # the generation they are cached under
+        with vector_store.reading():
+            cache_key = (vector_store.directory, vector_store.generation, mode, top_k,
+                         _normalize_query(query), tuple(sorted(set(specific_docs))) if specific_docs else None)
+            results = _query_cache.get(cache_key)
+            if results is None:
+                # Restrict the search to specific docs if any of them are indexed
+                if specific_docs and any(vector_store.has_document(doc_path) for doc_path in specific_docs):
+                    results = vector_store.search_chunks(query, top_k=top_k, doc_paths=specific_docs, mode=mode)
+                else:
+                    # If no specific docs or empty filtered index, search all
+                    results = vector_store.search_chunks(query, top_k=top_k, mode=mode)
+                _query_cache.put(cache_key, results)
         
-        return results
+        # Copies, so callers can't alter the cached entry
+        return [dict(chunk) for chunk in results]
         
     except Exception as e:
         print(f"Error searching index: {e}")
@@ -312,8 +2148,8 @@ def remove_from_index(file_path: str) -> bool:
         bool: True if successful, False otherwise
     """
     try:
-        # Create vector store instance
-        vector_store = SimpleVectorStore()
+        # Get the shared vector store instance
+        vector_store = get_vector_store()
         
         # Remove document from the vector store
         vector_store.remove_document(file_path)
@@ -0,0 +1,73 @@
+import sys
+import types
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from multiprocessing import context as mp_context
+
+# Modules a forkserver imports once, so each worker forked from it starts
+# with them loaded instead of importing them itself
+WORKER_PRELOAD = ["utils.vector_store"]
+
+# Serializes worker starts, as each swaps the process-wide __main__ module
+_main_swap_lock = threading.Lock()
+
+@contextmanager
+def _main_script_hidden():
+    """
+    Keep workers started inside from re-running the main script.
+
+    Spawned and forkserver workers re-import the parent's __main__ from
+    its file. Under Streamlit that is app.py, which would set up the page,
+    run the login form and write credentials in every worker. Workers only
+    run functions from this package, so an empty __main__ stands in while
+    they start.
+    """
+    with _main_swap_lock:
+        main_module = sys.modules['__main__']
+        sys.modules['__main__'] = types.ModuleType('__main__')
+        try:
+            yield
+        finally:
+            sys.modules['__main__'] = main_module
+
+class _ForkServerWorker(mp_context.ForkServerProcess):
+    def start(self):
+        with _main_script_hidden():
+            super().start()
+
+class _SpawnWorker(mp_context.SpawnProcess):
+    def start(self):
+        with _main_script_hidden():
+            super().start()
+
+class _ForkServerContext(mp_context.ForkServerContext):
+    Process = _ForkServerWorker
+
+class _SpawnContext(mp_context.SpawnContext):
+    Process = _SpawnWorker
+
+_worker_context = None
+_worker_context_lock = threading.Lock()
+
+def worker_context() -> mp_context.BaseContext:
+    """
+    Multiprocessing context for the app's worker processes.
+
+    Workers are forked from a forkserver that has WORKER_PRELOAD imported,
+    or spawned where there is no forkserver (Windows). Neither copies the
+    parent's threads and locks, as a plain fork would, and neither re-runs
+    the main script.
+
+    Returns:
+        Context to pass as mp_context / ctx to process pools and managers
+    """
+    global _worker_context
+    with _worker_context_lock:
+        if _worker_context is None:
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                _worker_context = _ForkServerContext()
+                _worker_context.set_forkserver_preload(WORKER_PRELOAD)
+            else:
+                _worker_context = _SpawnContext()
+        return _worker_context